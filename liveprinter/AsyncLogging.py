@@ -0,0 +1,154 @@
+#
+# Logging off the event loop: loggers get a QueueHandler that only puts the
+# (unformatted) record on a queue, and a single writer thread formats and
+# writes them to the right file.  File writes are buffered and flushed every
+# so often instead of after every line, and files rotate by size or time,
+# optionally gzipping the old ones.
+#
+# See main license for details.
+#
+import atexit
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+
+#
+# only flushes the file every flush_interval seconds, so lots of small
+# records turn into a few big writes
+#
+class BufferedFlushMixin():
+    flush_interval = 1.0 # in s
+
+    def flush(self):
+        now = time.monotonic()
+        if now - getattr(self, '_last_flush', 0) >= self.flush_interval:
+            self.flush_now()
+
+    def flush_now(self):
+        self._last_flush = time.monotonic()
+        super().flush()
+
+
+class BufferedRotatingFileHandler(BufferedFlushMixin, logging.handlers.RotatingFileHandler):
+    pass
+
+
+class BufferedTimedRotatingFileHandler(BufferedFlushMixin, logging.handlers.TimedRotatingFileHandler):
+    pass
+
+
+def gzip_namer(name:str):
+    return name + ".gz"
+
+def gzip_rotator(source:str, dest:str):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+
+#
+# make a buffered log file handler.  Rotates when it reaches max_bytes, or
+# if when is given (e.g. 'midnight', 'H') on that schedule instead.  With
+# compress, rotated files are gzipped.
+#
+def file_handler(path:str, formatter:logging.Formatter=None, max_bytes:int=0, backup_count:int=10, when:str=None, compress:bool=False, flush_interval:float=1.0):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    if when:
+        handler = BufferedTimedRotatingFileHandler(path, when=when, backupCount=backup_count, delay=True)
+    else:
+        handler = BufferedRotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, delay=True)
+    handler.flush_interval = flush_interval
+    if formatter is not None:
+        handler.setFormatter(formatter)
+    if compress:
+        handler.namer = gzip_namer
+        handler.rotator = gzip_rotator
+    return handler
+
+
+#
+# puts records on the queue as they are: no formatting on the caller's thread
+#
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+
+#
+# one writer thread for any number of loggers, each routed to its own handler
+#
+class LogPipeline(logging.handlers.QueueListener):
+    def __init__(self, flush_interval:float=1.0):
+        super().__init__(queue.SimpleQueue())
+        self.flush_interval = flush_interval
+        self._routes = {} # logger name -> handler
+        self._lock = threading.Lock()
+
+    #
+    # send everything logged to logger through the queue to handler
+    #
+    def attach(self, logger:logging.Logger, handler:logging.Handler):
+        with self._lock:
+            self._routes[logger.name] = handler
+            if self._thread is None:
+                self.start()
+        logger.addHandler(LazyQueueHandler(self.queue))
+
+    def detach(self, logger:logging.Logger):
+        for handler in list(logger.handlers):
+            if isinstance(handler, LazyQueueHandler) and handler.queue is self.queue:
+                logger.removeHandler(handler)
+        with self._lock:
+            handler = self._routes.pop(logger.name, None)
+        if handler is not None:
+            # close from the writer thread, after anything still queued
+            self.queue.put_nowait(_CloseHandler(handler))
+
+    def dequeue(self, block):
+        # wake up every so often to flush, even when nothing is being logged
+        while True:
+            try:
+                return self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                self.flush()
+
+    def handle(self, record):
+        if isinstance(record, _CloseHandler):
+            record.handler.close()
+            return
+        handler = self._routes.get(record.name)
+        if handler is not None and record.levelno >= handler.level:
+            handler.handle(record)
+
+    def flush(self):
+        for handler in list(self._routes.values()):
+            try:
+                if isinstance(handler, BufferedFlushMixin):
+                    handler.flush_now()
+                else:
+                    handler.flush()
+            except Exception:
+                pass
+
+    def stop(self):
+        if self._thread is not None:
+            super().stop()
+        self.flush()
+
+
+class _CloseHandler():
+    def __init__(self, handler):
+        self.handler = handler
+        self.name = None
+        self.levelno = 0
+
+
+# shared by everything in the server
+log_pipeline = LogPipeline()
+atexit.register(log_pipeline.stop)
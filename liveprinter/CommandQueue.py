@@ -0,0 +1,101 @@
+#
+# Async command queue for the printer: one command talks to the serial port
+# at a time, waiters are served in priority then FIFO order, and the number
+# of waiting commands is bounded so callers get told when it's full.
+#
+# See main license for details.
+#
+import asyncio
+import heapq
+import itertools
+import re
+
+# same values as the front end (js/constants/priority.js) -- lower runs first
+PRIORITY_HIGHEST = 2
+PRIORITY_HIGH = 3
+PRIORITY_NORMAL = 4
+PRIORITY_LOW = 5
+PRIORITY_LOWEST = 6
+
+# emergency stop, cancel heating wait, quickstop
+EMERGENCY_COMMANDS = re.compile(r"^\s*(M112|M108|M410)(?!\d)", re.IGNORECASE)
+
+
+class CommandQueueFull(Exception):
+    pass
+
+
+class CommandQueue():
+    def __init__(self, maxsize:int=256):
+        self.maxsize = maxsize # max number of waiting commands, 0 for unbounded
+        self._waiters = [] # heap of (priority, order, future)
+        self._order = itertools.count()
+        self._locked = False
+        self.on_change = None # called with the new depth whenever it changes
+
+    #
+    # pick a priority for a command, emergency commands jump the queue
+    #
+    @staticmethod
+    def priority_for(cmd, default:int=PRIORITY_NORMAL):
+        if CommandQueue.is_emergency(cmd):
+            return PRIORITY_HIGHEST
+        return default
+
+    @staticmethod
+    def is_emergency(cmd):
+        if isinstance(cmd, bytes):
+            cmd = cmd.decode('cp437')
+        return EMERGENCY_COMMANDS.match(str(cmd)) is not None
+
+    def locked(self):
+        return self._locked
+
+    #
+    # number of commands waiting for their turn (not counting the running one)
+    #
+    def waiting(self):
+        return sum(1 for (_, _, fut) in self._waiters if not fut.done())
+
+    def depth(self):
+        return self.waiting() + (1 if self._locked else 0)
+
+    #
+    # wait for our turn -- raises CommandQueueFull if too many are waiting
+    #
+    async def acquire(self, priority:int=PRIORITY_NORMAL):
+        if not self._locked:
+            self._locked = True
+            self._changed()
+            return
+
+        if self.maxsize > 0 and self.waiting() >= self.maxsize:
+            raise CommandQueueFull("command queue full ({} waiting)".format(self.maxsize))
+
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), fut))
+        self._changed()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # we were handed the lock just as we got cancelled, pass it on
+                self.release()
+            raise
+
+    #
+    # hand over to the next waiter, or unlock if there's nobody
+    #
+    def release(self):
+        while self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                fut.set_result(True) # still locked, now owned by the waiter
+                self._changed()
+                return
+        self._locked = False
+        self._changed()
+
+    def _changed(self):
+        if self.on_change is not None:
+            self.on_change(self.depth())
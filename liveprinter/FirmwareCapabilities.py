@@ -0,0 +1,168 @@
+#
+# What the printer's firmware can do, learned from its M115 reply when it
+# connects: name and version, the Cap: flags (AUTOREPORT_TEMP,
+# EMERGENCY_PARSER, ...) and, if it sends ADVANCED_OK oks, the size of its
+# command buffer and planner.  SerialDevice tunes itself from this (streaming
+# window, temperature auto-reports, how emergency commands are sent).
+#
+# Records are cached on disk per port and firmware version, so a printer that
+# was seen before is tuned straight away on reconnect.
+#
+# See main license for details.
+#
+import json
+import os
+import time
+import logging
+from MarlinParsers import parse_line, OkResponse, FirmwareInfo, CapabilityReport
+
+
+class FirmwareCapabilities():
+    def __init__(self, firmware:dict=None, caps:dict=None, command_buffer_size:int=None,
+            planner_size:int=None, rx_buffer_size:int=None, probed:float=None):
+        self.firmware = firmware if firmware is not None else {} # FIRMWARE_NAME line fields
+        self.caps = caps # Cap: name -> bool, None if the firmware doesn't list them
+        self.command_buffer_size = command_buffer_size # BUFSIZE, from ADVANCED_OK
+        self.planner_size = planner_size # BLOCK_BUFFER_SIZE, from ADVANCED_OK
+        self.rx_buffer_size = rx_buffer_size # serial RX buffer in bytes, if known
+        self.probed = probed # when M115 was answered, in ms
+
+    #
+    # from the lines of an M115 reply (including its ok)
+    #
+    @classmethod
+    def fromLines(cls, lines:list):
+        capabilities = cls(probed=time.time() * 1000)
+        for line in lines:
+            response = parse_line(str(line))
+            if isinstance(response, FirmwareInfo):
+                capabilities.firmware = response.fields
+            elif isinstance(response, CapabilityReport):
+                if capabilities.caps is None:
+                    capabilities.caps = {}
+                capabilities.caps[response.name] = response.enabled
+            elif isinstance(response, OkResponse):
+                space = response.buffer_space
+                if space is not None:
+                    # the printer is idle, so everything but the M115 itself is free
+                    (_, planner_free, buffer_free) = space
+                    capabilities.planner_size = planner_free + 1
+                    capabilities.command_buffer_size = buffer_free + 1
+        return capabilities
+
+    @classmethod
+    def fromDict(cls, fields:dict):
+        return cls(firmware=fields.get('firmware'), caps=fields.get('caps'),
+            command_buffer_size=fields.get('command_buffer_size'), planner_size=fields.get('planner_size'),
+            rx_buffer_size=fields.get('rx_buffer_size'), probed=fields.get('probed'))
+
+    def toDict(self):
+        return {
+            'firmware': self.firmware,
+            'caps': self.caps,
+            'command_buffer_size': self.command_buffer_size,
+            'planner_size': self.planner_size,
+            'rx_buffer_size': self.rx_buffer_size,
+            'probed': self.probed,
+            'advanced_ok': self.advanced_ok,
+            'estop': self.estop_strategy,
+            }
+
+    #
+    # whether the firmware answered M115 at all
+    #
+    @property
+    def known(self):
+        return bool(self.firmware)
+
+    @property
+    def version(self):
+        return self.firmware.get('FIRMWARE_NAME', '')
+
+    #
+    # a Cap: flag: True or False, None if the firmware doesn't say
+    #
+    def has(self, name:str):
+        if self.caps is None:
+            return None
+        return self.caps.get(name, False)
+
+    @property
+    def advanced_ok(self):
+        return self.command_buffer_size is not None
+
+    @property
+    def autoreport_temp(self):
+        return self.has('AUTOREPORT_TEMP')
+
+    #
+    # 'immediate': the firmware acts on M112/M108/M410 as soon as they arrive
+    # (EMERGENCY_PARSER), so they can go out without waiting for room in the
+    # streaming window.  'queued': they wait their turn like any other line.
+    #
+    @property
+    def estop_strategy(self):
+        return 'immediate' if self.has('EMERGENCY_PARSER') else 'queued'
+
+    #
+    # fill in what this probe couldn't measure from an earlier one of the
+    # same firmware (e.g. the printer was busy, so the buffer sizes are off)
+    #
+    def merge(self, other):
+        if other is None or other.version != self.version:
+            return
+        if self.command_buffer_size is None:
+            self.command_buffer_size = other.command_buffer_size
+            self.planner_size = other.planner_size
+        if self.rx_buffer_size is None:
+            self.rx_buffer_size = other.rx_buffer_size
+
+
+#
+# capabilities on disk, as JSON: port -> {'last': version, version -> record}.
+# Several printers (or worker processes) may share the file, so it's read
+# again before each save and replaced in one go.
+#
+class CapabilityCache():
+    def __init__(self, path:str):
+        self.path = path
+        self.logger = logging.getLogger("{name}.cache".format(name=__name__))
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            self.logger.error("couldn't read firmware cache {}: {}".format(self.path, repr(e)))
+            return {}
+
+    #
+    # the record for this port and firmware version, or the last one seen
+    # on the port if version is None
+    #
+    def get(self, port:str, version:str=None):
+        entry = self._load().get(str(port))
+        if not entry:
+            return None
+        if version is None:
+            version = entry.get('last')
+        fields = entry.get('versions', {}).get(version)
+        return FirmwareCapabilities.fromDict(fields) if fields else None
+
+    def save(self, port:str, capabilities:FirmwareCapabilities):
+        if not capabilities.known:
+            return
+        cache = self._load()
+        entry = cache.setdefault(str(port), {'versions': {}})
+        entry['last'] = capabilities.version
+        entry.setdefault('versions', {})[capabilities.version] = capabilities.toDict()
+        temp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            with open(temp_path, 'w') as f:
+                json.dump(cache, f, indent=1)
+            os.replace(temp_path, self.path)
+        except OSError as e:
+            self.logger.error("couldn't write firmware cache {}: {}".format(self.path, repr(e)))
@@ -0,0 +1,65 @@
+#
+# Framing for outgoing GCODE: line numbers and checksums, straight on bytes.
+#
+# Marlin's checksum is the XOR of every byte before the '*', and XOR doesn't
+# care about order, so a command's checksum can be worked out once (when
+# it's prepared) and combined with the line number's checksum when it's sent.
+# Retries, resends and renumbering never have to look at the command again.
+#
+# See main license for details.
+#
+import functools
+import operator
+from typing import Union
+
+#
+# XOR checksum of some bytes.  reduce() runs the loop in C; folding the
+# bytes as 64-bit words or a lookup table was slower for lines the length of
+# a GCODE command, and the body's checksum is only worked out once anyway.
+#
+def checksum(data:bytes):
+    return functools.reduce(operator.xor, data, 0)
+
+# checksums for "N<number>", worked out as needed
+_LINE_NUMBER_CHECKSUMS = {}
+
+def line_number_checksum(line_number:int):
+    try:
+        return _LINE_NUMBER_CHECKSUMS[line_number]
+    except KeyError:
+        value = checksum(b"N%d" % line_number)
+        if len(_LINE_NUMBER_CHECKSUMS) < 65536:
+            _LINE_NUMBER_CHECKSUMS[line_number] = value
+        return value
+
+
+#
+# a command ready for framing: its bytes (no line ending) and their checksum
+#
+class PreparedLine():
+    __slots__ = ('body', 'body_checksum')
+
+    def __init__(self, cmd:Union[str,bytes]):
+        if isinstance(cmd, str):
+            cmd = cmd.encode()
+        self.body = cmd.rstrip(b"\r\n")
+        self.body_checksum = checksum(self.body)
+
+    #
+    # numbered line with checksum and line ending, as sent to the printer
+    #
+    def frame(self, line_number:int):
+        return b"N%d%s*%d\n" % (line_number, self.body, line_number_checksum(line_number) ^ self.body_checksum)
+
+    #
+    # for ports that don't want line numbers (the dummy printer)
+    #
+    def unframed(self):
+        return self.body + b"\n"
+
+
+def prepare(cmd:Union[str,bytes]):
+    return PreparedLine(cmd)
+
+def frame(line_number:int, cmd:Union[str,bytes]):
+    return PreparedLine(cmd).frame(line_number)
@@ -0,0 +1,59 @@
+#
+# One place to turn responses into JSON, with a choice of encoder: orjson
+# (much faster, if it's installed) or the standard library's json.  Whole
+# responses (and batches of them) are encoded in one pass, straight to a
+# string ready for the wire.
+#
+# See main license for details.
+#
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+ENCODERS = ('auto', 'json', 'orjson')
+
+_use_orjson = orjson is not None
+
+
+#
+# choose the encoder: 'json', 'orjson', or 'auto' for orjson if it's there
+#
+def use_encoder(name:str='auto'):
+    global _use_orjson
+    if name not in ENCODERS:
+        raise ValueError("Bad JSON encoder: {}".format(repr(name)))
+    if name == 'orjson' and orjson is None:
+        raise ValueError("orjson isn't installed")
+    _use_orjson = orjson is not None and name != 'json'
+
+
+def encoder_name():
+    return 'orjson' if _use_orjson else 'json'
+
+
+#
+# JSON text (str) for obj
+#
+def encode(obj):
+    return encode_bytes(obj).decode('utf-8') if _use_orjson else json.dumps(obj)
+
+
+#
+# JSON as UTF-8 bytes, for sockets and files
+#
+def encode_bytes(obj):
+    if _use_orjson:
+        try:
+            return orjson.dumps(obj)
+        except TypeError:
+            pass # something orjson won't do (e.g. ints over 64 bits), json will
+    return json.dumps(obj).encode('utf-8')
+
+
+def decode(data):
+    if _use_orjson:
+        return orjson.loads(data)
+    return json.loads(data)
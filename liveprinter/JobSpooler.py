@@ -0,0 +1,154 @@
+#
+# Streams a GCODE file from disk to a printer on the server, so a long print
+# doesn't depend on a browser tab (and a round trip per line).  The file is
+# read in chunks off the event loop and never held in memory whole; lines
+# go to the printer in batches through the command queue like any other
+# commands, so live-coded commands and emergency stops still get in between.
+#
+# Jobs can be paused and resumed (between batches) or cancelled, and report
+# their progress as 'job' events to the printer's listeners.
+#
+# See main license for details.
+#
+import asyncio
+import os
+import time
+from printerreponse import PrinterResponse
+from SerialDevice import error_line
+
+
+class JobSpooler():
+    def __init__(self, printer, path:str, chunk_size:int=64*1024, batch_size:int=32, report_interval:float=0.5):
+        self.printer = printer
+        self.path = path
+        self.chunk_size = chunk_size # bytes read from the file at a time
+        self.batch_size = batch_size # lines sent to the printer at a time
+        self.report_interval = report_interval # s between progress events
+
+        self.state = 'waiting' # printing, paused, done, cancelled or failed
+        self.error = None
+        self.bytes_total = os.path.getsize(path)
+        self.bytes_read = 0
+        self.bytes_sent = 0 # of the file, up to the end of the last line sent
+        self.lines_sent = 0
+        self.started = None
+        self.finished = None
+        self._resumed = asyncio.Event()
+        self._resumed.set()
+        self._task = None
+        self._last_report = 0
+
+    def start(self):
+        if self._task is None:
+            self.started = time.time()
+            self.state = 'printing'
+            self._task = asyncio.ensure_future(self._run())
+        return self._task
+
+    @property
+    def active(self):
+        return self.state in ('waiting', 'printing', 'paused')
+
+    #
+    # stop sending after the batch in progress
+    #
+    def pause(self):
+        if self.state == 'printing':
+            self.state = 'paused'
+            self._resumed.clear()
+            self._report()
+
+    def resume(self):
+        if self.state == 'paused':
+            self.state = 'printing'
+            self._resumed.set()
+            self._report()
+
+    def cancel(self):
+        if self.active:
+            self.state = 'cancelled'
+            self._resumed.set() # let a paused job see it's cancelled
+            self._report()
+
+    def progress(self):
+        finished = self.finished if self.finished is not None else time.time()
+        return {
+            'file': os.path.basename(self.path),
+            'state': self.state,
+            'error': self.error,
+            'bytes_total': self.bytes_total,
+            'bytes_sent': self.bytes_sent,
+            'percent': 100.0 * self.bytes_sent / self.bytes_total if self.bytes_total else 100.0,
+            'lines_sent': self.lines_sent,
+            'elapsed': finished - self.started if self.started is not None else 0,
+            }
+
+    #
+    # progress event for websocket clients, at most every report_interval
+    # unless something changed
+    #
+    def _report(self, force:bool=True):
+        now = time.monotonic()
+        if force or now - self._last_report >= self.report_interval:
+            self._last_report = now
+            self.printer._notify(PrinterResponse(type='job', command=None, **self.progress()))
+
+    #
+    # lines of GCODE in the file, in batches, with the file offset after the
+    # last line of each batch.  Comments and blank lines are left out.
+    #
+    async def _batches(self):
+        loop = asyncio.get_event_loop()
+        with open(self.path, 'rb') as f:
+            rest = b"" # the start of a line that didn't fit in the last chunk
+            offset = 0 # file offset at the start of rest
+            batch = []
+            while True:
+                chunk = await loop.run_in_executor(None, f.read, self.chunk_size)
+                self.bytes_read += len(chunk)
+                lines = (rest + chunk).split(b"\n")
+                rest = lines.pop() if chunk else b""
+                for line in lines:
+                    offset += len(line) + 1
+                    line = line.split(b";", 1)[0].strip()
+                    if line:
+                        batch.append(line.decode('latin1'))
+                        if len(batch) >= self.batch_size:
+                            yield batch, min(offset, self.bytes_total)
+                            batch = []
+                if not chunk:
+                    if batch:
+                        yield batch, self.bytes_total
+                    return
+
+    async def _run(self):
+        batches = self._batches()
+        try:
+            async for batch, offset in batches:
+                await self._resumed.wait()
+                if self.state == 'cancelled':
+                    break
+                results = await self.printer.send_commands(batch)
+                self.lines_sent += len(batch)
+                self.bytes_sent = offset
+                for result in results:
+                    error = error_line(result)
+                    if error is not None:
+                        self.state = 'failed'
+                        self.error = error
+                        break
+                if self.state == 'failed':
+                    break
+                self._report(force=False)
+            else:
+                if self.state != 'cancelled': # whilst the last batch was sent
+                    self.state = 'done'
+                    self.bytes_sent = self.bytes_total # including any comments at the end
+        except Exception as e:
+            self.printer.serial_logger.error("job {} failed: {}".format(self.path, repr(e)))
+            self.state = 'failed'
+            self.error = repr(e)
+        finally:
+            await batches.aclose() # closes the file
+        self.finished = time.time()
+        self._report()
@@ -0,0 +1,72 @@
+#
+# Buffered line receiver: reads whatever the printer has sent in one go (the
+# port's in_waiting bytes) into a reusable bytearray and splits off the
+# complete lines, keeping any partial line for the next read.
+#
+# readline() on a serial port reads a byte at a time and gives up with half a
+# line on timeout, so a chatty printer (temperature auto-reports on top of the
+# oks) cost a system call per byte.  This is one or two per burst.
+#
+# See main license for details.
+#
+
+class LineBuffer():
+    def __init__(self, max_line:int=4096, encoding:str='cp437'):
+        self._buffer = bytearray()
+        self.max_line = max_line # a "line" this long without a newline is passed on anyway
+        self.encoding = encoding # this format seems to work best for cross-platform Marlin printers
+        self.reads = 0 # read() calls on the port
+        self.bytes_read = 0
+
+    #
+    # add received bytes, returns the complete lines (str, with their
+    # newlines, like readline())
+    #
+    def feed(self, data:bytes):
+        buffer = self._buffer
+        start = len(buffer)
+        buffer += data
+        end = buffer.find(b"\n", start)
+        if end < 0 and len(buffer) <= self.max_line:
+            return []
+
+        lines = []
+        start = 0
+        with memoryview(buffer) as view:
+            while end >= 0:
+                lines.append(str(view[start:end + 1], self.encoding))
+                start = end + 1
+                end = buffer.find(b"\n", start)
+            if len(buffer) - start > self.max_line:
+                lines.append(str(view[start:], self.encoding))
+                start = len(buffer)
+        del buffer[:start] # the partial line left, if any
+        return lines
+
+    #
+    # read everything the port has for us, waiting up to its timeout for the
+    # first byte.  Returns the complete lines, or None if nothing arrived.
+    #
+    def read_lines(self, serial):
+        waiting = serial.in_waiting
+        data = serial.read(waiting if waiting > 0 else 1)
+        if not data:
+            return None
+        if waiting <= 0:
+            # woke up for the first byte, the rest of the burst is likely there
+            waiting = serial.in_waiting
+            if waiting > 0:
+                data += serial.read(waiting)
+                self.reads += 1
+        self.reads += 1
+        self.bytes_read += len(data)
+        return self.feed(data)
+
+    #
+    # bytes of a partial line waiting for the rest
+    #
+    def pending(self):
+        return len(self._buffer)
+
+    def clear(self):
+        self._buffer.clear()
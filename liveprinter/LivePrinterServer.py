@@ -26,6 +26,11 @@
 # curl --insecure --data '{ "jsonrpc": "2.0", "id": 6, "method":
 # "get-serial-ports","params": []}' http://localhost:8888/jsonrpc
 #
+# to print a file from the server, upload it then start it:
+# curl -T model.gcode http://localhost:8888/jobs/model.gcode
+# curl --data '{ "jsonrpc": "2.0", "id": 7, "method": "start-job",
+# "params": [ "model.gcode" ]}' http://localhost:8888/jsonrpc
+#
 #
 # python -m serial.tools.list_ports will print a list of available ports.  It
 # is also possible to add a regexp as first argument and the list will only
@@ -42,22 +47,69 @@ import tornado.httpserver
 import tornado.ioloop
 import tornado.options
 import tornado.web
+import tornado.websocket
 from tornado import gen
 from serial import Serial, SerialException, SerialTimeoutException
 import serial.tools.list_ports
 import dummyserial
 from ConnectionState import ConnectionState
-from SerialDevice import SerialDevice
+from SerialDevice import SerialDevice, is_error_result
+from PrinterRegistry import PrinterRegistry, UnknownPrinter
+from PrinterWorker import WorkerPrinter
+from CommandQueue import PRIORITY_NORMAL
 from tornado.options import define, options
 import functools
+import asyncio
 from tornado_jsonrpc2.handler import JSONRPCHandler
+from tornado_jsonrpc2.jsonrpc import decode as jsonrpc_decode
+from tornado_jsonrpc2.exceptions import JSONRPCError, ParseError, InvalidParams
+from printerreponse import PrinterResponse
+from LoopLagMonitor import LoopLagMonitor
+from MethodRegistry import MethodRegistry
+from JSONEncoding import use_encoder, encode, ENCODERS
+from JobSpooler import JobSpooler
+import re
 import time
 from typing import Union
 import logging
 import tornado.log
+from AsyncLogging import log_pipeline, file_handler
+
+
+#
+# files the server keeps between runs go in a folder per user, not in the
+# source tree
+#
+def user_state_path(*names):
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA', os.path.expanduser('~'))
+    else:
+        base = os.environ.get('XDG_STATE_HOME', os.path.join(os.path.expanduser('~'), '.local', 'state'))
+    return os.path.join(base, 'liveprinter', *names)
 
 
 define("port", default=8888, help="run on the given port", type=int)
+define("dummy_latency", default=[0.01, 0.3], multiple=True, type=float, help="dummy printer reply delay in s: a fixed delay, or min,max for random delays (0 for none)")
+define("dummy_clock", default="real", help="dummy printer clock: real, or virtual to simulate the delays without waiting")
+define("dummy_firmware", default="canned", help="dummy printer replies: canned, or marlin for a simulated Marlin (planner queue, move times, heaters)")
+define("dummy_seed", default=None, type=int, help="random seed for the dummy printer's delays")
+define("workers", default=False, type=bool, help="run each printer in its own worker process, so they can use all cores (Unix only)")
+define("printers", default=[], multiple=True, help="ids of more printers to drive besides the default one, e.g. --printers=left,right (see add-printer)")
+define("jobs_path", default=user_state_path("jobs"), help="folder for uploaded GCODE files (see start-job)")
+define("max_upload_size", default=1024*1024*1024, type=int, help="largest GCODE file that can be uploaded, in bytes")
+define("telemetry_interval", default=0, type=float, help="s between temperature reports for get-telemetry (M155 auto-report, or M105 polls), 0 for none (turn it on with set-telemetry)")
+define("firmware_cache", default=user_state_path("firmware-capabilities.json"), help="file to cache what each printer's firmware can do (from M115) in, empty for none")
+define("auto_tune", default=True, type=bool, help="size the streaming window and choose telemetry and emergency command handling from the firmware's capabilities")
+define("coalesce_writes", default=True, type=bool, help="send the lines written in one event loop pass to the printer in one write, instead of a write and flush per line")
+define("json_encoder", default="auto", help="JSON encoder for responses: {} (auto uses orjson if it's installed)".format(", ".join(ENCODERS)))
+define("logs_path", default=user_state_path("logs"), help="folder for the server, gcode and serial logs")
+define("compress_logs", default=False, help="gzip old gcode logs when they rotate (see --log_rotate_mode)", type=bool)
+
+# the JSON-RPC API: handlers register themselves below
+rpc_methods = MethodRegistry()
+
+# event loop lag, for get-metrics (the server's, or a worker process's)
+loop_monitor = LoopLagMonitor()
 
 # create logger for this module
 
@@ -71,21 +123,27 @@ acc_logger.propagate = False
 logger = tornado.log.app_log
 
 logger.setLevel(logging.ERROR)
-# create file handler which logs even debug messages
-server_log = logging.FileHandler(
-    os.path.join(
-        os.path.dirname(__file__), 
-        "logs", 
-        "server-{time}.log".format(time=time.time())
+
+#
+# create file handler which logs even debug messages (written on the log
+# pipeline's thread, not the event loop).  Called once the command line
+# has been read, it says where the logs go.
+#
+def start_server_log():
+    server_log = file_handler(
+        os.path.join(
+            options.logs_path,
+            "server-{time}.log".format(time=time.time())
+            ),
+        max_bytes=options.log_file_max_size
         )
-    )
 
-server_log.setLevel(logging.ERROR)
-# create formatter and add it to the handlers
-formatter = logging.Formatter('%(asctime)s::%(name)s.%(funcName)s[%(lineno)s]: %(message)s')
-server_log.setFormatter(formatter)
-# add the handlers to the logger
-logger.addHandler(server_log)
+    server_log.setLevel(logging.ERROR)
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s::%(name)s.%(funcName)s[%(lineno)s]: %(message)s')
+    server_log.setFormatter(formatter)
+    # add the handlers to the logger
+    log_pipeline.attach(logger, server_log)
 
 
 class TestHandler(tornado.web.RequestHandler):
@@ -93,6 +151,9 @@ class TestHandler(tornado.web.RequestHandler):
         self.printer = kwargs["printer"]
 
     async def get(self):
+        if isinstance(self.printer, WorkerPrinter):
+            # the serial port is open in the worker process, not here
+            raise tornado.web.HTTPError(501, "/test is not available with --workers")
         result = await self.printer.async_connect()
         self.write("Hello, world: {}".format(repr(result)))
 
@@ -136,6 +197,159 @@ class JsonQueueTestHandler(tornado.web.RequestHandler):
             logger.error("ERROR in GET: {}".format(repr(e)))
 
 
+#
+# WebSocket push channel: streams everything the printer says (ok, temperature,
+# position, resend, echo, error...) and command queue changes as JSON-RPC
+# notifications (see PrinterResponse.toJSONRPC).  Accepts JSON-RPC requests
+# (same API as /jsonrpc) or plain lines of gcode.
+#
+class PrinterSocketHandler(tornado.websocket.WebSocketHandler):
+    def initialize(self, **kwargs):
+        self.printers = kwargs["printers"]
+        self.response_creator = kwargs["response_creator"]
+        self.printer_id = None
+        self.printer = None
+
+    def check_origin(self, origin):
+        return True # allow Max/MSP and other local clients
+
+    def open(self, printer_id=None):
+        try:
+            self.printer = self.printers.get(printer_id)
+        except UnknownPrinter as e:
+            logger.error("websocket for {}".format(e))
+            self.close(reason="Unknown printer")
+            return
+        self.printer_id = printer_id
+        self.printer.add_listener(self.send_response)
+        logger.debug("websocket opened")
+
+    def on_close(self):
+        if self.printer is not None:
+            self.printer.remove_listener(self.send_response)
+        logger.debug("websocket closed")
+
+    def send_response(self, response:PrinterResponse):
+        try:
+            self.write_message(response.toJSON())
+        except tornado.websocket.WebSocketClosedError:
+            self.printer.remove_listener(self.send_response)
+
+    async def on_message(self, message):
+        try:
+            request = jsonrpc_decode(message)
+        except ParseError as e:
+            if message.lstrip()[:1] in ('{', '[', b'{', b'['):
+                # broken json (e.g. cut short), which must never reach the printer
+                self.write_message(encode({'jsonrpc': '2.0', 'id': None, 'error': {'code': e.error_code, 'message': str(e)}}))
+                return
+            # not json, so it's gcode
+            gcode = [line for line in message.splitlines() if line.strip() != ""]
+            results = await call_printer(self.printer, "send-gcode-batch", [gcode])
+            self.send_response(PrinterResponse(type='gcode', command=gcode, results=results))
+            return
+        except JSONRPCError as e:
+            self.write_message(encode({'jsonrpc': '2.0', 'id': None, 'error': {'code': e.error_code, 'message': str(e)}}))
+            return
+
+        if isinstance(request, list):
+            responses = await rpc_methods.batch(request, self.handle_call)
+            self.write_message(encode(responses))
+        else:
+            self.write_message(encode(await self.handle_call(request)))
+
+    async def handle_call(self, request):
+        if isinstance(request, JSONRPCError):
+            return {'jsonrpc': '2.0', 'id': None, 'error': {'code': request.error_code, 'message': str(request)}}
+        try:
+            result = await self.response_creator(request, self.printer_id)
+        except JSONRPCError as e:
+            return {'jsonrpc': '2.0', 'id': request.id, 'error': {'code': e.error_code, 'message': "{}: {}".format(e.short_message, e)}}
+        except Exception as e:
+            logger.error("websocket request failed: {}".format(repr(e)))
+            return {'jsonrpc': '2.0', 'id': request.id, 'error': {'code': -32603, 'message': repr(e)}}
+        return {'jsonrpc': '2.0', 'id': request.id, 'result': result}
+
+
+#
+# upload a GCODE file to print with start-job: PUT (or POST) the file itself
+# to /jobs/<name>.  It's written to disk as it arrives, never held in memory.
+#
+@tornado.web.stream_request_body
+class JobUploadHandler(tornado.web.RequestHandler):
+    def check_xsrf_cookie(self):
+        pass
+
+    async def prepare(self):
+        self._file = None
+        self._bytes = 0
+        try:
+            self._path = job_path(self.path_args[0], must_exist=False)
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, reason=str(e))
+        self.request.connection.set_max_body_size(options.max_upload_size)
+        os.makedirs(options.jobs_path, exist_ok=True)
+        self._file = open(self._path + ".part", 'wb')
+
+    async def data_received(self, chunk):
+        await asyncio.get_event_loop().run_in_executor(None, self._file.write, chunk)
+        self._bytes += len(chunk)
+
+    async def put(self, name):
+        self._file.close()
+        os.replace(self._path + ".part", self._path)
+        self._file = None
+        self.write({'file': name, 'bytes': self._bytes, 'time': time.time() * 1000})
+
+    async def post(self, name):
+        await self.put(name)
+
+    def on_finish(self):
+        self._discard()
+
+    def on_connection_close(self):
+        self._discard()
+
+    # an upload that didn't finish
+    def _discard(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            os.remove(self._path + ".part")
+
+
+#
+# JSON-RPC for one printer of many: /printers/<id>/jsonrpc
+#
+class PrinterJSONRPCHandler(JSONRPCHandler):
+    async def post(self, printer_id=None):
+        self.printer_id = printer_id
+        await self.handle_jsonrpc(self.request)
+
+    async def compute_result(self, request):
+        return await self.create_response(request, self.printer_id)
+
+    # responses (and whole batches of them) are encoded in one go with the
+    # chosen encoder (see --json_encoder)
+    async def process_jsonrpc_request(self, request):
+        if isinstance(request, list):
+            message = await self.process_jsonrpc_batch_request(request)
+        else:
+            message = await self.process_jsonrpc_single_request(request)
+        if message:
+            self.write(encode(message))
+
+    # run the calls in a batch together where that's safe
+    async def process_jsonrpc_batch_request(self, request):
+        responses = await rpc_methods.batch(request, self.batch_response)
+        return [response for response in responses if response]
+
+    async def batch_response(self, call):
+        if isinstance(call, JSONRPCError):
+            return self.exception_to_jsonrpc(call)
+        return await self.create_jsonrpc_response(call)
+
+
 #
 # list all serial ports
 #
@@ -151,53 +365,67 @@ async def list_ports():
     return ports
 
 
-def use_dummy_serial_port(printer:SerialDevice):
-    # FIXME
-    # not great, should be async!!!
-
-    def delayed_string(result:Union[str,bytes]):
-        # print ("delayed string {}".format(time.time()))
-        time.sleep(random.uniform(0.01,0.3)) # removed for testing speed
-        # print ("delayed string {}".format(time.time()))
-        return result
+def use_dummy_serial_port(printer:SerialDevice, firmware:str=None):
+    # replies are delayed by the dummy port itself (see --dummy_latency),
+    # without blocking
+    if firmware is None:
+        firmware = options.dummy_firmware
+    latency = options.dummy_latency
+    if len(latency) == 1:
+        latency = latency[0]
 
     printer._serial_port = "/dev/null"
-    printer._serial = dummyserial.Serial(port=printer._serial_port,
-        baudrate=printer._baud_rate,
-        ds_responses={
-            'N?[0-9]*(M105).*': lambda : delayed_string(b'ok T:%.2f /190.0 B:%.2f /24.0 @:0 B@:0\nok\nok\n' % (random.uniform(170,195),random.uniform(20,35))),
-            'N?[0-9]*M115.*': lambda : delayed_string(b'FIRMWARE_NAME:DUMMY\nok\nok\n'),
-            'N?[0-9]*M114': lambda : delayed_string(b'X:%.2fY:%.2fZ:%.2fE:%.2f Count X: 2.00Y:3.00Z:4.00\nok\nok\n' % (random.uniform(0,200), random.uniform(0,200), random.uniform(0,200), random.uniform(0,200))),   # position request
-            'N?[0-9]*G.*': lambda : delayed_string(b'ok\n'),
-            'N?[0-9]*M400.*': lambda : delayed_string(b'ok\nok\n'),
-            'N?[0-9]*M207.*': lambda : delayed_string(b'ok\nok\n'),
-            'N?[0-9]*M208.*': lambda : delayed_string(b'ok\nok\n'),
-            'N?[0-9]*M10[0-46-9].*': lambda : delayed_string(b'ok\nok\n'),
-            "N?[0-9]*(M[0-9]+).*" : lambda : delayed_string(b'ok\nok\n'), # catch all M codes
-            '^XXX': b'!!\n',
-            })
+
+    if firmware == "marlin":
+        # simulated firmware: planner, move times, heaters
+        printer._serial = dummyserial.Serial(port=printer._serial_port,
+            baudrate=printer._baud_rate,
+            ds_latency=latency,
+            ds_seed=options.dummy_seed,
+            ds_clock=options.dummy_clock,
+            ds_firmware=dummyserial.MarlinSimulator())
+    else:
+        printer._serial = dummyserial.Serial(port=printer._serial_port,
+            baudrate=printer._baud_rate,
+            ds_latency=latency,
+            ds_seed=options.dummy_seed,
+            ds_clock=options.dummy_clock,
+            ds_responses={
+                'M105': lambda : b'ok T:%.2f /190.0 B:%.2f /24.0 @:0 B@:0\n' % (random.uniform(170,195),random.uniform(20,35)),
+                'M115': b'FIRMWARE_NAME:DUMMY\nok\n',
+                'M114': lambda : b'X:%.2fY:%.2fZ:%.2fE:%.2f Count X: 2.00Y:3.00Z:4.00\nok\n' % (random.uniform(0,200), random.uniform(0,200), random.uniform(0,200), random.uniform(0,200)),   # position request
+                'G': b'ok\n',
+                'M': b'ok\n', # catch all M codes
+                '^XXX': b'!!\n',
+                })
     if not printer._serial.is_open:
         printer._serial.open()
+    printer.commands_sent = 1 # fresh firmware, like async_connect()
+    printer.sent_lines.clear()
     printer.set_log_level(logging.ERROR)
     printer.connection_state = ConnectionState.connected
+    printer.start_transport()
 
     
 #
 # set the serial port of the printer and connect.
 # return the port name if successful, otherwise "error" as the port
 #
+@rpc_methods.printer_method("send-gcode", params=(1, 3), types=(str,))
 async def json_handle_gcode(printer, *args):  
-    for i in args:
-        logger.debug("{}".format(i))
-        logger.debug("json_handle_gcode::start::{}".format(i))
+    logger.debug("json_handle_gcode::start::%s", args)
 
     gcode = args[0]
     parse_results = False
-    if len(args) == 2:
+    priority = PRIORITY_NORMAL
+    if len(args) > 1:
         parse_results = args[1]
+    if len(args) > 2:
+        priority = int(args[2])
 
+    result = []
     try:
-        result = await printer.send_command(gcode, parse_results)
+        result = await printer.send_command(gcode, parse_results, priority)
     except Exception as e:
         logger.error("json_handle_gcode::error (see serial logs)::{err}".format(err=e))
         
@@ -205,10 +433,50 @@ async def json_handle_gcode(printer, *args):
     return result
 
 
+#
+# send many lines of gcode in one request: params are a list of gcode lines,
+# optionally whether to parse results and whether to only return a summary.
+# return a list of results (one per line), or if summary is true, one dict
+# with the number of lines sent and only the results that were errors
+#
+@rpc_methods.printer_method("send-gcode-batch", params=(1, 3), types=((list, str),))
+async def json_handle_gcode_batch(printer, *args):
+    gcode = args[0]
+    if not isinstance(gcode, list):
+        gcode = str(gcode).splitlines()
+    parse_results = False
+    summary = False
+    if len(args) > 1:
+        parse_results = args[1]
+    if len(args) > 2:
+        summary = args[2]
+
+    results = []
+    try:
+        results = await printer.send_commands(gcode, parse_results)
+    except Exception as e:
+        logger.error("json_handle_gcode_batch::error (see serial logs)::{err}".format(err=e))
+        results = [["ERROR: {}".format(e)]]
+
+    if not summary:
+        return results
+
+    errors = []
+    for i, result in enumerate(results):
+        if is_error_result(result):
+            errors.append({'line': i, 'gcode': gcode[i] if i < len(gcode) else None, 'result': result})
+    return [{
+        'time': time.time() * 1000,
+        'sent': len(gcode),
+        'errors': errors
+        }]
+
+
 #
 # set line number
 # return the line number if successful, otherwise -1
 #
+@rpc_methods.printer_method("set-line", params=(1, 1), types=((int, str),))
 async def json_handle_line_number(printer, *args):
     printer.commands_sent = int(args[0])
     response = [printer.commands_sent]
@@ -219,6 +487,7 @@ async def json_handle_line_number(printer, *args):
 # set logging level for GCODE (default is INFO) see https://docs.python.org/3/library/logging.html#logging-levels
 # return the line number if successful, otherwise -1
 #
+@rpc_methods.printer_method("set-gcode-loglevel", params=(1, 1), types=((int, str),))
 async def json_handle_set_gcode_loglevel(printer, *args):
     lvl = int(args[0])
     try:
@@ -231,10 +500,30 @@ async def json_handle_set_gcode_loglevel(printer, *args):
 
     return [lvl]
 
+#
+# set how gcode is sent to the printer: "ping-pong" (one line at a time) or
+# "window" (several lines in flight), with an optional window size
+# return the mode and window size
+#
+@rpc_methods.printer_method("set-flow-mode", params=(1, 2), types=(str, (int, str)))
+async def json_handle_set_flow_mode(printer, *args):
+    mode = args[0]
+    window_size = None
+    if len(args) > 1:
+        window_size = int(args[1])
+    try:
+        printer.set_flow_mode(mode, window_size)
+    except ValueError as e:
+        logger.error("json_handle_set_flow_mode::error::{err}".format(err=e))
+        return ["ERROR: {}".format(e)]
+
+    return [{'mode': printer.flow_mode, 'window': printer.window_size}]
+
 #
 # set the serial port of the printer and connect.
 # return the port name if successful, otherwise "error" as the port
 #
+@rpc_methods.printer_method("set-serial-port", params=(2, 2), types=(str, (int, str)))
 async def json_handle_set_serial_port(printer:SerialDevice, *args):  
     response = ""
     received = ""  
@@ -255,10 +544,11 @@ async def json_handle_set_serial_port(printer:SerialDevice, *args):
 
     if port.lower().startswith("dummy"):
         logger.debug("[SERVER] setting dummy serial port: {}".format(port))
-        use_dummy_serial_port(printer)
+        # "dummy:marlin" or "dummy:canned" overrides --dummy_firmware
+        firmware = port.split(":")[1].lower() if ":" in port else None
+        use_dummy_serial_port(printer, firmware)
+        await printer.negotiate()
     else:
-        # TODO: check if printer serial ports are different!!
-       
         printer._serial_port = port
         printer._baud_rate = baud_rate
 
@@ -284,10 +574,14 @@ async def json_handle_set_serial_port(printer:SerialDevice, *args):
 # Disconnect current serial port
 # return the connection state name (closed, open, etc.)
 #
+@rpc_methods.printer_method("close-serial-port", params=(0, 0))
 async def json_handle_close_serial(printer, *args):  
     response = ""
+    if printer.job is not None:
+        printer.job.cancel()
     if printer._serial is not None and printer._serial.is_open:
         if printer._serial_port == "/dev/null":
+            printer.stop_transport()
             printer._serial.close()
             printer.connection_state = ConnectionState.closed
             response = printer.connection_state.name
@@ -304,7 +598,8 @@ async def json_handle_close_serial(printer, *args):
 #
 # Handle request for serial ports from front end
 #
-async def json_handle_portslist():
+@rpc_methods.server_method("get-serial-ports", params=(0, 0), concurrent=True)
+async def json_handle_portslist(printers:PrinterRegistry):
     result = []
     try:
         ports = await list_ports()
@@ -323,6 +618,7 @@ async def json_handle_portslist():
 #
 # return the name of the serial port and connection state
 #
+@rpc_methods.printer_method("get-printer-state", params=(0, 0), concurrent=True)
 async def json_handle_printer_state(printer):
     
     response = []
@@ -336,56 +632,281 @@ async def json_handle_printer_state(printer):
         'time': time.time() * 1000,
         'port': serial_port_name,
         'baud': str(printer._baud_rate),
-        'state': connectionState.name
+        'state': connectionState.name,
+        'queued': printer.command_queue.depth()
         })
     return response
 
+#
+# return the printer's counters: lines sent, oks, resends, queue depth...
+# and the event loop lag.  Optional first param: reset the lag stats after
+# reading them.
+#
+@rpc_methods.printer_method("get-metrics", params=(0, 1), concurrent=True)
+async def json_handle_metrics(printer, *args):
+    metrics = printer.metrics()
+    metrics['time'] = time.time() * 1000
+    firmware = getattr(printer._serial, 'firmware', None)
+    if firmware is not None:
+        metrics['simulator'] = firmware.metrics() # dummy port's simulated firmware
+    metrics['loop_lag'] = loop_monitor.stats()
+    if len(args) > 0 and args[0]:
+        loop_monitor.reset()
+    return [metrics]
+
+#
+# how many times each JSON-RPC method was called, and how long the calls
+# took (in ms).  Optional first param: reset the counters after reading them.
+#
+@rpc_methods.server_method("get-method-stats", params=(0, 1), concurrent=True)
+async def json_handle_method_stats(printers:PrinterRegistry, *args):
+    stats = rpc_methods.stats()
+    if len(args) > 0 and args[0]:
+        rpc_methods.reset_stats()
+    return [stats]
+
+
+#
+# the printer's temperature and position history: time series (times in ms)
+# of hotend, hotend_target, bed, bed_target and x, y, z, e.  Optional first
+# param: only samples after this time (ms), to fetch just what's new (null
+# for all of them).
+#
+@rpc_methods.printer_method("get-telemetry", params=(0, 1), types=((int, float, type(None)),), concurrent=True)
+async def json_handle_get_telemetry(printer, *args):
+    since = args[0] if len(args) > 0 else None
+    return [printer.telemetry.history(since)]
+
+#
+# how often to gather telemetry: s between temperatures (0 to stop), and
+# optionally between positions (null to leave it).  Returns the new settings.
+#
+@rpc_methods.printer_method("set-telemetry", params=(1, 2), types=((int, float), (int, float, type(None))))
+async def json_handle_set_telemetry(printer, *args):
+    telemetry = printer.telemetry
+    if telemetry.mode == 'autoreport' and printer.connection_state is ConnectionState.connected:
+        await printer.send_command("M155 S0") # back to quiet
+    telemetry.stop()
+    telemetry.interval = float(args[0])
+    if len(args) > 1 and args[1] is not None:
+        telemetry.position_interval = float(args[1])
+    if printer.connection_state is ConnectionState.connected:
+        telemetry.start()
+    return [{'interval': telemetry.interval, 'position_interval': telemetry.position_interval}]
+
+#
+# what the printer's firmware can do, from its M115 reply when it connected:
+# firmware fields, Cap: flags, command buffer and planner sizes (if it sends
+# ADVANCED_OK oks) and how emergency commands are sent.  Optional param:
+# true to ask the printer again.
+#
+@rpc_methods.printer_method("get-capabilities", params=(0, 1), types=((bool, type(None)),))
+async def json_handle_get_capabilities(printer, *args):
+    if len(args) > 0 and args[0]:
+        if printer.connection_state is not ConnectionState.connected:
+            return ["ERROR: Serial port not open"]
+        await printer.negotiate()
+    return [printer.capabilities.toDict()]
+
+#
+# full path of an uploaded GCODE file, by name.  Names are plain file names
+# (no folders), so only files in the jobs folder can be printed.
+#
+JOB_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_\-][A-Za-z0-9_.\-]{0,127}$")
+
+def job_path(name:str, must_exist:bool=True):
+    if not JOB_NAME_PATTERN.match(str(name)) or str(name).endswith(".part"):
+        raise ValueError("Bad job file name: {}".format(repr(name)))
+    path = os.path.join(options.jobs_path, name)
+    if must_exist and not os.path.isfile(path):
+        raise ValueError("No such job file: {}".format(repr(name)))
+    return path
+
+#
+# the uploaded GCODE files: name, size and time uploaded
+#
+@rpc_methods.server_method("list-jobs", params=(0, 0), concurrent=True)
+async def json_handle_list_jobs(printers:PrinterRegistry):
+    response = []
+    if os.path.isdir(options.jobs_path):
+        for entry in sorted(os.scandir(options.jobs_path), key=lambda entry: entry.name):
+            if entry.is_file() and JOB_NAME_PATTERN.match(entry.name) and not entry.name.endswith(".part"):
+                stat = entry.stat()
+                response.append({'file': entry.name, 'bytes': stat.st_size, 'time': stat.st_mtime * 1000})
+    return response
+
+#
+# start printing an uploaded file from the server.  Params: file name.
+# Returns the job's progress (see get-job).
+#
+@rpc_methods.printer_method("start-job", params=(1, 1), types=(str,))
+async def json_handle_start_job(printer, *args):
+    if printer.job is not None and printer.job.active:
+        return ["ERROR: Already printing {}".format(printer.job.progress()['file'])]
+    if printer.connection_state is not ConnectionState.connected:
+        return ["ERROR: Serial port not open"]
+    try:
+        printer.job = JobSpooler(printer, job_path(args[0]))
+    except (IndexError, ValueError, OSError) as e:
+        logger.error("start-job failed: {}".format(repr(e)))
+        return ["ERROR: {}".format(e)]
+    printer.job.start()
+    return [printer.job.progress()]
+
+#
+# the current (or last) job's state and progress: file, state (printing,
+# paused, done, cancelled or failed), bytes and lines sent, time taken
+#
+@rpc_methods.printer_method("get-job", params=(0, 0), concurrent=True)
+async def json_handle_get_job(printer, *args):
+    if printer.job is None:
+        return [None]
+    return [printer.job.progress()]
+
+#
+# pause, resume or cancel the job.  Pausing stops after the lines already
+# on their way to the printer.
+#
+async def json_handle_job_control(printer, action:str):
+    if printer.job is None or not printer.job.active:
+        return ["ERROR: No job printing"]
+    getattr(printer.job, action)()
+    return [printer.job.progress()]
+
+@rpc_methods.printer_method("pause-job", params=(0, 0))
+async def json_handle_pause_job(printer):
+    return await json_handle_job_control(printer, "pause")
+
+@rpc_methods.printer_method("resume-job", params=(0, 0))
+async def json_handle_resume_job(printer):
+    return await json_handle_job_control(printer, "resume")
+
+@rpc_methods.printer_method("cancel-job", params=(0, 0))
+async def json_handle_cancel_job(printer):
+    return await json_handle_job_control(printer, "cancel")
+
+#
+# the printers this server drives: id, port and state of each
+#
+@rpc_methods.server_method("list-printers", params=(0, 0), concurrent=True)
+async def json_handle_list_printers(printers:PrinterRegistry):
+    response = []
+    for (printer_id, printer) in printers.items():
+        state = (await call_printer(printer, "get-printer-state", []))[0]
+        state['id'] = printer_id
+        response.append(state)
+    return response
+
+#
+# add a printer (not connected yet), returns its id
+#
+@rpc_methods.server_method("add-printer", params=(1, 1), types=(str,))
+async def json_handle_add_printer(printers:PrinterRegistry, *args):
+    try:
+        printers.add(str(args[0]))
+    except (IndexError, ValueError) as e:
+        logger.error("add-printer failed: {}".format(repr(e)))
+        return ["ERROR: {}".format(e)]
+    return [args[0]]
+
+#
+# disconnect and remove a printer, returns its id
+#
+@rpc_methods.server_method("remove-printer", params=(1, 1), types=(str,))
+async def json_handle_remove_printer(printers:PrinterRegistry, *args):
+    try:
+        await printers.remove(str(args[0]))
+    except (IndexError, ValueError, UnknownPrinter) as e:
+        logger.error("remove-printer failed: {}".format(repr(e)))
+        return ["ERROR: {}".format(e)]
+    return [args[0]]
+
+
+#
+# run a JSON-RPC method for a printer, here or in its worker process
+#
+async def call_printer(printer, method:str, params:list):
+    if isinstance(printer, WorkerPrinter):
+        return await printer.call(method, params)
+    return await rpc_methods.get(method).handler(printer, *params)
+
+#
+# handler that runs a method in a printer's worker process
+#
+def worker_handler(method:str):
+    async def call(printer:WorkerPrinter, *params):
+        return await printer.call(method, list(params))
+    return call
+
+
+#
+# settings for each printer: log file rotation follows tornado's own logging
+# options
+#
+def printer_settings():
+    settings = dict(compress_logs=options.compress_logs, log_max_bytes=options.log_file_max_size,
+        telemetry_interval=options.telemetry_interval, coalesce_writes=options.coalesce_writes,
+        capabilities_cache=options.firmware_cache or None, auto_tune=options.auto_tune)
+    if options.log_rotate_mode == 'time':
+        settings['log_rotate_when'] = options.log_rotate_when
+    return settings
+
 
 def main():
     settings = dict(cookie_secret="__TODO:_GENERATE_YOUR_OWN_RANDOM_VALUE_HERE__",
             template_path=os.path.join(os.path.dirname(__file__), "templates"),
             static_path=os.path.join(os.path.dirname(__file__), "static"),
-            logs_path=os.path.join(os.path.dirname(__file__), "logs"),
             xsrf_cookies=False,)
     
-    printer = SerialDevice(logpath=settings['logs_path'])
+    tornado.options.parse_command_line()
+    settings['logs_path'] = options.logs_path
+    start_server_log()
+    use_encoder(options.json_encoder)
 
-    serial_port_func = functools.partial(json_handle_set_serial_port, printer)
+    printers = PrinterRegistry(printer_factory=WorkerPrinter if options.workers else SerialDevice,
+        logpath=settings['logs_path'], **printer_settings())
+    printer = printers.add() # the default printer
+    for printer_id in options.printers:
+        printers.add(printer_id)
 
     #----------------------------------------
     # THIS DEFINES THE JSON-RPC API:
+    #
+    # Methods go to the default printer, or to printer <id> when called via
+    # /printers/<id>/jsonrpc (or /printers/<id>/json), or with named params
+    # {"printer": <id>, "args": [...]}.
     #----------------------------------------
-    async def r_creator(request):
-        params = request.params
-        logger.debug("JSONRPC request: {}".format(request))
-
-        if request.method == "set-serial-port":
-            result = await serial_port_func(*params)
-            return result
-        elif request.method == "get-serial-ports":
-            result = await json_handle_portslist()
-            return result
-        elif request.method == "send-gcode":
-            result = await json_handle_gcode(printer, *params)
-            return result
-        elif request.method == "get-printer-state":
-            result = await json_handle_printer_state(printer)
-            return result
-        elif request.method == "close-serial-port":
-            result = await json_handle_close_serial(printer)
-            return result
-        elif request.method == "set-line":
-            result = await json_handle_line_number(printer, *params)
-            return result
-        elif request.method == "set-gcode-loglevel":
-            result = await json_handle_set_gcode_loglevel(printer, *params)
-            return result
+    async def r_creator(request, printer_id=None):
+        try:
+            params = request.params
+        except AttributeError:
+            params = [] # none given
+        logger.debug("JSONRPC request: %s", request)
 
-        else:
-            logger.error("Method not found: request.method")
-            # raise MethodNotFound("{}".format(request.method))
-            request.params = ["ERROR: Method not found"]
-            return request
+        if isinstance(params, dict):
+            printer_id = params.get('printer', printer_id)
+            params = params.get('args', [])
+
+        method = rpc_methods.get(request.method) # or MethodNotFound
+
+        if method.scope == 'server':
+            return await rpc_methods.call(method, printers, params)
+
+        try:
+            printer = printers.get(printer_id)
+        except UnknownPrinter as e:
+            logger.error("{}: {}".format(request.method, e))
+            return ["ERROR: {}".format(e)]
+
+        if method.name == "set-serial-port" and len(params) > 0:
+            # only one printer per port
+            other_printer = printers.port_user(params[0], printer)
+            if other_printer is not None:
+                logger.error("serial port {} is already used by printer {}".format(params[0], other_printer))
+                return ["ERROR: serial port {} is already used by printer {}".format(params[0], other_printer)]
+
+        handler = worker_handler(method.name) if isinstance(printer, WorkerPrinter) else None
+        return await rpc_methods.call(method, printer, params, handler)
 
     handlers = [(r"/", MainHandler),
         (r"/data", PostTestHandler),        
@@ -393,15 +914,19 @@ def main():
         (r"/jsontest", JsonTestHandler),
         (r"/jsonqtest", JsonQueueTestHandler),
         # (r"/jsonrpc", JSONHandler),
-        (r"/jsonrpc", JSONRPCHandler, dict(response_creator=r_creator)),]
+        (r"/jsonrpc", PrinterJSONRPCHandler, dict(response_creator=r_creator)),
+        (r"/json", PrinterSocketHandler, dict(printers=printers, response_creator=r_creator)),
+        (r"/printers/([A-Za-z0-9_\-]+)/jsonrpc", PrinterJSONRPCHandler, dict(response_creator=r_creator)),
+        (r"/printers/([A-Za-z0-9_\-]+)/json", PrinterSocketHandler, dict(printers=printers, response_creator=r_creator)),
+        (r"/jobs/([^/]+)", JobUploadHandler),]
     
     application = tornado.web.Application(handlers=handlers, debug=True, **settings)
     
     http_server = tornado.httpserver.HTTPServer(application)
 
-    tornado.options.parse_command_line()
     logger.debug(settings['logs_path'])
     loop = tornado.ioloop.IOLoop.current()
+    loop.add_callback(loop_monitor.start)
 
     http_server.listen(options.port)
 
@@ -0,0 +1,57 @@
+#
+# Measures event loop lag: how late a short sleep wakes up is how long
+# something else was blocking the loop.  Anything that blocks (serial
+# writes, file I/O, slow handlers) shows up here.
+#
+# See main license for details.
+#
+import asyncio
+import time
+from collections import deque
+
+
+class LoopLagMonitor():
+    def __init__(self, interval:float=0.01, samples:int=2000):
+        self.interval = interval # in s
+        self._lags = deque(maxlen=samples) # most recent lags, in s
+        self.max_lag = 0
+        self._task = None
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def reset(self):
+        self._lags.clear()
+        self.max_lag = 0
+
+    async def _run(self):
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = max(0, time.monotonic() - before - self.interval)
+            self._lags.append(lag)
+            if lag > self.max_lag:
+                self.max_lag = lag
+
+    #
+    # lag stats (in ms) since the last reset, over the most recent samples
+    #
+    def stats(self):
+        lags = sorted(self._lags)
+        if not lags:
+            return {'samples': 0, 'mean': 0, 'p50': 0, 'p99': 0, 'max': 0}
+        def percentile(p):
+            return lags[min(len(lags) - 1, int(p * len(lags)))] * 1000
+        return {
+            'samples': len(lags),
+            'mean': sum(lags) / len(lags) * 1000,
+            'p50': percentile(0.5),
+            'p99': percentile(0.99),
+            'max': self.max_lag * 1000,
+            }
@@ -0,0 +1,283 @@
+#
+# Marlin response parsing: turns a line received from the printer into a
+# typed response object in one pass.  Dispatches on the first character of
+# the line so only the patterns that can possibly match are tried, and all
+# patterns are compiled once, here.
+#
+# Based on the front end's js/parsers/MarlinParsers.js
+#
+# See main license for details.
+#
+import re
+
+# ok T:293.0 /0.0 B:25.9 /0.0 @:0 B@:0
+# T:176.1 E:0 W:?
+# ok T:293.0 /0.0 (0.0) B:25.9 /0.0 T0:293.0 /0.0 (0.0) T1:100.0 /0.0 (0.0) @:0 B@:0 @0:0 @1:0
+TEMPERATURE_PATTERN = re.compile(r"(?<![\w@])(T\d*|B|C): ?(-?[\d\.]+) ?(?:\/ ?(-?[\d\.]+))?")
+HOTEND_PATTERN = re.compile(r"T\d*: ?(-?[\d\.]+) ?(?:\/ ?(-?[\d\.]+))?")
+BED_PATTERN = re.compile(r"B: ?(-?[\d\.]+) ?(?:\/ ?(-?[\d\.]+))?")
+# a temperature report starts with a heater (Begin file list, TMC ... don't)
+TEMPERATURE_START_PATTERN = re.compile(r"(?:T\d*|B):")
+# X:0.00 Y:0.00 Z:0.00 E:0.00 Count X:0 Y:0 Z:0
+POSITION_PATTERN = re.compile(r"([XYZE]): ?(-?[\d\.]+)")
+NUMBER_PATTERN = re.compile(r"(\d+)")
+# ok N12 P15 B3 (ADVANCED_OK: last line number, free planner blocks, free command slots)
+ADVANCED_OK_PATTERN = re.compile(r"ok\s+N(-?\d+)\s+P(\d+)\s+B(\d+)")
+# FIRMWARE_NAME:Marlin 2.0.9.3 (Github) SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin PROTOCOL_VERSION:1.0 ...
+FIRMWARE_FIELD_PATTERN = re.compile(r"([A-Z_]+):(.*?)(?=\s+[A-Z_]+:|$)")
+
+#
+# Response types.  Only the line is stored when parsing, the details are
+# worked out when asked for, since most lines are only ever checked for
+# their type.
+#
+class MarlinResponse():
+    __slots__ = ('line',)
+    type = 'info'
+
+    def __init__(self, line:str):
+        self.line = line
+
+    def properties(self):
+        return {'message': self.line}
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, self.line)
+
+
+class OkResponse(MarlinResponse):
+    __slots__ = ()
+    type = 'ok'
+
+    #
+    # (line number, free planner blocks, free command slots) from an
+    # ADVANCED_OK ok, None for a plain one
+    #
+    @property
+    def buffer_space(self):
+        if len(self.line) < 4:
+            return None
+        matches = ADVANCED_OK_PATTERN.match(self.line)
+        if matches is None:
+            return None
+        return (int(matches.group(1)), int(matches.group(2)), int(matches.group(3)))
+
+
+class ResendRequest(MarlinResponse):
+    __slots__ = ()
+    type = 'resend'
+
+    # line the firmware wants next
+    @property
+    def line_number(self):
+        matches = NUMBER_PATTERN.search(self.line)
+        return int(matches.group(1)) if matches else None
+
+    def properties(self):
+        return {'message': self.line, 'line': self.line_number}
+
+
+class TemperatureReport(MarlinResponse):
+    __slots__ = ('ok',)
+    type = 'temperature'
+
+    def __init__(self, line:str, ok:bool=False):
+        self.line = line
+        self.ok = ok # also acknowledges a command (M105)
+
+    #
+    # all heaters: name -> (current, target), as strings from the firmware
+    #
+    @property
+    def temperatures(self):
+        temperatures = {}
+        for heater, current, target in TEMPERATURE_PATTERN.findall(self.line):
+            if heater not in temperatures:
+                temperatures[heater] = (current, target)
+        return temperatures
+
+    #
+    # same fields as the old inline parsing, for the front end
+    #
+    def properties(self):
+        props = dict()
+        ### NOTE: hot end (tool number) is the first match
+        match = HOTEND_PATTERN.search(self.line)
+        if match is not None:
+            props["hotend"] = match.group(1)
+            if match.group(2):
+                props["hotend_target"] = match.group(2)
+        match = BED_PATTERN.search(self.line)
+        if match is not None:
+            props["bed"] = match.group(1)
+            props["bed_target"] = match.group(2) or ''
+        return props
+
+
+class PositionReport(MarlinResponse):
+    __slots__ = ()
+    type = 'position'
+
+    @property
+    def position(self):
+        # after "Count" are stepper counts, not positions
+        return dict((axis.lower(), value) for (axis, value) in POSITION_PATTERN.findall(self.line.split("Count")[0]))
+
+    def properties(self):
+        return self.position
+
+
+class EchoMessage(MarlinResponse):
+    __slots__ = ()
+    type = 'echo'
+
+    @property
+    def message(self):
+        return self.line[5:].strip()
+
+    def properties(self):
+        return {'message': self.message}
+
+
+class ErrorMessage(MarlinResponse):
+    __slots__ = ()
+    type = 'error'
+
+    # line number/checksum errors are always followed by a resend
+    @property
+    def line_error(self):
+        lowerline = self.line.lower()
+        return 'line number' in lowerline or 'checksum' in lowerline
+
+
+class BusyMessage(MarlinResponse):
+    __slots__ = ()
+    type = 'busy'
+
+
+# M115 reply: FIRMWARE_NAME:Marlin 2.0.9.3 SOURCE_CODE_URL:... PROTOCOL_VERSION:1.0
+class FirmwareInfo(MarlinResponse):
+    __slots__ = ()
+    type = 'firmware'
+
+    @property
+    def fields(self):
+        return dict((name, value.strip()) for (name, value) in FIRMWARE_FIELD_PATTERN.findall(self.line))
+
+    def properties(self):
+        return self.fields
+
+
+# M115 reply: Cap:AUTOREPORT_TEMP:1
+class CapabilityReport(MarlinResponse):
+    __slots__ = ()
+    type = 'capability'
+
+    @property
+    def name(self):
+        return self.line.split(':')[1].strip()
+
+    @property
+    def enabled(self):
+        return self.line.rsplit(':', 1)[-1].strip() == '1'
+
+    def properties(self):
+        return {'name': self.name, 'enabled': self.enabled}
+
+
+# responses are never changed once parsed, so plain oks can all share one
+OK = OkResponse("ok")
+
+def _parse_ok(line:str):
+    # "ok" itself never gets here, and "okay..." isn't one
+    if line[:3] != "ok ":
+        return None
+    if "T:" in line or "B:" in line:
+        return TemperatureReport(line, ok=True)
+    return OkResponse(line)
+
+def _parse_temperature(line:str):
+    if TEMPERATURE_START_PATTERN.match(line) is None:
+        return None
+    return TemperatureReport(line)
+
+def _parse_resend(line:str):
+    # Resend: 12, resend: 12 or rs 12
+    if line[:6].lower() == 'resend' or line[:2] == 'rs':
+        return ResendRequest(line)
+    return None
+
+def _parse_echo_or_error(line:str):
+    if line.startswith("echo:"):
+        return EchoMessage(line)
+    if line[:5].lower() == "error":
+        return ErrorMessage(line)
+    return None
+
+def _parse_busy(line:str):
+    if line.startswith("busy:"):
+        return BusyMessage(line)
+    return None
+
+def _parse_firmware(line:str):
+    if line.startswith("FIRMWARE_NAME:"):
+        return FirmwareInfo(line)
+    return None
+
+def _parse_capability(line:str):
+    if line.startswith("Cap:") and line.count(':') >= 2:
+        return CapabilityReport(line)
+    return None
+
+def _parse_position(line:str):
+    if line[1:2] == ":":
+        return PositionReport(line)
+    return None
+
+def _parse_indented(line:str):
+    line = line.lstrip()
+    if line == "":
+        return MarlinResponse(line)
+    parser = _DISPATCH.get(line[0])
+    if parser is None or parser is _parse_indented:
+        return None
+    return parser(line)
+
+# first character of the line -> parser
+_DISPATCH = {
+    'o': _parse_ok,
+    'T': _parse_temperature,
+    'B': _parse_temperature,
+    'R': _parse_resend,
+    'r': _parse_resend,
+    'e': _parse_echo_or_error,
+    'E': _parse_echo_or_error,
+    'b': _parse_busy,
+    'X': _parse_position,
+    'F': _parse_firmware,
+    'C': _parse_capability,
+    ' ': _parse_indented,
+    '\t': _parse_indented,
+}
+
+#
+# parse one line from the printer
+#
+def parse_line(line:str):
+    line = line.rstrip()
+    if line == "ok":
+        return OK # by far the most common
+    if line == "":
+        return MarlinResponse(line)
+
+    parser = _DISPATCH.get(line[0])
+    if parser is not None:
+        response = parser(line)
+        if response is not None:
+            return response
+
+    # some firmwares mention a resend mid-line
+    lowerline = line.lower()
+    if 'resend' in lowerline:
+        return ResendRequest(line[lowerline.index('resend'):])
+    return MarlinResponse(line)
@@ -0,0 +1,170 @@
+#
+# The JSON-RPC API as a table: each method's handler is registered with a
+# decorator, along with how many params it takes (and what types), whether it
+# runs for the whole server or for one printer, and whether it's safe to run
+# alongside other calls in a batch.  Calls are looked up in a dict, params
+# are checked before the handler runs, and each method's calls are timed.
+#
+# See main license for details.
+#
+import asyncio
+import time
+from tornado_jsonrpc2.exceptions import InvalidParams, MethodNotFound
+
+
+#
+# a param type as JSON-RPC clients know it
+#
+def _type_name(param_type:type):
+    return "null" if param_type is type(None) else param_type.__name__
+
+
+class RPCMethod():
+    __slots__ = ('name', 'handler', 'scope', 'min_params', 'max_params', 'types', 'concurrent',
+        'calls', 'errors', 'total_time', 'max_time')
+
+    def __init__(self, name:str, handler, scope:str, params:tuple, types:tuple, concurrent:bool):
+        self.name = name
+        self.handler = handler
+        self.scope = scope # 'server' or 'printer'
+        self.min_params, self.max_params = params # max None for any number
+        self.types = types # types of the first params, in order
+        self.concurrent = concurrent # only reads state, so batches can run it alongside others
+
+        # timing counters, in s
+        self.calls = 0
+        self.errors = 0
+        self.total_time = 0
+        self.max_time = 0
+
+    def check_params(self, params:list):
+        if not isinstance(params, list):
+            raise InvalidParams("{} takes a list of params".format(self.name))
+        if len(params) < self.min_params or (self.max_params is not None and len(params) > self.max_params):
+            if self.max_params is None:
+                expected = "at least {}".format(self.min_params)
+            elif self.min_params == self.max_params:
+                expected = "{}".format(self.min_params)
+            else:
+                expected = "{} to {}".format(self.min_params, self.max_params)
+            raise InvalidParams("{} takes {} params, got {}".format(self.name, expected, len(params)))
+        for i, (param, param_type) in enumerate(zip(params, self.types)):
+            if param_type is not None and not isinstance(param, param_type):
+                raise InvalidParams("{} param {} should be {}, got {}".format(self.name, i + 1,
+                    " or ".join(_type_name(t) for t in (param_type if isinstance(param_type, tuple) else (param_type,))),
+                    _type_name(type(param))))
+
+    def record(self, elapsed:float, failed:bool):
+        self.calls += 1
+        self.total_time += elapsed
+        if elapsed > self.max_time:
+            self.max_time = elapsed
+        if failed:
+            self.errors += 1
+
+    #
+    # timing counters, in ms
+    #
+    def stats(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'mean': 1000 * self.total_time / self.calls if self.calls else 0,
+            'max': 1000 * self.max_time,
+            'total': 1000 * self.total_time,
+            }
+
+    def reset(self):
+        self.calls = self.errors = 0
+        self.total_time = self.max_time = 0
+
+
+class MethodRegistry():
+    def __init__(self):
+        self._methods = {}
+
+    #
+    # decorator registering a handler: params is (min, max) number of params
+    # (max None for any), types the types of the first params (None for any)
+    #
+    def method(self, name:str, scope:str='printer', params:tuple=(0, None), types:tuple=(), concurrent:bool=False):
+        if scope not in ('server', 'printer'):
+            raise ValueError("Bad method scope: {}".format(repr(scope)))
+        def register(handler):
+            if name in self._methods:
+                raise ValueError("Method already registered: {}".format(name))
+            self._methods[name] = RPCMethod(name, handler, scope, params, types, concurrent)
+            return handler
+        return register
+
+    def server_method(self, name:str, **kwargs):
+        return self.method(name, scope='server', **kwargs)
+
+    def printer_method(self, name:str, **kwargs):
+        return self.method(name, scope='printer', **kwargs)
+
+    def get(self, name:str):
+        try:
+            return self._methods[name]
+        except KeyError:
+            raise MethodNotFound(str(name))
+
+    def __contains__(self, name):
+        return name in self._methods
+
+    def names(self):
+        return list(self._methods.keys())
+
+    #
+    # check the params and run the handler with them, timing it.  context is
+    # what the handler is called with first (the printer, or the printer
+    # registry for server methods).  handler runs it some other way (in a
+    # printer's worker process) instead of the registered one.
+    #
+    async def call(self, method:RPCMethod, context, params:list, handler=None):
+        method.check_params(params)
+        if handler is None:
+            handler = method.handler
+        start = time.perf_counter()
+        failed = True
+        try:
+            result = await handler(context, *params)
+            failed = isinstance(result, list) and len(result) > 0 and isinstance(result[0], str) \
+                and result[0].startswith("ERROR")
+            return result
+        finally:
+            method.record(time.perf_counter() - start, failed)
+
+    def stats(self):
+        return {name: method.stats() for (name, method) in self._methods.items() if method.calls}
+
+    def reset_stats(self):
+        for method in self._methods.values():
+            method.reset()
+
+    #
+    # run a batch of calls with run(call), returning the results in order.
+    # Calls to concurrent methods next to each other run together; any
+    # other call waits for everything before it, and everything after waits
+    # for it, so gcode still goes out in the order it was sent.
+    #
+    async def batch(self, calls:list, run):
+        results = [None] * len(calls)
+        together = []
+
+        async def run_together():
+            if together:
+                done = await asyncio.gather(*[run(calls[i]) for i in together])
+                for i, result in zip(together, done):
+                    results[i] = result
+                together.clear()
+
+        for i, call in enumerate(calls):
+            method = self._methods.get(getattr(call, 'method', None))
+            if method is not None and method.concurrent:
+                together.append(i)
+            else:
+                await run_together()
+                results[i] = await run(call)
+        await run_together()
+        return results
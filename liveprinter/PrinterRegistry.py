@@ -0,0 +1,85 @@
+#
+# All the printers one server drives, by printer id.  Each is its own
+# SerialDevice with its own port, command queue, streaming window and log
+# files, so a slow printer only ever waits on itself.
+#
+# See main license for details.
+#
+import re
+from ConnectionState import ConnectionState
+from SerialDevice import SerialDevice
+
+# ids end up in URLs (/printers/<id>/jsonrpc) and log file names
+PRINTER_ID_PATTERN = re.compile(r"^[A-Za-z0-9_\-]{1,64}$")
+
+
+class UnknownPrinter(KeyError):
+    def __str__(self):
+        return str(self.args[0]) # not KeyError's repr()
+
+
+class PrinterRegistry():
+    DEFAULT_ID = "default" # the printer used when no id is given
+
+    #
+    # printer_factory makes the printers (SerialDevice, or WorkerPrinter to
+    # run each in its own process), printer_settings are passed to it
+    #
+    def __init__(self, printer_factory=SerialDevice, **printer_settings):
+        self.printer_factory = printer_factory
+        self.printer_settings = printer_settings
+        self._printers = {}
+
+    #
+    # create a printer.  The default printer keeps the old (unprefixed) log
+    # names.
+    #
+    def add(self, printer_id:str=DEFAULT_ID):
+        if not PRINTER_ID_PATTERN.match(str(printer_id)):
+            raise ValueError("Bad printer id: {}".format(repr(printer_id)))
+        if printer_id in self._printers:
+            raise ValueError("Printer already exists: {}".format(repr(printer_id)))
+        printer = self.printer_factory(printer_id=None if printer_id == self.DEFAULT_ID else printer_id, **self.printer_settings)
+        self._printers[printer_id] = printer
+        return printer
+
+    def get(self, printer_id:str=None):
+        if printer_id is None:
+            printer_id = self.DEFAULT_ID
+        try:
+            return self._printers[printer_id]
+        except KeyError:
+            raise UnknownPrinter("Unknown printer: {}".format(repr(printer_id)))
+
+    #
+    # disconnect a printer and forget it
+    #
+    async def remove(self, printer_id:str):
+        if printer_id == self.DEFAULT_ID:
+            raise ValueError("The default printer can't be removed")
+        printer = self.get(printer_id)
+        await printer.close()
+        del self._printers[printer_id]
+        return printer
+
+    def ids(self):
+        return list(self._printers.keys())
+
+    def items(self):
+        return list(self._printers.items())
+
+    #
+    # the id of another printer already using this (real) serial port, or None
+    #
+    def port_user(self, port:str, printer:SerialDevice=None):
+        for (printer_id, other) in self._printers.items():
+            if other is not printer and other._serial_port == port and other._serial_port != "/dev/null" \
+                    and other.connection_state == ConnectionState.connected:
+                return printer_id
+        return None
+
+    def __contains__(self, printer_id):
+        return printer_id in self._printers
+
+    def __len__(self):
+        return len(self._printers)
@@ -0,0 +1,237 @@
+#
+# Worker processes: run each printer's SerialDevice in its own process, so
+# a farm of printers can use all cores and a wedged USB port only takes its
+# own process down.
+#
+# The server keeps a WorkerPrinter for each printer and forwards JSON-RPC
+# methods to its worker over a Unix socket pair, one JSON message per line:
+#   server -> worker: {"id": 1, "method": "send-gcode", "params": [...]}
+#                     {"subscribe": true} to get printer responses as events
+#   worker -> server: {"id": 1, "result": [...]}
+#                     {"event": PrinterResponse.toDict()}
+#
+# The worker runs the same method handlers as the server (see
+# LivePrinterServer.rpc_methods) with the server's command line options.
+#
+# See main license for details.
+#
+import asyncio
+import logging
+import os
+import socket
+import subprocess
+import sys
+from ConnectionState import ConnectionState
+from printerreponse import PrinterResponse
+from JSONEncoding import encode_bytes, decode
+
+logger = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.abspath(__file__)
+
+
+#
+# a printer running in a worker process, as seen from the server
+#
+class WorkerPrinter():
+    def __init__(self, printer_id:str=None, **settings):
+        self.printer_id = printer_id
+        self.worker_args = sys.argv[1:] # same options as the server
+        self._process = None
+        self._reader = None
+        self._writer = None
+        self._replies = None # task reading the worker's messages
+        self._waiting = {} # request id -> future
+        self._next_id = 0
+        self._listeners = []
+        self._closing = False
+        self._starting = asyncio.Lock() # calls that come in whilst the worker starts wait for it
+
+        # last known port and state, for PrinterRegistry.port_user
+        self._serial_port = None
+        self.connection_state = ConnectionState.closed
+
+    #
+    # start the worker process if it isn't running
+    #
+    async def start(self):
+        async with self._starting:
+            if self._writer is None:
+                await self._start()
+
+    async def _start(self):
+        server_end, worker_end = socket.socketpair()
+        args = [sys.executable, WORKER_SCRIPT, "--worker_fd={}".format(worker_end.fileno())]
+        if self.printer_id is not None:
+            args.append("--worker_printer_id={}".format(self.printer_id))
+        self._process = subprocess.Popen(args + self.worker_args,
+            cwd=os.path.dirname(WORKER_SCRIPT), pass_fds=[worker_end.fileno()])
+        worker_end.close()
+        self._reader, self._writer = await asyncio.open_unix_connection(sock=server_end)
+        self._replies = asyncio.ensure_future(self._read_messages())
+        if self._listeners:
+            self._send({'subscribe': True})
+        logger.info("started worker {pid} for printer {id}".format(pid=self._process.pid, id=self.printer_id))
+
+    def _send(self, message:dict):
+        self._writer.write(encode_bytes(message) + b"\n")
+
+    #
+    # run a method in the worker, returns its result
+    #
+    async def call(self, method:str, params:list):
+        await self.start()
+        self._next_id += 1
+        request_id = self._next_id
+        future = asyncio.get_event_loop().create_future()
+        self._waiting[request_id] = future
+        self._send({'id': request_id, 'method': method, 'params': params})
+        result = await future
+
+        if method in ("set-serial-port", "close-serial-port"):
+            await self._update_state()
+        return result
+
+    async def _update_state(self):
+        state = (await self.call("get-printer-state", []))[0]
+        self._serial_port = "/dev/null" if state['port'] == "dummy" else state['port']
+        self.connection_state = ConnectionState[state['state']]
+
+    async def _read_messages(self):
+        try:
+            while True:
+                line = await self._reader.readline()
+                if not line:
+                    break
+                message = decode(line)
+                if 'event' in message:
+                    self._notify(message['event'])
+                else:
+                    future = self._waiting.pop(message['id'], None)
+                    if future is not None and not future.done():
+                        future.set_result(message['result'])
+        except Exception as e:
+            logger.error("worker for printer {id} failed: {err}".format(id=self.printer_id, err=repr(e)))
+        finally:
+            self._stopped()
+
+    #
+    # the worker went away: fail whatever was waiting on it, it gets
+    # restarted on the next call
+    #
+    def _stopped(self):
+        if not self._closing:
+            logger.error("worker for printer {id} stopped".format(id=self.printer_id))
+        waiting = self._waiting
+        self._waiting = {}
+        for future in waiting.values():
+            if not future.done():
+                future.set_result(["ERROR: printer worker stopped"])
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+        self.connection_state = ConnectionState.closed
+
+    def _notify(self, event:dict):
+        response = PrinterResponse.fromDict(event)
+        for listener in list(self._listeners):
+            try:
+                listener(response)
+            except Exception as e:
+                logger.error("listener failed: {}".format(repr(e)))
+
+    def add_listener(self, listener):
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+            if len(self._listeners) == 1 and self._writer is not None:
+                self._send({'subscribe': True})
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+            if not self._listeners and self._writer is not None:
+                self._send({'subscribe': False})
+
+    #
+    # disconnect the printer and stop its worker
+    #
+    async def close(self, timeout:float=5):
+        self._closing = True
+        if self._writer is not None:
+            await self.call("close-serial-port", [])
+            self._writer.close()
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                await asyncio.get_event_loop().run_in_executor(None, self._process.wait, timeout)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+            self._process = None
+
+
+#
+# the worker process: serve one printer to the server on the other end of
+# the socket
+#
+async def serve(printer, sock:socket.socket):
+    from LivePrinterServer import rpc_methods
+
+    reader, writer = await asyncio.open_unix_connection(sock=sock)
+
+    def send(message:dict):
+        writer.write(encode_bytes(message) + b"\n")
+
+    def send_event(response:PrinterResponse):
+        send({'event': response.toDict()})
+
+    async def handle(message:dict):
+        try:
+            method = rpc_methods.get(message['method'])
+            result = await rpc_methods.call(method, printer, message.get('params', []))
+        except Exception as e:
+            logger.error("{method} failed: {err}".format(method=message.get('method'), err=repr(e)))
+            result = ["ERROR: {}".format(repr(e))]
+        send({'id': message['id'], 'result': result})
+
+    while True:
+        line = await reader.readline()
+        if not line:
+            break # the server has gone
+        message = decode(line)
+        if 'subscribe' in message:
+            if message['subscribe']:
+                printer.add_listener(send_event)
+            else:
+                printer.remove_listener(send_event)
+        else:
+            # requests run concurrently, like they do in the server
+            asyncio.ensure_future(handle(message))
+
+    await printer.close()
+
+
+def main():
+    import tornado.options
+    from tornado.options import define, options
+    from LivePrinterServer import printer_settings, loop_monitor
+    from JSONEncoding import use_encoder
+    from SerialDevice import SerialDevice
+
+    define("worker_fd", type=int, help="socket to the server (set by the server)")
+    define("worker_printer_id", default=None, help="printer id (set by the server)")
+    tornado.options.parse_command_line()
+    use_encoder(options.json_encoder)
+
+    sock = socket.socket(fileno=options.worker_fd)
+    printer = SerialDevice(printer_id=options.worker_printer_id,
+        logpath=options.logs_path, **printer_settings())
+
+    async def run():
+        loop_monitor.start()
+        await serve(printer, sock)
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
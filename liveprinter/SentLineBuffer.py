@@ -0,0 +1,44 @@
+#
+# Ring buffer of the last few framed lines sent to the printer, keyed by
+# line number, so resend requests can be answered straight away.
+#
+# See main license for details.
+#
+
+class SentLineBuffer():
+    def __init__(self, size:int=64):
+        self.size = size
+        self._numbers = [None] * size
+        self._lines = [None] * size
+
+    def add(self, line_number:int, data:bytes):
+        index = line_number % self.size
+        self._numbers[index] = line_number
+        self._lines[index] = data
+
+    #
+    # framed bytes for a line number, or None if it's not (or no longer) here
+    #
+    def get(self, line_number:int):
+        index = line_number % self.size
+        if self._numbers[index] == line_number:
+            return self._lines[index]
+        return None
+
+    #
+    # all lines from first to last (inclusive), or None if any are missing
+    #
+    def since(self, first:int, last:int):
+        if last - first >= self.size:
+            return None
+        lines = []
+        for line_number in range(first, last + 1):
+            data = self.get(line_number)
+            if data is None:
+                return None
+            lines.append(data)
+        return lines
+
+    def clear(self):
+        self._numbers = [None] * self.size
+        self._lines = [None] * self.size
@@ -12,12 +12,74 @@ import re
 from typing import Union
 import functools
 from ConnectionState import ConnectionState
+from SerialReader import SerialReader
+from SerialWriter import SerialWriter
+from LineBuffer import LineBuffer
+from CommandQueue import CommandQueue, CommandQueueFull, PRIORITY_NORMAL, PRIORITY_HIGH
+from printerreponse import PrinterResponse
+from GCodeFramer import PreparedLine
+from SentLineBuffer import SentLineBuffer
+from MarlinParsers import parse_line, OkResponse, ResendRequest, TemperatureReport, PositionReport, EchoMessage, ErrorMessage, BusyMessage
+from Telemetry import Telemetry
+from FirmwareCapabilities import FirmwareCapabilities, CapabilityCache
 import logging
 import os
+import asyncio
+from AsyncLogging import log_pipeline, file_handler
+from collections import deque
+from itertools import islice
+
+#
+# the line of a send_command result list that reports a failure (Marlin's
+# errors start with Error: or !!), or None
+#
+def error_line(result:list):
+    for line in result:
+        if isinstance(line, str) and line.lower().startswith(('error', 'fatal', 'serial', 'printer halted', '!!')):
+            return line
+    return None
+
+#
+# true if a send_command result list reports a failure
+#
+def is_error_result(result:list):
+    return error_line(result) is not None
+
+
+# Marlin's defaults (BUFSIZE and RX_BUFFER_SIZE), used until the firmware
+# says otherwise
+DEFAULT_WINDOW_SIZE = 4
+DEFAULT_RX_BUFFER_SIZE = 128
+
+# with ADVANCED_OK the RX buffer limits the lines in flight, this is just a
+# backstop
+MAX_IN_FLIGHT = 64
+
+# the one emergency command the firmware doesn't answer, it stops
+EMERGENCY_SHUTDOWN = re.compile(r"^\s*M112(?!\d)", re.IGNORECASE)
+
+# commands that wait for the heaters, printing temperatures until they're done
+# (T:... W:...), which are their replies rather than auto-reports
+HEATER_WAIT_COMMANDS = re.compile(r"^\s*(M109|M190|M191|M116|M303)(?!\d)", re.IGNORECASE)
+
+#
+# a line sent whilst streaming, waiting for its ok
+#
+class StreamedLine():
+    def __init__(self, line_number:int, cmd, data:bytes, parse_results:bool, future):
+        self.line_number = line_number
+        self.cmd = cmd
+        self.data = data # framed bytes as written to the port
+        self.parse_results = parse_results
+        self.future = future
+        self.result = []
+        self.sent_time = time.time()
+
 
 class SerialDevice():
     def __init__(self, **kwdargs):
         logpath = kwdargs['logpath']
+        self.printer_id = kwdargs.get('printer_id', None) # name in a printer farm, None for a lone printer
         self._serial = None
         self._serial_port = None
         self._baud_rate = 250000
@@ -25,31 +87,131 @@ class SerialDevice():
         self.settle_time = 0.005 # used between serial commands to let the firmware "settle"
         self.retry_time = 0.1 # in s, time to wait in between retries
         self.max_retries = 600 # means about 60 seconds of total waiting, helpful for longer bed leveling ops
+        self.connect_timeout = 10 # in s, longest to wait for the firmware to answer after opening the port
+        self.probe_interval = 0.5 # in s, time between M110 probes whilst the firmware says nothing
+        self.connect_time = None # in ms, how long the last connect took to get an answer
         self.connection_state = ConnectionState.closed
         self.commands_sent = 0 # needed for keeping track of them
-        self.busy = False # whether it is processing commands or not
+        self.command_queue = CommandQueue(maxsize=kwdargs.get('max_queued', 256)) # one command on the serial port at a time
         
         self.ok_count = 0 # count ok responses received
 
-        self.gcode_logger = logging.getLogger("{name}.gcode".format(name=__name__))
-        self.serial_logger = logging.getLogger("{name}.serial".format(name=__name__))
+        # "ping-pong" sends one line and waits for its ok, "window" keeps
+        # several lines in flight (character-counting against the firmware's
+        # serial RX buffer) and matches the oks back in order
+        self.flow_mode = kwdargs.get('flow_mode', 'ping-pong')
+        self.window_size = DEFAULT_WINDOW_SIZE # max lines in flight in window mode
+        self.rx_buffer_size = DEFAULT_RX_BUFFER_SIZE # firmware's serial RX buffer, in bytes
+        self._in_flight = deque() # StreamedLine's waiting for an ok
+        self._in_flight_bytes = 0
+        self._window_changed = asyncio.Event()
+        self._dispatcher = None # task matching responses to streamed lines
+        self._oks_to_ignore = 0 # firmware sends an ok after every resend request
+        self._urgent_replies = deque() # futures of emergency commands sent mid-command (ping-pong mode)
+        self._resend_line = None # line we're currently resending from
+        self.sent_lines = SentLineBuffer(kwdargs.get('resend_buffer_size', 64)) # recently sent lines, for resends
+
+        # firmware with ADVANCED_OK says in each ok how many planner blocks
+        # and command slots it has free.  Then the window is exact: lines it
+        # has taken into its command buffer don't count against the RX
+        # buffer.  None until an ok says.
+        self.planner_free = None
+        self.buffer_free = None
+        self._firmware_queued = 0 # in-flight lines in the firmware's command buffer, as of its last ok
+        self._command_buffer_size = 0 # largest seen, if the firmware didn't say in M115
+
+        # counters for get-metrics
+        self.resend_count = 0 # resend requests from the printer
+        self.lines_resent = 0
+        self.line_errors = 0 # line number/checksum errors
+        self.failed_resends = 0 # resend requests for lines we no longer had
+
+        # "threaded" reads the port on a background thread so the event loop
+        # never blocks, "blocking" calls readline() directly (old behaviour)
+        self.transport_mode = kwdargs.get('transport_mode', 'threaded')
+        self._reader = None
+        self._line_buffer = LineBuffer() # blocking transport: lines read but not returned yet in _received
+        self._received = deque()
+
+        # lines written in one pass of the event loop go to the port in one
+        # write (see SerialWriter), unless coalesce_writes is False
+        self.coalesce_writes = kwdargs.get('coalesce_writes', True)
+        self._writer = None
+
+        self._listeners = [] # called with a PrinterResponse for everything received
+        self.job = None # JobSpooler streaming a file to this printer, if any
+
+        # temperature and position history, polled in the background whilst
+        # connected (every telemetry_interval s, 0 for never, the default)
+        self.telemetry = Telemetry(self, interval=kwdargs.get('telemetry_interval', 0),
+            position_interval=kwdargs.get('telemetry_position_interval', 5.0), size=kwdargs.get('telemetry_size', 600))
+
+        # what the firmware can do, asked on connect (see negotiate()).  With
+        # auto_tune the window, telemetry and emergency commands follow it.
+        self.capabilities = FirmwareCapabilities()
+        self.auto_tune = kwdargs.get('auto_tune', True)
+        cache_path = kwdargs.get('capabilities_cache', None)
+        self.capability_cache = CapabilityCache(cache_path) if cache_path else None
+
+        self._last_command = None
+        self.command_queue.on_change = self._queue_changed
+
+        # each printer in a farm logs to its own files
+        log_name = __name__ if self.printer_id is None else "{name}.{id}".format(name=__name__, id=self.printer_id)
+        log_prefix = "" if self.printer_id is None else "{id}-".format(id=self.printer_id)
+        self.gcode_logger = logging.getLogger("{name}.gcode".format(name=log_name))
+        self.serial_logger = logging.getLogger("{name}.serial".format(name=log_name))
         self.gcode_logger.setLevel(logging.INFO)
         self.gcode_logger.propagate = False
         self.serial_logger.setLevel(logging.ERROR)
 
-        # create file handler which logs even debug messages
-        gcode_fh = logging.FileHandler(os.path.join(logpath, "gcode-{time}.log".format(time=time.time())))
-        serial_fh = logging.FileHandler(os.path.join(logpath, "serial-{time}.log".format(time=time.time())))
-        # create formatter and add it to the handlers
-        formatter = logging.Formatter(";%(asctime)s:\n%(message)s")
-        gcode_fh.setFormatter(formatter)
-        formatter = logging.Formatter('%(asctime)s::%(name)s.%(funcName)s[%(lineno)s]: %(message)s')
-        serial_fh.setFormatter(formatter)
+        # create file handlers which log even debug messages.  They're written
+        # on the log pipeline's thread, never on the event loop.  Rotate at
+        # log_max_bytes, or on the log_rotate_when schedule (e.g. 'midnight'),
+        # gcode archives are gzipped if compress_logs
+        rotation = dict(max_bytes=kwdargs.get('log_max_bytes', 20*1024*1024), when=kwdargs.get('log_rotate_when', None))
+        gcode_fh = file_handler(os.path.join(logpath, "gcode-{prefix}{time}.log".format(prefix=log_prefix, time=time.time())), 
+            logging.Formatter(";%(asctime)s:\n%(message)s"), compress=kwdargs.get('compress_logs', False), **rotation)
+        serial_fh = file_handler(os.path.join(logpath, "serial-{prefix}{time}.log".format(prefix=log_prefix, time=time.time())),
+            logging.Formatter('%(asctime)s::%(name)s.%(funcName)s[%(lineno)s]: %(message)s'), **rotation)
        
-        self.gcode_logger.addHandler(gcode_fh)
-        self.serial_logger.addHandler(serial_fh)
+        log_pipeline.attach(self.gcode_logger, gcode_fh)
+        log_pipeline.attach(self.serial_logger, serial_fh)
         self.serial_logger.debug('starting')
+
+    #
+    # disconnect for good and stop logging to this printer's files (when it's
+    # removed from a farm)
+    #
+    async def close(self):
+        if self.job is not None:
+            self.job.cancel()
+        await self.disconnect()
+        log_pipeline.detach(self.gcode_logger)
+        log_pipeline.detach(self.serial_logger)
  
+    #
+    # whether it is processing commands or not
+    #
+    @property
+    def busy(self):
+        return self.command_queue.locked()
+
+    #
+    # choose how lines are sent: "ping-pong" (one at a time) or "window"
+    # (pipelined).  window_size is the max number of lines in flight, unless
+    # the firmware sends ADVANCED_OK oks (then its free space decides).
+    #
+    def set_flow_mode(self, mode:str, window_size:int=None):
+        if mode not in ('ping-pong', 'window'):
+            self.serial_logger.error("Bad flow mode in set_flow_mode: {}".format(repr(mode)))
+            raise ValueError("Bad flow mode in set_flow_mode: {}".format(repr(mode)))
+        self.flow_mode = mode
+        if window_size is not None:
+            if int(window_size) < 1:
+                raise ValueError("Bad window size in set_flow_mode: {}".format(repr(window_size)))
+            self.window_size = int(window_size)
+
     def set_log_level(self, level):
         # self.serial_logger.critical("{debug}/{info}".format(debug=logging.DEBUG, info=logging.INFO))
         debug_level = level
@@ -87,11 +249,13 @@ class SerialDevice():
         self.serial_logger.debug("self port: ::{}::".format(self._serial_port))
 
         self.commands_sent = 1 # reset on each connection
+        self.sent_lines.clear()
         try:
             self._serial = Serial(str(self._serial_port), self._baud_rate, timeout=self._timeout, writeTimeout=self._timeout)
             if self._serial.is_open:
                 self.serial_logger.debug("SERIAL OPEN")
                 self.connection_state = ConnectionState.connected
+                self.start_transport()
                 result.append("open")
             else:
                 self.serial_logger.debug("SERIAL NOT OPEN")
@@ -104,44 +268,148 @@ class SerialDevice():
             self.serial_logger.error("An exception occurred while trying to create serial connection: {}".format(repr(e)))
             #raise
         else:
-            # the printer is quite chatty on startup, but takes a second or so
-            # to reboot when connected
-            newline = ""
-            timeout = 10 # max time to wait in seconds
-            start_time = time.time()
-            got_something = False
-
-            while self.busy:
-                gen.sleep(self.retry_time)
-
-            self.busy = True # async mutex
-            
-            retry_count = 0
-
-            while time.time() - start_time < timeout:
-                new_line = await self.read_response()
-                new_line = str(new_line).rstrip('\n\r')
-                if new_line != "":
-                    result.append(new_line)
-                    got_something = True
-                else:
-                    if retry_count > 3:
-                        if got_something:
-                            result.append('DONE')
-                            break # we're done, already got everything!
-                        else:
-                            retry_count += 1
-                            result.append('WAITING...')
-                            await gen.sleep(self.retry_time)
-                    else:
-                        # just chill for a bit
-                        await gen.sleep(self.retry_time)
-            self.busy = False # async mutex
+            if self.connection_state != ConnectionState.connected:
+                return result
+            await self.command_queue.acquire()
+            try:
+                result.extend(await self._handshake())
+            finally:
+                self.command_queue.release()
             self.serial_logger.debug('connected to printer')
+            await self.negotiate()
         return result
 
+    #
+    # wait for the firmware to answer, instead of sitting out its boot time.
+    # Opening the port resets most boards (they print "start" and a banner
+    # once they're up), others are already running and stay quiet, so: probe
+    # with M110 straight away and every probe_interval, probe again as soon
+    # as a reset shows up ("start": anything sent before it is lost), and
+    # stop at the first ok.  Returns the lines received, then 'DONE', or
+    # 'WAITING...' if nothing answered within connect_timeout.
+    #
+    async def _handshake(self):
+        lines = []
+        start_time = time.time()
+        deadline = start_time + self.connect_timeout
+        probe = self._frame("M110 N0", 0) # next line is N1
+        outstanding = 0 # probes not answered yet
+        next_probe = start_time
+
+        while True:
+            now = time.time()
+            if now >= deadline:
+                lines.append('WAITING...')
+                self.serial_logger.warning("no answer from the firmware after {}s".format(self.connect_timeout))
+                return lines
+            if now >= next_probe:
+                try:
+                    self._writer.write_now(probe)
+                except SerialException as e:
+                    self.serial_logger.error("couldn't probe the firmware: {}".format(repr(e)))
+                    lines.append("ERROR: {}".format(repr(e)))
+                    return lines
+                outstanding += 1
+                next_probe = now + self.probe_interval
+            line = await self._read_line(min(next_probe, deadline) - now)
+            line = line.rstrip('\n\r')
+            if line == "":
+                continue
+            lines.append(line)
+            response = parse_line(line)
+            if self._listeners:
+                self._notify(self.response_event(response))
+            if self._is_ok(response):
+                outstanding -= 1
+                break
+            if line == 'start':
+                # just reset, it's listening now
+                self.serial_logger.debug("firmware reset after {:.3f}s".format(time.time() - start_time))
+                outstanding = 0
+                next_probe = time.time()
+
+        self.connect_time = (time.time() - start_time) * 1000
+        self.serial_logger.debug("firmware answered after {:.1f}ms".format(self.connect_time))
+        # mop up the oks for the other probes still on their way, so they
+        # aren't taken for replies to the first commands
+        while outstanding > 0:
+            line = (await self._read_line(self.probe_interval)).rstrip('\n\r')
+            if line == "":
+                break
+            lines.append(line)
+            if self._is_ok(parse_line(line)):
+                outstanding -= 1
+        lines.append('DONE')
+        return lines
+
+    @staticmethod
+    def _is_ok(response):
+        return isinstance(response, OkResponse) or (isinstance(response, TemperatureReport) and response.ok)
+
+    #
+    # ask the firmware what it can do (M115) and tune to it, then start the
+    # telemetry (which needs to know about auto-reports).  Returns the
+    # capabilities.
+    #
+    async def negotiate(self):
+        try:
+            result = await self.send_command("M115", False, PRIORITY_HIGH)
+        except Exception as e:
+            self.serial_logger.error("M115 failed: {}".format(repr(e)))
+            result = []
+        capabilities = FirmwareCapabilities.fromLines(result)
+        if capabilities.known and self.capability_cache is not None:
+            capabilities.merge(self.capability_cache.get(self._serial_port, capabilities.version))
+            self.capability_cache.save(self._serial_port, capabilities)
+        self.use_capabilities(capabilities)
+        self.telemetry.start()
+        return capabilities
+
+    def use_capabilities(self, capabilities:FirmwareCapabilities):
+        self.capabilities = capabilities
+        if not self.auto_tune:
+            return
+        self.window_size = capabilities.command_buffer_size or DEFAULT_WINDOW_SIZE
+        self.rx_buffer_size = capabilities.rx_buffer_size or DEFAULT_RX_BUFFER_SIZE
+        self.telemetry.autoreport = capabilities.autoreport_temp
+        self.serial_logger.info("firmware {version}: window {window} lines/{rx} bytes, auto-report {autoreport}, emergency commands {estop}".format(
+            version=repr(capabilities.version), window=self.window_size, rx=self.rx_buffer_size,
+            autoreport=capabilities.autoreport_temp, estop=capabilities.estop_strategy))
+
+    #
+    # start reading the serial port in the background (if using the threaded
+    # transport).  Needs to be called from the event loop once the port is open.
+    # Then negotiate() with the firmware, which starts the telemetry.
+    #
+    def start_transport(self):
+        self.stop_transport()
+        self._writer = SerialWriter(self._serial, coalesce=self.coalesce_writes)
+        self._writer.on_error = self._write_failed
+        self._line_buffer.clear()
+        self._received.clear()
+        self._reset_buffer_space()
+        if self.transport_mode == 'threaded':
+            self._reader = SerialReader(self._serial)
+            self._reader.divert = self._divert_report
+            self._reader.start()
+            self.serial_logger.debug("started threaded serial reader")
+
+    def stop_transport(self):
+        self.telemetry.stop()
+        if self._writer is not None:
+            try:
+                self._writer.drain() # anything still waiting to go
+            except Exception as e:
+                self.serial_logger.error("couldn't send the last lines: {}".format(repr(e)))
+            self._writer = None
+        if self._reader is not None:
+            self._reader.stop()
+            self._reader = None
+
     async def disconnect(self):
         if self.connection_state == ConnectionState.connected:
+            self._abort_stream("ERROR: disconnected")
+            self.stop_transport()
             self._serial.close()
             self.connection_state = ConnectionState.closed
         return self.connection_state
@@ -149,19 +417,394 @@ class SerialDevice():
 
     #
     # Send a GCODE command and get result.  If parse_results, try and interpret
-    # the results as a dict()
+    # the results as a dict().  Commands wait their turn in the command queue,
+    # lower priority numbers go first (emergency commands always jump ahead).
     #
-    async def send_command(self, cmd:Union[str,bytes], parse_results:bool=False):
+    async def send_command(self, cmd:Union[str,bytes], parse_results:bool=False, priority:int=PRIORITY_NORMAL):
         result = []
         if self._serial is None:
             result.append("Serial port not open")
             return result
 
-        # spin lock??        
-        while self.busy:
-            await gen.sleep(self.settle_time)
+        if self._is_urgent(cmd) and (self.command_queue.locked() or self._is_shutdown(cmd)):
+            # don't wait behind whatever is running (e.g. M109), the firmware
+            # acts on it as soon as it arrives.  M112 never gets an ok, so it
+            # isn't streamed or waited for in either mode.
+            if self.flow_mode == 'window' and not self._is_shutdown(cmd):
+                streamed = await self._stream_command(cmd, parse_results)
+                if isinstance(streamed, list):
+                    return streamed
+                return await streamed.future
+            return await self._send_urgent(cmd)
+
+        if self.flow_mode == 'window':
+            streamed = await self._queue_streamed(cmd, parse_results, priority)
+            if isinstance(streamed, list):
+                return streamed # error whilst sending
+            return await streamed.future
+
+        try:
+            await self.command_queue.acquire(self.command_queue.priority_for(cmd, priority))
+        except CommandQueueFull as e:
+            self.serial_logger.error("{}".format(e))
+            result.append("ERROR: {}".format(e))
+            return result
+
+        try:
+            # switching back from window mode, let the stream finish first
+            await self.drain()
+            return await self._send_command(cmd, parse_results)
+        finally:
+            self.command_queue.release()
+
+    #
+    # Send a list of GCODE commands in order, returns a list of results (one
+    # per command).  In window mode they're all streamed before waiting for
+    # any oks.  Each line still takes its turn in the command queue, so
+    # emergency commands can get in between.
+    #
+    async def send_commands(self, cmds:list, parse_results:bool=False, priority:int=PRIORITY_NORMAL):
+        if self._serial is None:
+            return [["Serial port not open"] for cmd in cmds]
+
+        if self.flow_mode != 'window':
+            results = []
+            for cmd in cmds:
+                results.append(await self.send_command(cmd, parse_results, priority))
+            return results
+
+        # encode and checksum everything up front, only the line numbers
+        # are left for when each line is sent
+        prepared = [PreparedLine(str(cmd)) for cmd in cmds]
+
+        pending = []
+        for cmd, prepared_line in zip(cmds, prepared):
+            pending.append(await self._queue_streamed(cmd, parse_results, priority, prepared_line))
+
+        results = []
+        for streamed in pending:
+            if isinstance(streamed, list):
+                results.append(streamed) # error whilst sending
+            else:
+                results.append(await streamed.future)
+        return results
+
+    #
+    # window mode: wait for our turn in the command queue, then stream the
+    # line.  Returns the StreamedLine or a result list with an error.
+    #
+    async def _queue_streamed(self, cmd:Union[str,bytes], parse_results:bool, priority:int, prepared:PreparedLine=None):
+        try:
+            await self.command_queue.acquire(self.command_queue.priority_for(cmd, priority))
+        except CommandQueueFull as e:
+            self.serial_logger.error("{}".format(e))
+            return ["ERROR: {}".format(e)]
+
+        try:
+            return await self._stream_command(cmd, parse_results, prepared)
+        finally:
+            # let the next command go as soon as this one is written
+            self.command_queue.release()
+
+    #
+    # frame a command with line number and checksum, ready for the port
+    #
+    def _frame(self, cmd:Union[str,bytes,PreparedLine], line_number:int):
+        if not isinstance(cmd, PreparedLine):
+            cmd = PreparedLine(str(cmd))
+        if self._canned_dummy():
+            return cmd.unframed()
+        return cmd.frame(line_number)
+
+    #
+    # the dummy port with canned replies, which knows nothing about line
+    # numbers.  (The dummy with a simulated firmware behaves like a real
+    # printer.)
+    #
+    def _canned_dummy(self):
+        return self._serial_port == "/dev/null" and getattr(self._serial, 'firmware', None) is None
+
+    #
+    # wait until the streamed lines have all been acknowledged
+    #
+    async def drain(self):
+        while self._in_flight or (self._dispatcher is not None and not self._dispatcher.done()):
+            self._window_changed.clear()
+            await self._window_changed.wait()
+
+    def _window_full(self, size:int):
+        if not self._in_flight:
+            return False # always allow one line through, however long
+        if self.buffer_free is None:
+            # plain counting: every line in flight might still be in the RX buffer
+            return (len(self._in_flight) >= self.window_size or
+                self._in_flight_bytes + size > self.rx_buffer_size)
+        if len(self._in_flight) >= MAX_IN_FLIGHT:
+            return True
+        if self.planner_free == 0:
+            # the firmware can't take anything more out of the RX buffer until
+            # a move finishes, only send what fits in its free command slots.
+            # Lines left waiting in the RX buffer wouldn't be done any sooner,
+            # they'd only hold up whatever comes after them (e.g. M112 on
+            # firmware without an emergency parser).
+            return len(self._in_flight) - min(self._firmware_queued, len(self._in_flight)) >= self.buffer_free
+        # ADVANCED_OK: keep the command buffer (and so the planner) full, and
+        # the RX buffer as full as it'll go
+        return self._rx_bytes() + size > self.rx_buffer_size
+
+    #
+    # bytes of the in-flight lines not yet taken into the firmware's command
+    # buffer (so still in its RX buffer, or on the way).  An overestimate,
+    # the firmware has likely taken more since its last ok.
+    #
+    def _rx_bytes(self):
+        queued = min(self._firmware_queued, len(self._in_flight))
+        return self._in_flight_bytes - sum(len(streamed.data) for streamed in islice(self._in_flight, queued))
+
+    #
+    # note what an ADVANCED_OK ok says is free.  The command it acknowledges
+    # still has its slot, the rest are lines sent after it.
+    #
+    def _record_buffer_space(self, response:OkResponse):
+        space = response.buffer_space
+        if space is None:
+            return
+        (_, self.planner_free, self.buffer_free) = space
+        self._command_buffer_size = max(self._command_buffer_size, self.capabilities.command_buffer_size or 0,
+            self.buffer_free + 1)
+        self._firmware_queued = self._command_buffer_size - self.buffer_free - 1
+
+    def _reset_buffer_space(self):
+        self.planner_free = None
+        self.buffer_free = None
+        self._firmware_queued = 0
+        self._command_buffer_size = 0
+
+    #
+    # window mode: write a line without waiting for its ok.  Returns the
+    # StreamedLine (its future resolves to the usual result list), or a result
+    # list with an error if it couldn't be sent.  Only call whilst holding the
+    # command queue.
+    #
+    async def _stream_command(self, cmd:Union[str,bytes], parse_results:bool=False, prepared:PreparedLine=None):
+        line_number = self.commands_sent
+        cmd_to_send = self._frame(prepared if prepared is not None else cmd, line_number)
+
+        # firmware with an emergency parser acts on these as soon as they
+        # arrive, don't make them wait for room
+        urgent = self._is_urgent(cmd)
+
+        while not urgent and self._window_full(len(cmd_to_send)):
+            self._window_changed.clear()
+            await self._window_changed.wait()
+
+        if line_number != self.commands_sent:
+            # an emergency command went out whilst we waited
+            cmd_to_send = self._frame(prepared if prepared is not None else cmd, self.commands_sent)
+
+        self.gcode_logger.info("%s", cmd)
+        self.serial_logger.debug("streaming:%d::%r", self.commands_sent, cmd_to_send)
+        try:
+            self._writer.write(cmd_to_send) # goes out at the end of this loop pass
+        except SerialException as e:
+            self.serial_logger.error(e)
+            self.serial_logger.error("Serial exception whilst streaming {command}:{current}".format(command=cmd_to_send, current=self.commands_sent))
+            return ["Serial exception whilst sending {command}:{current}".format(command=cmd_to_send, current=self.commands_sent)]
+
+        streamed = StreamedLine(self.commands_sent, cmd, cmd_to_send, parse_results, asyncio.get_event_loop().create_future())
+        self._in_flight.append(streamed)
+        self._in_flight_bytes += len(cmd_to_send)
+        self.sent_lines.add(self.commands_sent, cmd_to_send)
+        self.commands_sent += 1
+
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.ensure_future(self._dispatch_responses())
+        return streamed
+
+    #
+    # an emergency command (M112, M108, M410) the firmware acts on as soon as
+    # it arrives (EMERGENCY_PARSER)
+    #
+    def _is_urgent(self, cmd:Union[str,bytes]):
+        return self.auto_tune and self.capabilities.estop_strategy == 'immediate' and CommandQueue.is_emergency(cmd)
+
+    @staticmethod
+    def _is_shutdown(cmd:Union[str,bytes]):
+        return EMERGENCY_SHUTDOWN.match(cmd.decode('cp437') if isinstance(cmd, bytes) else cmd) is not None
+
+    #
+    # ping-pong mode: send an emergency command whilst another one waits for
+    # its reply.  It goes out without a line number (the running command has
+    # the next one), and the running command hands it the next ok it reads.
+    # M112 (in either mode) never gets one, the firmware stops.
+    #
+    async def _send_urgent(self, cmd:Union[str,bytes]):
+        data = PreparedLine(cmd).unframed()
+        self.gcode_logger.info("%s", cmd)
+        self.serial_logger.debug("sending now:%r", data)
+        try:
+            self._writer.write_now(data)
+            self._writer.drain()
+        except SerialException as e:
+            self.serial_logger.error("Serial exception whilst sending {command}: {error}".format(command=data, error=repr(e)))
+            return ["Serial exception whilst sending {command}".format(command=data)]
+
+        if self._is_shutdown(cmd):
+            return []
+        reply = asyncio.get_event_loop().create_future()
+        self._urgent_replies.append(reply)
+        try:
+            return await asyncio.wait_for(reply, self.max_retries * self.retry_time)
+        except asyncio.TimeoutError:
+            self.serial_logger.error("no reply to {}".format(cmd))
+            return ["ERROR: serial response timeout"]
+        finally:
+            if reply in self._urgent_replies:
+                self._urgent_replies.remove(reply)
+
+    def _finish_streamed(self, result=None):
+        streamed = self._in_flight.popleft()
+        self._in_flight_bytes -= len(streamed.data)
+        if result is not None:
+            streamed.result.append(result)
+        if not streamed.future.done():
+            streamed.future.set_result(streamed.result)
+        self._window_changed.set()
+
+    #
+    # a streamed write failed after the line was handed over
+    #
+    def _write_failed(self, error:Exception):
+        self.serial_logger.error("Serial exception whilst streaming: {}".format(repr(error)))
+        self._abort_stream("ERROR: serial exception whilst streaming: {}".format(repr(error)))
+
+    #
+    # rewrite all lines from the requested line number up to the last one sent,
+    # straight from the sent lines buffer.  Returns the number of lines resent,
+    # or None if they're not all in the buffer anymore.
+    #
+    def _resend_from(self, line_number:int, last_line_number:int):
+        self.resend_count += 1
+        lines = self.sent_lines.since(line_number, last_line_number)
+        if not lines:
+            self.failed_resends += 1
+            self.serial_logger.error("can't resend from line {line}, last sent {last}".format(line=line_number, last=last_line_number))
+            return None
+        # lines not written yet are all in the resend, don't send them twice
+        self._writer.clear()
+        self._firmware_queued = 0 # not sure what it kept, until the next ok
+        for data in lines:
+            self.serial_logger.debug("resending:%r", data)
+            self._writer.write(data)
+        self.lines_resent += len(lines)
+        return len(lines)
+
+    def metrics(self):
+        return {
+            'commands_sent': self.commands_sent,
+            'ok_count': self.ok_count,
+            'resends': self.resend_count,
+            'lines_resent': self.lines_resent,
+            'failed_resends': self.failed_resends,
+            'line_errors': self.line_errors,
+            'queued': self.command_queue.depth(),
+            'in_flight': len(self._in_flight),
+            'in_flight_bytes': self._in_flight_bytes,
+            'advanced_ok': self.buffer_free is not None,
+            'planner_free': self.planner_free,
+            'buffer_free': self.buffer_free,
+            'firmware_queued': min(self._firmware_queued, len(self._in_flight)),
+            'rx_bytes': self._rx_bytes(),
+            'serial_writes': self._writer.writes if self._writer is not None else 0,
+            'lines_written': self._writer.lines_written if self._writer is not None else 0,
+            'connect_time': self.connect_time,
+            }
+
+    #
+    # window mode: read responses and match them to the in-flight lines, in
+    # order.  Runs whilst there's anything in flight.
+    #
+    async def _dispatch_responses(self):
+        stream_timeout = self.max_retries * self.retry_time
+        last_heard = time.time()
+
+        try:
+            while self._in_flight:
+                response = await self.read_parsed_response()
+
+                if response is None:
+                    if time.time() - last_heard > stream_timeout:
+                        self._abort_stream("ERROR: serial response timeout")
+                    continue
+
+                last_heard = time.time()
+                line = response.line
+                head = self._in_flight[0]
+
+                if isinstance(response, ResendRequest):
+                    # every resend request is followed by an ok for the bad line
+                    self._oks_to_ignore += 1
+                    if response.line_number is None:
+                        self.serial_logger.error("Couldn't parse resend: {}".format(line))
+                        continue
+                    if response.line_number == self._resend_line:
+                        # lines already in flight after the bad one get rejected
+                        # too, they're already being resent
+                        continue
+                    self._resend_line = response.line_number
+                    self.serial_logger.error("Printer signals resend: {line} (current line) {current}".format(line=line, current=self.commands_sent))
+                    self._resend_from(response.line_number, self.commands_sent - 1)
+
+                elif self._is_ok(response):
+                    if self._oks_to_ignore > 0:
+                        self._oks_to_ignore -= 1
+                        continue
+                    self._resend_line = None
+                    self.ok_count += 1
+                    if head.parse_results and isinstance(response, TemperatureReport):
+                        self._finish_streamed(response.properties())
+                    else:
+                        self._finish_streamed(line)
+
+                elif isinstance(response, EchoMessage):
+                    head.result.append(response.message if response.message else line)
+
+                elif isinstance(response, ErrorMessage) and response.line_error:
+                    # next line will be a resend
+                    self.line_errors += 1
+                    self.serial_logger.error("Line error: {line} (for {cmd}) {current}".format(line=line, cmd=head.cmd, current=head.line_number))
+
+                elif isinstance(response, BusyMessage):
+                    pass # firmware keepalive
+
+                elif head.parse_results and isinstance(response, TemperatureReport):
+                    head.result.append(response.properties())
+
+                else:
+                    head.result.append(line)
+        except Exception as e:
+            self.serial_logger.error("Fatal error whilst streaming: {}".format(repr(e)))
+            self._abort_stream("ERROR: {}".format(repr(e)))
+        finally:
+            self._window_changed.set()
+
+    #
+    # give up on everything in flight, e.g. on timeout or disconnect
+    #
+    def _abort_stream(self, error:str):
+        if self._in_flight:
+            self.serial_logger.error("{error}: {lines} streamed lines lost".format(error=error, lines=len(self._in_flight)))
+        while self._in_flight:
+            self._finish_streamed(error)
+        self._oks_to_ignore = 0
+        self._resend_line = None
 
-        self.busy = True
+    #
+    # does the actual sending, only call whilst holding the command queue
+    #
+    async def _send_command(self, cmd:Union[str,bytes], parse_results:bool=False):
+        result = []
+        self._last_command = str(cmd)
 
         # all commands have a response, wait for it
         no_response = True
@@ -170,6 +813,8 @@ class SerialDevice():
         start_time = time.time()
         current_time = 0
 
+        # line number and checksum don't change on retries, frame it once
+        cmd_to_send = self._frame(cmd, self.commands_sent)
 
         while no_response and current_time < max_loop_timeout:
             
@@ -188,9 +833,9 @@ class SerialDevice():
             #    self.commands_sent = 1
 
             # log to file
-            self.gcode_logger.info("{code}".format(code=str(cmd)))
+            self.gcode_logger.info("%s", cmd)
 
-            self.serial_logger.debug("{line},{code}".format(line=self.commands_sent, code=str(cmd)))
+            self.serial_logger.debug("%d,%s", self.commands_sent, cmd)
             send_tries = 0
             max_send_tries = 50
             retry_attempts = 5
@@ -203,19 +848,11 @@ class SerialDevice():
                     result.append("ERROR: Serial communication timed out whilst sending {command}:{current}".format(command=cmd_to_send, current=self.commands_sent))
                     return result
 
-                if self._serial_port == "/dev/null": # fake serial port
-                    cmd_to_send = str(cmd).encode()
-                else:
-                    checksum = functools.reduce(lambda x, y: x ^ y, map(ord, "N%d%s" % (self.commands_sent, cmd)))
-                    cmd_to_send = str("N%d%s*%d" % (self.commands_sent, cmd, checksum)).encode()
-                if not cmd_to_send.endswith(b"\n"):
-                    cmd_to_send += b"\n"
-            
-                self.serial_logger.debug("try {tries}: sending:{line}::{commmand}".format(tries=send_tries, line=self.commands_sent, commmand=cmd_to_send))
+                self.serial_logger.debug("try %d: sending:%d::%r", send_tries, self.commands_sent, cmd_to_send)
                 try:
                     send_tries += 1
-                    self._serial.write(cmd_to_send)    
-                    self._serial.flush() # do it now!
+                    self._writer.write_now(cmd_to_send) # no need to wait for the OS to drain it, the ok says it arrived
+                    self.sent_lines.add(self.commands_sent, cmd_to_send)
                 except SerialTimeoutException as e:
                     self.serial_logger.error(e)
                     self.serial_logger.error("Serial timeout whilst sending {command}:{current}".format(command=cmd_to_send, current=self.commands_sent))
@@ -252,10 +889,9 @@ class SerialDevice():
                     return result
                     #break # exit loop
 
-                new_line = await self.read_response()
-                if new_line != "":
-                    line = str(new_line)
-                    lowerline = line.lower()
+                response = await self.read_parsed_response()
+                if response is not None:
+                    line = response.line
 
                     if retries < 1:
                         result.append("FATAL ERROR: too many retries")
@@ -264,47 +900,62 @@ class SerialDevice():
                         # break
 
                     # Check for RESEND
-                    if 'resend' in lowerline or lowerline.startswith('rs'):
+                    if isinstance(response, ResendRequest):
 
                         # A resend can be requested either by Resend, resend or
                         # rs.
                         retries = retries - 1 # probably will fail anyway
-                        error_msg = "Printer signals resend: {line} (for {cmd} - current line) {current}".format(line=line.rstrip('\n\r'), cmd=cmd, current=self.commands_sent)
+                        error_msg = "Printer signals resend: {line} (for {cmd} - current line) {current}".format(line=line, cmd=cmd, current=self.commands_sent)
                         self.serial_logger.error("{msg}".format(msg=error_msg))
 
-                        # sleep it off, might be busy
-                        await gen.sleep(self.retry_time)
+                        # the firmware acknowledges the bad line after asking
+                        # for the resend, and every earlier line we replay
+                        # gets its own ok too
+                        self._oks_to_ignore += 1
+                        resent = None
+                        if response.line_number is not None:
+                            resent = self._resend_from(response.line_number, self.commands_sent)
+                        if resent is not None:
+                            self._oks_to_ignore += resent - 1
+                        else:
+                            # can't replay it, sleep it off, might be busy
+                            await gen.sleep(self.retry_time)
 
 
                     # Cold extrusion or something else - means line didn't take
                     # so don't update line number-- 'echo: cold extrusion
                     # prevented'
-                    elif line.startswith("echo:"):                              
+                    elif isinstance(response, EchoMessage):
                         no_response = False # received something
 
-                        echo_matches = re.findall("echo: ?(.+)", line)
-                        if len(echo_matches) > 0:
-                            result.append(echo_matches[0])
+                        if response.message:
+                            result.append(response.message)
                         else:
                             result.append(line)
 
-                    elif 'line number' in lowerline:
-                        # next line will be resend, do nothing
-                        error_msg = "Line error: {line} (for {cmd} - current line) {current}".format(line=line.rstrip('\n\r'), cmd=cmd, current=self.commands_sent)
-                        self.serial_logger.error("{msg}".format(msg=error_msg))
-                        await gen.sleep(self.retry_time) # wait, might mean printer is busy
-                        retries -= 1
-                        continue
-                    
-                    elif 'checksum' in lowerline:
-                        # next line will be resend, do nothing
+                    elif isinstance(response, ErrorMessage) and response.line_error:
+                        # line number or checksum error, next line will be resend, do nothing
                         # likely caused by motor moving error in firmware
-                        error_msg = "Checksum error: {line} (for {cmd} - current line) {current}".format(line=line.rstrip('\n\r'), cmd=cmd, current=self.commands_sent)
+                        error_msg = "Line error: {line} (for {cmd} - current line) {current}".format(line=line, cmd=cmd, current=self.commands_sent)
                         self.serial_logger.error("{msg}".format(msg=error_msg))
-                        await gen.sleep(self.retry_time)
+                        self.line_errors += 1
                         retries -= 1
                         continue
 
+                    elif self._urgent_replies and self._is_ok(response):
+                        # an emergency command was sent in the meantime.  The
+                        # oks come in order but can't be told apart, the first
+                        # is as good as the emergency command's.
+                        reply = self._urgent_replies.popleft()
+                        if not reply.done():
+                            reply.set_result([line])
+                        continue
+
+                    elif self._oks_to_ignore > 0 and self._is_ok(response):
+                        # ok for a rejected or replayed line, not ours
+                        self._oks_to_ignore -= 1
+                        continue
+
                     else:
                         no_response = False # received something
 
@@ -315,57 +966,38 @@ class SerialDevice():
                         # if not parsing, return whatever we got
                         if not parse_results:
                             done = False
-                            if lowerline.startswith('ok'):
+                            if self._is_ok(response):
                                 self.ok_count += 1
                                 done = True
-                            self.serial_logger.debug("Appending {line}::{cmd}".format(line=line.rstrip('\n\r'), cmd=cmd))
-                            result.append(line.rstrip('\n\r'))
+                            self.serial_logger.debug("Appending %s::%s", line, cmd)
+                            result.append(line)
                             
                             ## G commands are only one line
-                            if str(cmd).startswith("G") or done or self._serial_port == '/dev/null':
+                            if str(cmd).startswith("G") or done:
                                 break
                             else:
                                 self.serial_logger.debug("multipart response required, reading again")
                                 retries -= 1
 
                         # Temperature message.  'T:' for extruder and 'B:' for bed
-                        elif "ok T:" in line or line.startswith("T:") or "ok B:" in line or line.startswith("B:"):
-                            self.ok_count += 1
-                            response_props = dict()
-
-                            self.serial_logger.debug("temp response: {}".format(line))
-                            extruder_temperature_matches = re.findall("T(\d*): ?([\d\.]+) ?\/?([\d\.]+)?", line)
-                            # Update all temperature values
-                            # line looks like: b'ok T:24.7 /0.0 B:23.4 /0.0 @:0
-                            # B@:0\n'
-                            # OR b'T:176.1 E:0 W:?\n'
-                            if len(extruder_temperature_matches) > 0:
-                                match = extruder_temperature_matches[0]
-                                ### NOTE: hot end (tool number) is the first match
-                                ### (0)
-                                response_props["hotend"] = match[1]
-                    
-                                if match[2]:                         
-                                    response_props["hotend_target"] = match[2]
-                
-                            bed_temperature_matches = re.findall("B: ?([\d\.]+) ?\/?([\d\.]+)?", line)
-
-                            if len(bed_temperature_matches) > 0:
-                                match = bed_temperature_matches[0]
-                                response_props["bed"] = match[0]
-                                response_props["bed_target"] = match[1]
-                            result.append(response_props)
-                            break
+                        elif isinstance(response, TemperatureReport):
+                            self.serial_logger.debug("temp response: %s", line)
+                            result.append(response.properties())
+                            if response.ok:
+                                self.ok_count += 1
+                                break
+                            # otherwise it's a progress report whilst heating
+                            # (M109/M190), the ok comes later
                             # END TEMP PARSING
 
                         else:   
                             # DEFAULT RESPONSE if not matched - JUST SEND BACK TO FRONT END
-                            result.append(line.rstrip('\n\r'))
+                            result.append(line)
                             # DEBUG
-                            self.serial_logger.debug("couldn\'t parse, forwarding: {line}".format(line=line.rstrip('\n\r').escape()))
+                            self.serial_logger.debug("couldn\'t parse, forwarding: %r", line)
 
                             ## G commands are only one line
-                            if str(cmd).startswith("G"):
+                            if str(cmd).startswith("G") or isinstance(response, OkResponse):
                                 break
                             else:
                                 retries -= 1
@@ -373,7 +1005,7 @@ class SerialDevice():
 
                 # nothing received via serial
                 else:
-                    self.serial_logger.info('wating: retry {tries}/10'.format(tries=retries))
+                    self.serial_logger.info('wating: retry %d/10', retries)
 
                     if retries < 1:
                         break
@@ -383,9 +1015,7 @@ class SerialDevice():
         self.commands_sent += 1
           
         # end parsing results
-        # self.commands_queued -= 1
-        self.busy = False
-        self.serial_logger.debug('done sending. {cmds}/{oks}'.format(cmds=self.commands_sent, oks=self.ok_count))
+        self.serial_logger.debug('done sending. %d/%d', self.commands_sent, self.ok_count)
         return result
     
     #
@@ -398,8 +1028,8 @@ class SerialDevice():
         start_time = time.time()
         current_time = 0
 
-        self._serial.write(command)    
-        self._serial.flush() # do it now!
+        self._writer.write_now(command)
+        self._writer.drain() # do it now!
 
         while True:
             # check for timeout
@@ -423,28 +1053,138 @@ class SerialDevice():
             else:
                 # DEBUG
                 self.serial_logger.debug("Waiting on command: {}".format(command))
-                # await gen.sleep(0.05) # should this be gen.sleep() or just
-                # sleep??  Should it block?
-                time.sleep(self.retry_time)
+                # don't block the event loop whilst waiting
+                await gen.sleep(self.retry_time)
 
         return result
 
 
+    #
+    # read one line from the printer, returns "" if nothing arrived in time.
+    # Every line received is also passed on to listeners as a PrinterResponse.
+    #
     async def read_response(self):
-        line = ""
-        try:
-            line = self._serial.readline()
-            # print("SerialDevice(324):line: {}".format(line))
-        except SerialException as se:
-            line = repr(se)
-            print("SerialDevice(370) [except] line: {}".format(line))
-            self.serial_logger.error("370, line: {}".format(line))
-            # raise
-
-        # only process if there's something to process
-        if line != "":              
-            # this format seems to work best for cross-platform Marlin printers
-            line = line.decode('cp437')
-            # print("SerialDevice(334): line: {}".format(line))
-
-        return line
\ No newline at end of file
+        line = await self._read_line()
+        if line != "" and self._listeners:
+            self._notify(self.response_event(parse_line(line)))
+        return line
+
+    #
+    # same as read_response but returns the parsed line (see MarlinParsers),
+    # or None if nothing arrived in time
+    #
+    async def read_parsed_response(self):
+        line = await self._read_line()
+        if line == "":
+            return None
+        response = parse_line(line)
+        if isinstance(response, OkResponse):
+            self._record_buffer_space(response)
+        elif isinstance(response, (TemperatureReport, PositionReport)):
+            self.telemetry.record(response)
+        if self._listeners:
+            self._notify(self.response_event(response))
+        return response
+
+    #
+    # temperatures the firmware reports by itself (M155) aren't replies to
+    # anything: they go to telemetry and listeners, never into the results of
+    # whatever command is waiting.  Whilst a heater wait (M109...) is running
+    # they're left to it, since it can't tell its progress reports apart and
+    # would otherwise hear nothing until it's done.  Called on the event loop
+    # for every line read (threaded transport only).
+    #
+    def _divert_report(self, line:str):
+        if self.telemetry.mode != 'autoreport' or 'T:' not in line:
+            return False
+        if self._heater_wait_running():
+            return False
+        response = parse_line(line)
+        if not isinstance(response, TemperatureReport) or response.ok:
+            return False # an M105 reply
+        self.telemetry.record(response)
+        if self._listeners:
+            self._notify(PrinterResponse(type=response.type, command=None, **response.properties()))
+        return True
+
+    #
+    # whether the command the printer is working on waits for the heaters:
+    # the oldest line in flight, or the one being sent in ping-pong mode
+    #
+    def _heater_wait_running(self):
+        if self._in_flight:
+            cmd = self._in_flight[0].cmd
+        elif self.command_queue.locked():
+            cmd = self._last_command
+        else:
+            return False
+        if isinstance(cmd, bytes):
+            cmd = cmd.decode('cp437')
+        return cmd is not None and HEATER_WAIT_COMMANDS.match(str(cmd)) is not None
+
+    async def _read_line(self, timeout:float=None):
+        if self._reader is not None:
+            # never blocks the event loop, returns "" on timeout
+            return await self._reader.readline(self._timeout if timeout is None else timeout)
+        # the loop doesn't get a turn whilst we wait, send any waiting lines now
+        if self._writer is not None:
+            self._writer.send_pending()
+        return self._read_blocking()
+
+    #
+    # blocking transport: the next line, reading another burst from the port
+    # if there's none left from the last one
+    #
+    def _read_blocking(self):
+        if not self._received:
+            try:
+                lines = self._line_buffer.read_lines(self._serial)
+            except SerialException as se:
+                line = repr(se)
+                print("SerialDevice(370) [except] line: {}".format(line))
+                self.serial_logger.error("370, line: {}".format(line))
+                return line
+            if lines:
+                self._received.extend(lines)
+
+        if self._received:
+            return self._received.popleft()
+        return ""
+
+    #
+    # listeners get called with a PrinterResponse for every line received
+    # from the printer, and whenever the command queue changes
+    #
+    def add_listener(self, listener):
+        if listener not in self._listeners:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def _notify(self, response:PrinterResponse):
+        for listener in list(self._listeners):
+            try:
+                listener(response)
+            except Exception as e:
+                self.serial_logger.error("listener failed: {}".format(repr(e)))
+
+    def _queue_changed(self, depth:int):
+        if self._listeners:
+            self._notify(PrinterResponse(type='queued', command=self._current_command(), depth=depth, in_flight=len(self._in_flight)))
+
+    #
+    # the command a response belongs to (as far as we know)
+    #
+    def _current_command(self):
+        if self._in_flight:
+            return str(self._in_flight[0].cmd)
+        return self._last_command
+
+    #
+    # turn a parsed line from the printer into a PrinterResponse event:
+    # ok, temperature, position, resend, echo, error, busy or info
+    #
+    def response_event(self, response):
+        return PrinterResponse(type=response.type, command=self._current_command(), **response.properties())
@@ -0,0 +1,109 @@
+#
+# Threaded serial reader: reads lines from a serial port on a dedicated
+# thread and hands them to the event loop through an asyncio queue, so
+# slow or silent printers never block the Tornado IOLoop.  Lines are read in
+# bursts (see LineBuffer), and each burst goes to the loop in one hop.
+#
+# See main license for details.
+#
+import asyncio
+import threading
+import time
+import logging
+from LineBuffer import LineBuffer
+
+
+class SerialReader():
+    def __init__(self, serial, loop=None, idle_time=0.005):
+        self._serial = serial
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self._lines = asyncio.Queue()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._buffer = LineBuffer()
+        self.idle_time = idle_time # in s, rest after a read timed out with nothing, in case the port didn't wait
+        self.lines_read = 0
+        self.divert = None # called on the event loop with each line, returns True if it took the line (it isn't queued)
+        self.logger = logging.getLogger("{name}.reader".format(name=__name__))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="SerialReader", daemon=True)
+        self._thread.start()
+
+    def stop(self, wait:bool=False):
+        self._stopping.set()
+        if wait and self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def is_running(self):
+        return self._thread is not None and not self._stopping.is_set()
+
+    #
+    # reader thread main loop -- never touches the queue directly, always
+    # goes through the event loop
+    #
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                lines = self._buffer.read_lines(self._serial)
+            except Exception as e:
+                if self._stopping.is_set():
+                    break
+                # port went away (unplugged, closed underneath us)
+                self.logger.error("serial read failed: {}".format(repr(e)))
+                self._push([repr(e)])
+                break
+
+            if lines is None:
+                # the port already waited for its timeout (dummy ports too), this
+                # only keeps a port with a zero timeout from spinning
+                time.sleep(self.idle_time)
+                continue
+
+            if lines:
+                self._push(lines)
+
+    def _push(self, lines:list):
+        try:
+            self._loop.call_soon_threadsafe(self._deliver, lines)
+        except RuntimeError:
+            # event loop closed, nobody is listening anymore
+            self._stopping.set()
+
+    def _deliver(self, lines:list):
+        for line in lines:
+            if self.divert is not None and self.divert(line):
+                continue
+            self._lines.put_nowait(line)
+
+    #
+    # wait for the next line, returns "" on timeout like a serial readline()
+    #
+    async def readline(self, timeout:float=None):
+        if not self._lines.empty():
+            # already here, no need to set up a timeout
+            self.lines_read += 1
+            return self._lines.get_nowait()
+        try:
+            if timeout is None:
+                line = await self._lines.get()
+            else:
+                line = await asyncio.wait_for(self._lines.get(), timeout)
+        except asyncio.TimeoutError:
+            return ""
+        self.lines_read += 1
+        return line
+
+    def waiting(self):
+        return self._lines.qsize()
+
+    #
+    # throw away anything already received but not yet read
+    #
+    def clear(self):
+        while not self._lines.empty():
+            self._lines.get_nowait()
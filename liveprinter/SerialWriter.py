@@ -0,0 +1,98 @@
+#
+# Coalescing serial writer: lines written during one pass of the event loop
+# are gathered into one buffer and go to the port in a single write() at the
+# end of it, instead of a write() and a flush() (which waits for the OS to
+# drain everything to the device) per line.  Streaming a long path then costs
+# one system call per loop pass rather than two per line.
+#
+# Lines still go out in the order they were written.  Anything that has to
+# be on the wire before carrying on (an emergency stop, closing the port)
+# calls drain().
+#
+# See main license for details.
+#
+import asyncio
+import logging
+
+
+class SerialWriter():
+    def __init__(self, serial, loop=None, coalesce:bool=True):
+        self._serial = serial
+        self._loop = loop if loop is not None else asyncio.get_event_loop()
+        self.coalesce = coalesce # False writes and flushes every line straight away (old behaviour)
+        self._pending = bytearray()
+        self._scheduled = False
+        self.on_error = None # called with the exception if a deferred write fails
+        self.writes = 0 # write() calls on the port
+        self.lines_written = 0
+        self.bytes_written = 0
+        self.logger = logging.getLogger("{name}.writer".format(name=__name__))
+
+    #
+    # queue framed line(s) for the port, sent at the end of this loop pass.
+    # Errors go to on_error, since the caller has moved on by then.
+    #
+    def write(self, data:bytes):
+        self.lines_written += 1
+        if not self.coalesce:
+            self._write(data)
+            self._serial.flush()
+            return
+        self._pending += data
+        if not self._scheduled:
+            self._scheduled = True
+            self._loop.call_soon(self._send_scheduled)
+
+    #
+    # write data (after anything pending) right now, errors are raised
+    #
+    def write_now(self, data:bytes):
+        self.lines_written += 1
+        if self._pending:
+            self._pending += data
+            self.send_pending()
+            return
+        self._write(data)
+        if not self.coalesce:
+            self._serial.flush()
+
+    #
+    # send whatever is waiting, now.  Errors are raised.
+    #
+    def send_pending(self):
+        if not self._pending:
+            return
+        data = bytes(self._pending)
+        self._pending.clear()
+        self._write(data)
+
+    #
+    # send whatever is waiting and wait until the OS has passed it all on to
+    # the device
+    #
+    def drain(self):
+        self.send_pending()
+        self._serial.flush()
+
+    #
+    # throw away anything not sent yet (e.g. lines about to be resent anyway)
+    #
+    def clear(self):
+        self._pending.clear()
+
+    def pending(self):
+        return len(self._pending)
+
+    def _write(self, data:bytes):
+        self._serial.write(data)
+        self.writes += 1
+        self.bytes_written += len(data)
+
+    def _send_scheduled(self):
+        self._scheduled = False
+        try:
+            self.send_pending()
+        except Exception as e:
+            self.logger.error("serial write failed: {}".format(repr(e)))
+            if self.on_error is not None:
+                self.on_error(e)
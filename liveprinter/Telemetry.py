@@ -0,0 +1,188 @@
+#
+# Temperature and position history for a printer, gathered in the background
+# so clients can fetch whole time series in one call instead of polling the
+# printer themselves.  Off until an interval is set (--telemetry_interval or
+# set-telemetry), so the printer isn't sent anything nobody asked for.
+#
+# Temperatures come from Marlin's auto-report (M155) where the firmware has
+# it, otherwise from an M105 every interval; positions from an occasional
+# M114.  Polls wait behind normal commands in the command queue, so they
+# never hold up a print.  Every temperature and position the printer reports
+# is recorded, whoever asked for it.
+#
+# See main license for details.
+#
+import asyncio
+import math
+import time
+from array import array
+from bisect import bisect_right
+from CommandQueue import PRIORITY_LOW, PRIORITY_LOWEST
+from MarlinParsers import TemperatureReport, PositionReport
+
+
+#
+# fixed-size history of samples, one array of doubles per field, the oldest
+# samples overwritten first
+#
+class RingBuffer():
+    def __init__(self, fields:tuple, size:int):
+        self.fields = fields # the first is the time
+        self.size = size
+        self._columns = [array('d', bytes(8 * size)) for field in fields]
+        self._next = 0 # where the next sample goes
+        self._count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, values:tuple):
+        i = self._next
+        for column, value in zip(self._columns, values):
+            column[i] = value
+        self._next = (i + 1) % self.size
+        if self._count < self.size:
+            self._count += 1
+
+    def clear(self):
+        self._next = 0
+        self._count = 0
+
+    def _column(self, column:array):
+        start = (self._next - self._count) % self.size
+        if start + self._count <= self.size:
+            return column[start:start + self._count].tolist()
+        return column[start:].tolist() + column[:self._next].tolist()
+
+    #
+    # samples after time since (all if None), oldest first, as a list per
+    # field.  Missing values are None.
+    #
+    def series(self, since:float=None):
+        times = self._column(self._columns[0])
+        first = 0 if since is None else bisect_right(times, since)
+        series = {self.fields[0]: times[first:]}
+        for field, column in zip(self.fields[1:], self._columns[1:]):
+            values = self._column(column)[first:]
+            series[field] = [None if math.isnan(value) else value for value in values]
+        return series
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+class Telemetry():
+    TEMPERATURE_FIELDS = ('time', 'hotend', 'hotend_target', 'bed', 'bed_target')
+    POSITION_FIELDS = ('time', 'x', 'y', 'z', 'e')
+
+    def __init__(self, printer, interval:float=0, position_interval:float=5.0, size:int=600):
+        self.printer = printer
+        self.interval = interval # s between temperatures, 0 to stop polling
+        self.position_interval = position_interval # s between positions, 0 for none
+        self.temperature = RingBuffer(self.TEMPERATURE_FIELDS, size)
+        self.position = RingBuffer(self.POSITION_FIELDS, size)
+        self.mode = 'off' # 'autoreport' (M155), 'polling' (M105) or 'off'
+        self.last_report = 0 # time of the last temperature, in s
+        self.autoreport = None # whether the firmware has M155 (AUTOREPORT_TEMP), None to just try it
+        self._task = None
+        self._stopped = None # set to stop the task
+
+    #
+    # record a temperature or position report from the printer
+    #
+    def record(self, response):
+        now = time.time()
+        if isinstance(response, TemperatureReport):
+            props = response.properties()
+            self.temperature.append((now * 1000, _number(props.get('hotend')), _number(props.get('hotend_target')),
+                _number(props.get('bed')), _number(props.get('bed_target'))))
+            self.last_report = now
+        elif isinstance(response, PositionReport):
+            position = response.position
+            self.position.append((now * 1000, _number(position.get('x')), _number(position.get('y')),
+                _number(position.get('z')), _number(position.get('e'))))
+
+    def start(self):
+        if self._task is None or self._task.done():
+            self._stopped = asyncio.Event()
+            self._task = asyncio.ensure_future(self._run(self._stopped))
+
+    #
+    # stop polling.  A poll already sent still gets its reply, so the next
+    # command doesn't get it instead.
+    #
+    def stop(self):
+        if self._task is not None:
+            self._stopped.set()
+            self._task = None
+        self.mode = 'off'
+
+    #
+    # everything recorded after since (ms), all of it if None
+    #
+    def history(self, since:float=None):
+        return {
+            'time': time.time() * 1000,
+            'mode': self.mode,
+            'interval': self.interval,
+            'temperature': self.temperature.series(since),
+            'position': self.position.series(since),
+            }
+
+    async def _send(self, cmd:str, priority:int):
+        try:
+            return await self.printer.send_command(cmd, False, priority)
+        except Exception as e:
+            self.printer.serial_logger.error("telemetry {} failed: {}".format(cmd, repr(e)))
+            return []
+
+    #
+    # ask the firmware to report temperatures itself.  Only with the threaded
+    # transport, which keeps the reports out of command results.
+    #
+    async def _start_autoreport(self):
+        if self.printer.transport_mode != 'threaded' or self.autoreport is False:
+            return False
+        result = await self._send("M155 S{}".format(max(1, int(round(self.interval)))), PRIORITY_LOW)
+        return bool(result) and not any("unknown command" in str(line).lower() for line in result)
+
+    async def _run(self, stopped:asyncio.Event):
+        # sleep for the interval, returns True if stopped meanwhile
+        async def wait():
+            try:
+                await asyncio.wait_for(stopped.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            return stopped.is_set()
+
+        try:
+            if self.interval <= 0 or await wait(): # let the connection settle
+                return
+            started = time.time()
+            self.mode = 'autoreport' # before any reports can arrive
+            if not await self._start_autoreport():
+                self.mode = 'polling'
+            last_position = 0
+
+            while not await wait():
+                now = time.time()
+
+                if self.mode == 'autoreport' and now - max(self.last_report, started) > 3 * max(1, self.interval) + 1:
+                    # took the M155 but isn't reporting
+                    self.printer.serial_logger.info("no temperature auto-reports, polling instead")
+                    await self._send("M155 S0", PRIORITY_LOW)
+                    self.mode = 'polling'
+
+                if self.mode == 'polling':
+                    await self._send("M105", PRIORITY_LOW)
+
+                if self.position_interval > 0 and now - last_position >= self.position_interval:
+                    last_position = now
+                    await self._send("M114", PRIORITY_LOWEST)
+        finally:
+            if self._stopped is stopped:
+                self.mode = 'off'
@@ -0,0 +1,152 @@
+#
+# Connect benchmark: a fake Marlin on a pseudo-terminal, either one that
+# resets when the port is opened (deaf whilst it boots, then "start" and its
+# banner) or one that is already running and says nothing until spoken to.
+#
+# Times SerialDevice.async_connect() up to the firmware's first answer, and
+# the whole connect (with the M115 negotiation), against the old fixed wait
+# for the banner.  Unix only.
+#
+# usage: python benchmarks/connect.py [--boot 1.5] [--rounds 3] [--old]
+#
+# See main license for details.
+#
+import argparse
+import asyncio
+import logging
+import os
+import select
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serial import Serial
+from ConnectionState import ConnectionState
+from SerialDevice import SerialDevice
+
+BANNER = [
+    "start",
+    "echo:Marlin 2.1.2",
+    "echo: Last Updated: 2023-01-01 | Author: (none, default config)",
+    "echo:Compiled: Jan  1 2023",
+    "echo: Free Memory: 2791  PlannerBufferBytes: 1248",
+    "echo:Hardcoded Default Settings Loaded",
+    ]
+
+M115 = [
+    "FIRMWARE_NAME:Marlin 2.1.2 (Jan  1 2023) SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin PROTOCOL_VERSION:1.0 MACHINE_TYPE:3D Printer EXTRUDER_COUNT:1",
+    "Cap:EEPROM:1",
+    "Cap:AUTOREPORT_TEMP:1",
+    "Cap:EMERGENCY_PARSER:1",
+    ]
+
+
+#
+# the printer end of the pty.  With a boot time it ignores everything sent
+# until it's up, like a board that was just reset.
+#
+class FakePrinter(threading.Thread):
+    def __init__(self, master, boot:float):
+        super().__init__(daemon=True)
+        self.master = master
+        self.boot = boot
+        self.running = True
+
+    def send(self, lines):
+        os.write(self.master, "".join(line + "\n" for line in lines).encode('cp437'))
+
+    def run(self):
+        up = time.time() + self.boot
+        booted = self.boot <= 0
+        buffer = b""
+        while self.running:
+            if not booted and time.time() >= up:
+                booted = True
+                buffer = b""
+                self.send(BANNER) # comes whether or not anything was sent
+            ready, _, _ = select.select([self.master], [], [], 0.01)
+            if not ready:
+                continue
+            try:
+                data = os.read(self.master, 1024)
+            except OSError:
+                return
+            if not booted:
+                continue # lost in the reset
+            buffer += data
+            while b"\n" in buffer:
+                line, buffer = buffer.split(b"\n", 1)
+                if b"M115" in line:
+                    self.send(M115)
+                self.send(["ok"])
+
+
+#
+# the banner loop async_connect used before: read until the port goes quiet,
+# which in practice was the full 10 seconds
+#
+async def old_connect(printer):
+    printer._serial = Serial(str(printer._serial_port), printer._baud_rate, timeout=printer._timeout)
+    printer.connection_state = ConnectionState.connected
+    printer.start_transport()
+    start_time = time.time()
+    while time.time() - start_time < 10:
+        line = await printer.read_response()
+        if line == "":
+            await asyncio.sleep(printer.retry_time)
+    answered = time.time()
+    await printer.negotiate()
+    return answered
+
+
+async def connect(logpath, boot, old):
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    fake = FakePrinter(master, boot)
+    fake.start()
+
+    printer = SerialDevice(logpath=logpath, telemetry_interval=0)
+    printer.serial_logger.setLevel(logging.ERROR)
+    printer.gcode_logger.setLevel(logging.ERROR)
+    printer._serial_port = os.ttyname(slave)
+    try:
+        start = time.perf_counter()
+        if old:
+            answered = await old_connect(printer) - time.time() + time.perf_counter()
+        else:
+            await printer.async_connect()
+            answered = start + printer.connect_time / 1000
+        elapsed = time.perf_counter() - start
+        known = printer.capabilities.known
+    finally:
+        fake.running = False
+        await printer.close()
+        os.close(master)
+        os.close(slave)
+    return answered - start, elapsed, known
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LivePrinter connect handshake benchmark (pty fake printer)")
+    parser.add_argument("--boot", type=float, default=1.5, help="time the fake printer takes to reset, in s")
+    parser.add_argument("--rounds", type=int, default=3, help="connects per case")
+    parser.add_argument("--old", action="store_true", help="also time the old fixed wait (10s a go)")
+    args = parser.parse_args()
+
+    logpath = tempfile.mkdtemp(prefix="liveprinter-bench-")
+    print("{:<10} {:<10} {:>12} {:>12} {:>8}".format("", "printer", "answered s", "connected s", "M115"))
+    for method in (('old', 'handshake') if args.old else ('handshake',)):
+        for boot in (args.boot, 0):
+            for _ in range(args.rounds if method == 'handshake' else 1):
+                answered, elapsed, known = asyncio.run(connect(logpath, boot, method == 'old'))
+                print("{:<10} {:<10} {:>12.3f} {:>12.3f} {:>8}".format(method, "resets" if boot else "running",
+                    answered, elapsed, "yes" if known else "no"))
+
+
+if __name__ == "__main__":
+    main()
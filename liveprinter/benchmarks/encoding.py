@@ -0,0 +1,87 @@
+#
+# Serialization micro-benchmark: how long printer responses and RPC results
+# take to turn into JSON, with each encoder (stdlib json, and orjson if it's
+# installed).
+#
+#   - "events": PrinterResponse websocket notifications, one per line the
+#     printer sends (temperature reports, oks, queue changes)
+#   - "batch": a send-gcode-batch result for a few hundred lines, as one
+#     JSON-RPC response
+#
+# "json.dumps" is how notifications used to be sent: json.dumps of the
+# JSON-RPC dict, for every websocket listener.
+#
+# usage: python benchmarks/encoding.py [--count 20000]
+#
+# See main license for details.
+#
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import JSONEncoding
+from printerreponse import PrinterResponse
+
+
+def make_events(count):
+    events = []
+    for i in range(count):
+        if i % 3 == 0:
+            events.append(PrinterResponse(type='temperature', command='M105', hotend="{:.2f}".format(190 + i % 7),
+                hotend_target="190.0", bed="60.00", bed_target="60.0"))
+        elif i % 3 == 1:
+            events.append(PrinterResponse(type='ok', command="G1 X{} Y{}".format(i % 200, i % 180), message="ok"))
+        else:
+            events.append(PrinterResponse(type='queued', command="G1 X{}".format(i % 200), depth=i % 8, in_flight=i % 4))
+    return events
+
+
+def batch_result(lines):
+    return {'jsonrpc': '2.0', 'id': 7, 'result': [["ok"] for i in range(lines)] +
+        [["X:{:.2f} Y:10.00 Z:0.20 E:0.00 Count X:0 Y:0 Z:0".format(i), "ok"] for i in range(lines // 10)]}
+
+
+def timed(fn, repeat):
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LivePrinter JSON serialization benchmark")
+    parser.add_argument("--count", type=int, default=20000, help="notifications to encode")
+    parser.add_argument("--batch-lines", type=int, default=300, help="lines in the batch result")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    encoders = ['json'] + (['orjson'] if JSONEncoding.orjson is not None else [])
+    result = batch_result(args.batch_lines)
+
+    def old_events():
+        for response in make_events(args.count):
+            json.dumps(response.toJSONRPC())
+
+    print("{:<16} {:>12} {:>12}".format("", "events/s", "batch ms"))
+    print("{:<16} {:>12.0f} {:>12}".format("json.dumps", args.count / timed(old_events, args.repeat), "-"))
+    for name in encoders:
+        JSONEncoding.use_encoder(name)
+
+        def events():
+            for response in make_events(args.count):
+                response.toJSON()
+
+        events_time = timed(events, args.repeat)
+        batch_time = timed(lambda: JSONEncoding.encode(result), args.repeat * 20)
+        print("{:<16} {:>12.0f} {:>12.3f}".format(name, args.count / events_time, batch_time * 1000))
+
+
+if __name__ == "__main__":
+    main()
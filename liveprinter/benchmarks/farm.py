@@ -0,0 +1,124 @@
+#
+# Printer farm benchmark: one server driving several dummy printers.
+#
+# Starts LivePrinterServer.py with N printers on dummy ports and replays a
+# job on each at the same time, each through its own /printers/<id>/jsonrpc
+# endpoint.  Runs twice: the fast printers on their own, then again
+# alongside one slow printer (a simulated Marlin in real time, so it is
+# held up by its planner and motion), to show whether the slow one holds
+# the others back.
+#
+# usage: python benchmarks/farm.py [--printers 4] [--lines 500]
+#            [--flow-mode ping-pong|window] [--workers] [file.gcode]
+#
+# --workers runs each printer in its own worker process (see PrinterWorker).
+#
+# See main license for details.
+#
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from load import Client, default_jobs, load_gcode, percentile, start_server
+
+
+class PrinterClient(Client):
+    def __init__(self, port, printer_id):
+        super().__init__(port, 1)
+        self.url = "http://localhost:{}/printers/{}/jsonrpc".format(port, printer_id)
+        self.printer_id = printer_id
+
+
+#
+# send lines in order, one send-gcode at a time, until done or stop is set
+#
+async def replay(client, lines, stop=None):
+    latencies = []
+    start = time.perf_counter()
+    sent = 0
+    for line in lines:
+        if stop is not None and stop.is_set():
+            break
+        await client.timed(latencies, "send-gcode", line)
+        sent += 1
+    elapsed = time.perf_counter() - start
+    return {
+        'printer': client.printer_id,
+        'commands': sent,
+        'cmds_per_sec': sent / elapsed if elapsed > 0 else 0,
+        'p50_ms': percentile(latencies, 0.5),
+        'p99_ms': percentile(latencies, 0.99),
+        }
+
+
+#
+# the fast printers replay the job, optionally whilst the slow one does too
+#
+async def run_phase(clients, lines, slow_client=None, metrics_client=None):
+    await metrics_client.rpc("get-metrics", True)
+    stop = asyncio.Event()
+    slow = None
+    if slow_client is not None:
+        slow = asyncio.ensure_future(replay(slow_client, lines, stop))
+    results = await asyncio.gather(*[replay(client, lines) for client in clients])
+    stop.set()
+    if slow is not None:
+        results.append(await slow)
+    lag = (await metrics_client.rpc("get-metrics"))[0].get('loop_lag', {})
+    return results, lag
+
+
+def print_phase(name, results, lag):
+    print("{} (loop lag p99 {:.2f}ms, max {:.2f}ms)".format(name, lag.get('p99', 0), lag.get('max', 0)))
+    print("  {:<10} {:>7} {:>9} {:>8} {:>8}".format("printer", "cmds", "cmds/s", "p50 ms", "p99 ms"))
+    for r in results:
+        print("  {printer:<10} {commands:>7} {cmds_per_sec:>9.1f} {p50_ms:>8.2f} {p99_ms:>8.2f}".format(**r))
+
+
+async def run(args):
+    fast_ids = ["p{}".format(i) for i in range(1, args.printers)]
+    server = await start_server(args.port, ["--printers={}".format(",".join(fast_ids + ["slow"])),
+        "--dummy_latency=0", "--dummy_clock=real"] + (["--workers"] if args.workers else []))
+    try:
+        clients = [PrinterClient(args.port, printer_id) for printer_id in fast_ids]
+        slow_client = PrinterClient(args.port, "slow")
+        for client in clients:
+            await client.rpc("set-serial-port", "dummy:canned", 250000)
+            await client.rpc("set-flow-mode", args.flow_mode)
+        await slow_client.rpc("set-serial-port", "dummy:marlin", 250000)
+        await slow_client.rpc("set-flow-mode", args.flow_mode)
+
+        lines = load_gcode(args.job or default_jobs()[0], args.lines)
+        alone = await run_phase(clients, lines, metrics_client=clients[0])
+        shared = await run_phase(clients, lines, slow_client, metrics_client=clients[0])
+        return alone, shared
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LivePrinter server farm benchmark (dummy printers)")
+    parser.add_argument("job", nargs="?", help="GCODE file to replay (default: the first of testing/*.gcode)")
+    parser.add_argument("--port", type=int, default=8897)
+    parser.add_argument("--printers", type=int, default=4, help="printers in the farm, including the slow one")
+    parser.add_argument("--lines", type=int, default=500, help="lines to replay on each printer")
+    parser.add_argument("--flow-mode", default="ping-pong", choices=["ping-pong", "window"])
+    parser.add_argument("--workers", action="store_true", help="one worker process per printer")
+    args = parser.parse_args()
+
+    alone, shared = asyncio.run(run(args))
+    print_phase("fast printers on their own", *alone)
+    print_phase("with a slow printer", *shared)
+
+    fast_alone = sum(r['cmds_per_sec'] for r in alone[0])
+    fast_shared = sum(r['cmds_per_sec'] for r in shared[0][:len(alone[0])])
+    print("fast printers' throughput with the slow one: {:.0%} of on their own".format(fast_shared / fast_alone if fast_alone else 0))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+#
+# Streaming flow control benchmark: the simulated Marlin (dummyserial) with
+# plain oks, where the window counts every line in flight against the RX
+# buffer, vs. ADVANCED_OK oks (ok N P B), where lines the firmware has taken
+# into its command buffer don't count.
+#
+#   - "short": G92s, which take no time to run, so only the link matters
+#   - "moves": short G1 segments, where the planner should stay full
+#
+# Reports lines/s, the most lines (and bytes) in flight, and RX buffer
+# overflows in the simulator (there should be none).
+#
+# usage: python benchmarks/flowcontrol.py [--lines 200] [--latency 0.05]
+#
+# See main license for details.
+#
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dummyserial
+from ConnectionState import ConnectionState
+from SerialDevice import SerialDevice
+
+
+def make_lines(kind, count):
+    if kind == 'short':
+        return ["G92 E{}".format(i) for i in range(count)]
+    return ["G1 X{:.2f} Y{:.2f} F6000".format(100 + i * 0.05, 100 + (i % 2) * 0.05) for i in range(count)]
+
+
+async def stream(logpath, lines, latency, advanced_ok):
+    printer = SerialDevice(logpath=logpath, flow_mode='window', telemetry_interval=0)
+    printer.gcode_logger.setLevel(logging.ERROR)
+    printer._serial_port = "/dev/null"
+    printer._serial = dummyserial.Serial(port=printer._serial_port, baudrate=250000, ds_latency=latency,
+        ds_firmware=dummyserial.MarlinSimulator(advanced_ok=advanced_ok))
+    printer.commands_sent = 1
+    printer.connection_state = ConnectionState.connected
+    printer.start_transport()
+    await printer.negotiate()
+
+    most = [0, 0]
+    async def watch():
+        while True:
+            most[0] = max(most[0], len(printer._in_flight))
+            most[1] = max(most[1], printer._in_flight_bytes)
+            await asyncio.sleep(0.001)
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        start = time.perf_counter()
+        await printer.send_commands(lines)
+        elapsed = time.perf_counter() - start
+    finally:
+        watcher.cancel()
+        overflows = printer._serial.firmware.rx_overflows
+        await printer.close()
+    return len(lines) / elapsed, most[0], most[1], overflows
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LivePrinter ADVANCED_OK flow control benchmark (simulated Marlin)")
+    parser.add_argument("--lines", type=int, default=200, help="lines to stream")
+    parser.add_argument("--latency", type=float, default=0.05, help="dummy port reply delay in s")
+    args = parser.parse_args()
+
+    logpath = tempfile.mkdtemp(prefix="liveprinter-bench-")
+    print("{:<8} {:<12} {:>10} {:>10} {:>10} {:>10}".format("", "oks", "lines/s", "in flight", "bytes", "overflows"))
+    for kind in ('short', 'moves'):
+        lines = make_lines(kind, args.lines)
+        for advanced_ok in (False, True):
+            rate, in_flight, in_flight_bytes, overflows = asyncio.run(stream(logpath, lines, args.latency, advanced_ok))
+            print("{:<8} {:<12} {:>10.1f} {:>10} {:>10} {:>10}".format(kind, "ADVANCED_OK" if advanced_ok else "plain",
+                rate, in_flight, in_flight_bytes, overflows))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+#
+# Microbenchmark: framing outgoing GCODE (line number + checksum + encode),
+# the old per-send string formatting vs GCodeFramer.
+#
+# usage: python benchmarks/framing.py [file.gcode ...]
+#
+# Uses the given GCODE files (e.g. testing/*.gcode, anthill/*.gcode) or a
+# generated path of short G1 moves.
+#
+# See main license for details.
+#
+import functools
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+import GCodeFramer
+
+
+def generated_path(count=2000):
+    return ["G1 X{:.3f} Y{:.3f} E{:.5f} F1500".format(100 + i * 0.013, 100 - i * 0.021, i * 0.00173) for i in range(count)]
+
+
+def load_gcode(paths):
+    lines = []
+    for path in paths:
+        with open(path) as f:
+            for line in f:
+                line = line.split(';')[0].strip()
+                if line != "":
+                    lines.append(line)
+    return lines
+
+
+#
+# what SerialDevice.send_command did for every try of every line
+#
+def legacy_frame(line_number, cmd):
+    checksum = functools.reduce(lambda x, y: x ^ y, map(ord, "N%d%s" % (line_number, cmd)))
+    cmd_to_send = str("N%d%s*%d" % (line_number, cmd, checksum)).encode()
+    if not cmd_to_send.endswith(b"\n"):
+        cmd_to_send += b"\n"
+    return cmd_to_send
+
+
+def run(lines, repeat=5):
+    def bench(go):
+        return min(timeit.repeat(go, number=5, repeat=repeat)) / (5 * len(lines))
+
+    def legacy():
+        for n, cmd in enumerate(lines):
+            legacy_frame(n, cmd)
+
+    def framer():
+        for n, cmd in enumerate(lines):
+            GCodeFramer.frame(n, cmd)
+
+    prepared = [GCodeFramer.prepare(cmd) for cmd in lines]
+    def prepared_resend():
+        # frame already-prepared lines, e.g. resending or renumbering
+        for n, line in enumerate(prepared):
+            line.frame(n)
+
+    assert legacy_frame(7, lines[0]) == GCodeFramer.frame(7, lines[0])
+
+    results = [
+        ("legacy string formatting", bench(legacy)),
+        ("GCodeFramer.frame", bench(framer)),
+        ("prepared line, frame only", bench(prepared_resend)),
+        ]
+    print("{n} lines".format(n=len(lines)))
+    for name, t in results:
+        print("{:28s} {:8.3f} us/line  ({:5.2f}x)".format(name + ":", t * 1e6, results[0][1] / t))
+
+
+if __name__ == "__main__":
+    lines = load_gcode(sys.argv[1:]) if len(sys.argv) > 1 else generated_path()
+    run(lines)
@@ -0,0 +1,249 @@
+#
+# Load generator / throughput benchmark for the JSON-RPC server, against the
+# dummy printer.
+#
+# Starts LivePrinterServer.py on its own port, connects it to the dummy
+# serial port and then runs:
+#   - "mixed": concurrent send-gcode and get-printer-state calls
+#   - one replay per recorded job (testing/*.gcode, anthill/*.gcode), sent
+#     in order like the editor does, one command (or batch) at a time
+#
+# For each it reports commands/sec, p50/p95/p99 request latency and the
+# server's event loop lag (from get-metrics).
+#
+# usage: python benchmarks/load.py [--concurrency 8] [--requests 500]
+#            [--replay-lines 200] [--flow-mode ping-pong|window]
+#            [--dummy-latency 0.01,0.3] [--dummy-clock real|virtual]
+#            [--dummy-firmware canned|marlin]
+#            [--save results.json] [--compare results.json] [file.gcode ...]
+#
+# --compare exits with an error if any scenario's commands/sec dropped by
+# more than --tolerance against the saved results.
+#
+# See main license for details.
+#
+import argparse
+import asyncio
+import glob
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+from tornado.httpclient import AsyncHTTPClient, HTTPClientError
+
+SERVER_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+REPO_DIR = os.path.join(SERVER_DIR, "..")
+
+
+def default_jobs():
+    return sorted(glob.glob(os.path.join(REPO_DIR, "testing", "*.gcode"))) + \
+        sorted(glob.glob(os.path.join(REPO_DIR, "anthill", "*.gcode")))
+
+
+def load_gcode(path, limit=None):
+    lines = []
+    with open(path) as f:
+        for line in f:
+            line = line.split(';')[0].strip()
+            if line != "":
+                lines.append(line)
+                if limit and len(lines) >= limit:
+                    break
+    return lines
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p * len(values)))]
+
+
+class Client():
+    def __init__(self, port, concurrency):
+        self.url = "http://localhost:{}/jsonrpc".format(port)
+        self.http = AsyncHTTPClient(max_clients=max(concurrency, 10))
+        self._ids = itertools.count(1)
+
+    async def rpc(self, method, *params):
+        body = json.dumps({"jsonrpc": "2.0", "id": next(self._ids), "method": method, "params": list(params)})
+        response = await self.http.fetch(self.url, method="POST", body=body, request_timeout=120)
+        reply = json.loads(response.body)
+        if 'error' in reply:
+            raise RuntimeError("{} failed: {}".format(method, reply['error']))
+        return reply['result']
+
+    #
+    # call and time one method, in ms
+    #
+    async def timed(self, latencies, method, *params):
+        start = time.perf_counter()
+        result = await self.rpc(method, *params)
+        latencies.append((time.perf_counter() - start) * 1000)
+        return result
+
+
+#
+# start the server and wait for it to answer
+#
+async def start_server(port, server_args=(), startup_timeout=15):
+    server = subprocess.Popen([sys.executable, "LivePrinterServer.py", "--port={}".format(port), "--logging=warning"] + list(server_args),
+        cwd=SERVER_DIR)
+    client = Client(port, 1)
+    deadline = time.monotonic() + startup_timeout
+    while True:
+        try:
+            await client.rpc("get-printer-state")
+            return server
+        except (ConnectionError, HTTPClientError, OSError):
+            if server.poll() is not None or time.monotonic() > deadline:
+                server.terminate()
+                raise RuntimeError("server didn't start")
+            await asyncio.sleep(0.2)
+
+
+def summarise(name, commands, elapsed, latencies, metrics, errors):
+    lag = metrics.get('loop_lag', {})
+    return {
+        'scenario': name,
+        'commands': commands,
+        'errors': errors,
+        'seconds': elapsed,
+        'cmds_per_sec': commands / elapsed if elapsed > 0 else 0,
+        'p50_ms': percentile(latencies, 0.5),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'loop_lag_p99_ms': lag.get('p99', 0),
+        'loop_lag_max_ms': lag.get('max', 0),
+        }
+
+
+#
+# concurrent send-gcode / get-printer-state traffic
+#
+async def mixed(client, requests, concurrency, state_ratio):
+    latencies = []
+    errors = 0
+    commands = 0
+    remaining = iter(range(requests))
+
+    async def worker():
+        nonlocal errors, commands
+        for i in remaining:
+            if random.random() < state_ratio:
+                await client.timed(latencies, "get-printer-state")
+            else:
+                result = await client.timed(latencies, "send-gcode", "G1 X{:.2f} Y{:.2f} F3000".format(random.uniform(0, 200), random.uniform(0, 200)))
+                commands += 1
+                errors += sum(1 for r in result if isinstance(r, str) and r.startswith("ERROR"))
+
+    await client.rpc("get-metrics", True)
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    metrics = (await client.rpc("get-metrics"))[0]
+    return summarise("mixed", requests, elapsed, latencies, metrics, errors)
+
+
+#
+# send a recorded job in order, one send-gcode (or send-gcode-batch) at a time
+#
+async def replay(client, path, limit, batch_size):
+    lines = load_gcode(path, limit)
+    latencies = []
+    errors = 0
+
+    await client.rpc("get-metrics", True)
+    start = time.perf_counter()
+    if batch_size > 1:
+        for i in range(0, len(lines), batch_size):
+            result = await client.timed(latencies, "send-gcode-batch", lines[i:i + batch_size], False, True)
+            errors += len(result[0]['errors'])
+    else:
+        for line in lines:
+            result = await client.timed(latencies, "send-gcode", line)
+            errors += sum(1 for r in result if isinstance(r, str) and r.startswith("ERROR"))
+    elapsed = time.perf_counter() - start
+    metrics = (await client.rpc("get-metrics"))[0]
+    return summarise(os.path.basename(path), len(lines), elapsed, latencies, metrics, errors)
+
+
+def print_results(results):
+    print("{:<36} {:>7} {:>6} {:>9} {:>8} {:>8} {:>8} {:>9} {:>9}".format(
+        "scenario", "cmds", "errors", "cmds/s", "p50 ms", "p95 ms", "p99 ms", "lag p99", "lag max"))
+    for r in results:
+        print("{scenario:<36} {commands:>7} {errors:>6} {cmds_per_sec:>9.1f} {p50_ms:>8.2f} {p95_ms:>8.2f} {p99_ms:>8.2f} {loop_lag_p99_ms:>9.2f} {loop_lag_max_ms:>9.2f}".format(**r))
+
+
+#
+# scenarios that got slower than the saved results by more than tolerance
+#
+def regressions(results, baseline, tolerance):
+    saved = dict((r['scenario'], r) for r in baseline)
+    slower = []
+    for r in results:
+        before = saved.get(r['scenario'])
+        if before and r['cmds_per_sec'] < before['cmds_per_sec'] * (1 - tolerance):
+            slower.append((r['scenario'], before['cmds_per_sec'], r['cmds_per_sec']))
+    return slower
+
+
+async def run(args):
+    server = await start_server(args.port, ["--dummy_latency={}".format(args.dummy_latency), "--dummy_clock={}".format(args.dummy_clock),
+        "--dummy_firmware={}".format(args.dummy_firmware)])
+    try:
+        client = Client(args.port, args.concurrency)
+        await client.rpc("set-serial-port", "dummy", 250000)
+        await client.rpc("set-flow-mode", args.flow_mode)
+
+        results = [await mixed(client, args.requests, args.concurrency, args.state_ratio)]
+        for path in (args.jobs or default_jobs()):
+            results.append(await replay(client, path, args.replay_lines, args.batch))
+
+        await client.rpc("close-serial-port")
+        return results
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LivePrinter server load test (dummy printer)")
+    parser.add_argument("jobs", nargs="*", help="GCODE files to replay (default: testing/*.gcode anthill/*.gcode)")
+    parser.add_argument("--port", type=int, default=8898)
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients for the mixed load")
+    parser.add_argument("--requests", type=int, default=500, help="requests for the mixed load")
+    parser.add_argument("--state-ratio", type=float, default=0.2, help="fraction of get-printer-state calls in the mixed load")
+    parser.add_argument("--replay-lines", type=int, default=200, help="lines to replay from each job (0 for all)")
+    parser.add_argument("--batch", type=int, default=1, help="replay with send-gcode-batch calls of this many lines")
+    parser.add_argument("--flow-mode", default="ping-pong", choices=["ping-pong", "window"])
+    parser.add_argument("--dummy-latency", default="0", help="dummy printer reply delay in s, or min,max (default: none)")
+    parser.add_argument("--dummy-clock", default="virtual", choices=["real", "virtual"], help="simulate the dummy printer's delays (virtual) or really wait for them")
+    parser.add_argument("--dummy-firmware", default="canned", choices=["canned", "marlin"], help="canned replies, or a simulated Marlin (planner queue, move times, heaters)")
+    parser.add_argument("--save", help="save results to this JSON file")
+    parser.add_argument("--compare", help="compare with results saved with --save")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed drop in commands/sec for --compare")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    print_results(results)
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            slower = regressions(results, json.load(f), args.tolerance)
+        for (name, before, after) in slower:
+            print("REGRESSION {}: {:.1f} -> {:.1f} cmds/s".format(name, before, after))
+        if slower:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+#
+# Microbenchmark: Marlin response parsing, the old inline regex/lower()
+# chain from SerialDevice.send_command vs MarlinParsers.parse_line.
+#
+# usage: python benchmarks/parse_responses.py [recorded-serial-log.txt ...]
+#
+# A recorded log is just what the printer sent, one response per line.
+# Without one, a typical mix for a printing session with temperature
+# reports is used.
+#
+# See main license for details.
+#
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from MarlinParsers import parse_line, TemperatureReport, OkResponse
+
+SESSION_MIX = (
+    ["ok"] * 60 +
+    ["ok T:201.3 /205.0 B:59.8 /60.0 @:87 B@:0"] * 10 +
+    [" T:204.1 /205.0 B:60.1 /60.0 @:80 B@:12"] * 10 +
+    ["X:10.00 Y:20.00 Z:0.30 E:12.70 Count X:800 Y:1600 Z:120"] * 5 +
+    ["echo:busy: processing", "busy: processing"] * 5 +
+    ["Error:Line Number is not Last Line Number+1, Last Line: 41", "Resend: 42"] * 2 +
+    ["echo: cold extrusion prevented"]
+)
+
+
+#
+# the per-line work send_command used to do, kept here for comparison
+#
+def legacy_parse(new_line):
+    line = str(new_line)
+    lowerline = line.lower()
+    if 'resend' in lowerline or lowerline.startswith('rs'):
+        return ('resend', line)
+    elif line.startswith("echo:"):
+        echo_matches = re.findall("echo: ?(.+)", line)
+        return ('echo', echo_matches[0] if echo_matches else line)
+    elif 'line number' in lowerline:
+        return ('error', line)
+    elif 'checksum' in lowerline:
+        return ('error', line)
+    elif "ok T:" in line or line.startswith("T:") or "ok B:" in line or line.startswith("B:"):
+        response_props = dict()
+        extruder_temperature_matches = re.findall(r"T(\d*): ?([\d\.]+) ?\/?([\d\.]+)?", line)
+        if len(extruder_temperature_matches) > 0:
+            match = extruder_temperature_matches[0]
+            response_props["hotend"] = match[1]
+            if match[2]:
+                response_props["hotend_target"] = match[2]
+        bed_temperature_matches = re.findall(r"B: ?([\d\.]+) ?\/?([\d\.]+)?", line)
+        if len(bed_temperature_matches) > 0:
+            match = bed_temperature_matches[0]
+            response_props["bed"] = match[0]
+            response_props["bed_target"] = match[1]
+        return ('temperature', response_props)
+    elif lowerline.startswith('ok'):
+        return ('ok', line.rstrip('\n\r'))
+    return ('info', line.rstrip('\n\r'))
+
+
+def new_parse(line):
+    response = parse_line(line)
+    if isinstance(response, TemperatureReport):
+        return (response.type, response.properties())
+    return (response.type, response.line)
+
+
+def load_lines(paths):
+    lines = []
+    for path in paths:
+        with open(path, encoding='cp437') as f:
+            lines.extend(l.rstrip('\n\r') for l in f if l.strip() != "")
+    return lines
+
+
+def run(lines, repeat=5):
+    def bench(parse):
+        def go():
+            for line in lines:
+                parse(line)
+        return min(timeit.repeat(go, number=20, repeat=repeat)) / (20 * len(lines))
+
+    legacy = bench(legacy_parse)
+    new = bench(new_parse)
+    print("{n} lines".format(n=len(lines)))
+    print("legacy inline parsing: {:8.3f} us/line".format(legacy * 1e6))
+    print("MarlinParsers:         {:8.3f} us/line".format(new * 1e6))
+    print("speedup:               {:8.2f}x".format(legacy / new))
+
+
+if __name__ == "__main__":
+    lines = load_lines(sys.argv[1:]) if len(sys.argv) > 1 else SESSION_MIX
+    run(lines)
@@ -0,0 +1,100 @@
+#
+# Serial read benchmark: a chatty fake printer on a pseudo-terminal (oks with
+# temperature auto-reports in between) read with readline() per line, as
+# SerialReader used to, vs. LineBuffer reading whole bursts.
+#
+# Counts the read() calls on the port (pyserial's readline() reads a byte at
+# a time) as well as lines/s.  Unix only.
+#
+# usage: python benchmarks/serialread.py [--lines 20000] [--burst 8]
+#
+# See main license for details.
+#
+import argparse
+import os
+import sys
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serial import Serial
+from LineBuffer import LineBuffer
+
+
+#
+# a port that counts its reads
+#
+class CountingSerial(Serial):
+    reads = 0
+
+    def read(self, size=1):
+        self.reads += 1
+        return super().read(size)
+
+
+def make_lines(count):
+    lines = []
+    for i in range(count):
+        if i % 4 == 3:
+            lines.append(" T:{:.2f} /200.00 B:{:.2f} /60.00 @:127 B@:64\n".format(199 + i % 3 * 0.5, 59.8 + i % 5 * 0.1))
+        else:
+            lines.append("ok\n")
+    return [line.encode('cp437') for line in lines]
+
+
+#
+# write the lines to the pty in bursts, as a printer would
+#
+def send(master, lines, burst):
+    for i in range(0, len(lines), burst):
+        os.write(master, b"".join(lines[i:i + burst]))
+        time.sleep(0) # let the reader at them
+
+
+def run(lines, burst, method):
+    master, slave = os.openpty()
+    tty.setraw(master)
+    tty.setraw(slave)
+    port = CountingSerial(os.ttyname(slave), 250000, timeout=0.5)
+    sender = threading.Thread(target=send, args=(master, lines, burst), daemon=True)
+    buffer = LineBuffer()
+    received = 0
+    start = time.perf_counter()
+    sender.start()
+    try:
+        while received < len(lines):
+            if method == 'readline':
+                line = port.readline()
+                if not line:
+                    break
+                line.decode('cp437')
+                received += 1
+            else:
+                got = buffer.read_lines(port)
+                if got is None:
+                    break
+                received += len(got)
+        elapsed = time.perf_counter() - start
+    finally:
+        port.close()
+        os.close(master)
+    return received / elapsed, port.reads / max(1, received), received
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LivePrinter serial read benchmark (pty fake printer)")
+    parser.add_argument("--lines", type=int, default=20000, help="lines for the printer to send")
+    parser.add_argument("--burst", type=int, default=8, help="lines the printer sends at once")
+    args = parser.parse_args()
+
+    lines = make_lines(args.lines)
+    print("{:<12} {:>10} {:>12} {:>10}".format("", "lines/s", "reads/line", "lines"))
+    for method in ('readline', 'LineBuffer'):
+        rate, reads, received = run(lines, args.burst, method)
+        print("{:<12} {:>10.0f} {:>12.2f} {:>10}".format(method, rate, reads, received))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+#
+# Serial write benchmark: streams a path of G1 moves to a fake printer on a
+# pseudo-terminal (so the writes go through a real tty driver, flush() and
+# all), with each line written and flushed on its own vs. the lines from
+# each event loop pass coalesced into one write (SerialWriter).
+#
+# The fake printer answers "ok" to every line as soon as it's read, so this
+# measures the host side only.  Unix only.
+#
+# usage: python benchmarks/serialwrite.py [--lines 5000] [--window 4,16]
+#
+# See main license for details.
+#
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+import tty
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from serial import Serial
+from ConnectionState import ConnectionState
+from SerialDevice import SerialDevice
+
+
+#
+# answers every line written to the pty with an ok, counting the reads it
+# takes to get them
+#
+class FakePrinter():
+    def __init__(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(self.slave)
+        self.port = os.ttyname(self.slave)
+        self.reads = 0
+        self.lines = 0
+        self._stopping = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        buffered = b""
+        while not self._stopping:
+            try:
+                data = os.read(self.master, 65536)
+            except OSError:
+                break
+            self.reads += 1
+            buffered += data
+            lines = buffered.count(b"\n")
+            if lines:
+                buffered = buffered[buffered.rfind(b"\n") + 1:]
+                self.lines += lines
+                os.write(self.master, b"ok\n" * lines)
+
+    def close(self):
+        self._stopping = True
+        os.close(self.slave)
+        os.close(self.master)
+
+
+def make_path(count):
+    return ["G1 X{:.3f} Y{:.3f} E{:.5f} F1500".format(100 + i * 0.013, 100 - i * 0.021, i * 0.00173) for i in range(count)]
+
+
+async def stream(logpath, lines, flow_mode, window, coalesce):
+    fake = FakePrinter()
+    printer = SerialDevice(logpath=logpath, flow_mode=flow_mode, telemetry_interval=0, coalesce_writes=coalesce)
+    printer.gcode_logger.setLevel(logging.ERROR)
+    printer.window_size = window
+    printer.rx_buffer_size = 1 << 20 # the fake printer has no RX buffer to overflow
+    printer._serial_port = fake.port
+    printer._serial = Serial(fake.port, 250000, timeout=0.8, writeTimeout=0.8)
+    printer.connection_state = ConnectionState.connected
+    printer.start_transport()
+    try:
+        start = time.perf_counter()
+        results = await printer.send_commands(lines)
+        elapsed = time.perf_counter() - start
+        errors = sum(1 for result in results if result != ["ok"])
+        writes = printer.metrics()['serial_writes']
+    finally:
+        await printer.close()
+        fake.close()
+    return len(lines) / elapsed, writes, fake.reads, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LivePrinter serial write benchmark (pty fake printer)")
+    parser.add_argument("--lines", type=int, default=5000, help="G1 lines to stream")
+    parser.add_argument("--window", default="4,16", help="window sizes to try, comma separated")
+    args = parser.parse_args()
+
+    lines = make_path(args.lines)
+    logpath = tempfile.mkdtemp(prefix="liveprinter-bench-")
+    runs = [('ping-pong', 1)] + [('window', int(size)) for size in args.window.split(',')]
+
+    print("{:<14} {:<10} {:>10} {:>10} {:>10} {:>7}".format("flow", "writes", "lines/s", "writes", "reads", "errors"))
+    for flow_mode, window in runs:
+        for coalesce in (False, True):
+            rate, writes, reads, errors = asyncio.run(stream(logpath, lines, flow_mode, window, coalesce))
+            print("{:<14} {:<10} {:>10.0f} {:>10} {:>10} {:>7}".format(
+                flow_mode if flow_mode == 'ping-pong' else "window {}".format(window),
+                "coalesced" if coalesce else "per line", rate, writes, reads, errors))
+
+
+if __name__ == "__main__":
+    main()
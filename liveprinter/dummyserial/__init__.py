@@ -15,4 +15,6 @@ Dummy Serial Python Module.
 """
 
 from .classes import Serial  # NOQA
+from .clocks import RealClock, VirtualClock  # NOQA
+from .marlin import MarlinSimulator  # NOQA
 from .exceptions import DSIOError, DSTypeError  # NOQA
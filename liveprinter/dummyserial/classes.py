@@ -5,13 +5,15 @@
 
 import logging
 import logging.handlers
-import sys
+import threading
 import time
-import re
+from collections import deque
 
 from serial.serialutil import SerialException, PortNotOpenError
 
 import dummyserial.constants
+from dummyserial.clocks import RealClock, make_clock, make_latency
+from dummyserial.responses import ResponseTable
 
 __author__ = 'Greg Albrecht <gba@orionlabs.io> then Evan Raskob <http://pixelist.info>'
 __license__ = 'Apache License, Version 2.0'
@@ -28,6 +30,26 @@ class Serial(object):
     Args:
         * port:
         * timeout:
+        * ds_responses: dict of command (e.g. 'M105'), command letter
+          ('G') or regex -> reply (bytes, or a function returning bytes)
+          for written lines matching it (see
+          :class:`dummyserial.responses.ResponseTable`).
+        * ds_latency: delay before each reply can be read: None or 0 for
+          none, seconds, a (min, max) range or a function (see
+          :func:`dummyserial.clocks.make_latency`).
+        * ds_seed: random seed for the latency, for repeatable runs.
+        * ds_clock: 'real' (default) or 'virtual'. With a virtual clock
+          delays are simulated: reads skip ahead to the next reply
+          instead of waiting for it.
+        * ds_firmware: a simulated firmware (e.g.
+          :class:`dummyserial.marlin.MarlinSimulator`) to answer instead
+          of ds_responses.  Its reply times are added to the latency.
+
+    Replies are queued in the order they were written.  Reading before a
+    reply is due blocks, like a real port, until it is due, something else
+    is written or the timeout passes (None waits for ever, 0 never waits).
+    With a virtual clock only waiting for a write takes real time.
+    readline() returns them one line at a time.
 
     Note:
     As the portname argument not is used properly, only one port on
@@ -48,7 +70,14 @@ class Serial(object):
         self._logger.debug('kwargs=%s', kwargs)
 
         self.is_open = True  # pylint: disable=C0103
-        self._waiting_data = dummyserial.constants.NO_DATA_PRESENT
+
+        # replies on their way, in order: (due time, bytes)
+        self._pending = deque()
+        # replies that have arrived, for reading
+        self._input = bytearray()
+        self._last_due = 0.0
+        # written and read from different threads, reads wait on it
+        self._lock = threading.Condition()
 
         self.port = kwargs['port']  # Serial port name.
         self.initial_port_name = self.port  # Initial name given to the port
@@ -59,18 +88,34 @@ class Serial(object):
         self.baudrate = kwargs.get(
             'baudrate', dummyserial.constants.DEFAULT_BAUDRATE)
 
+        self.clock = make_clock(kwargs.get('ds_clock'))
+        self._latency = make_latency(
+            kwargs.get('ds_latency'), kwargs.get('ds_seed'))
+
+        self.firmware = kwargs.get('ds_firmware')
+        if self.firmware is not None and self.firmware.baudrate is None:
+            self.firmware.baudrate = self.baudrate
+
+    @property
+    def ds_responses(self):
+        return self._responses.responses
+
+    @ds_responses.setter
+    def ds_responses(self, responses):
+        self._responses = ResponseTable(responses)
+
     def __repr__(self):
         """String representation of the DummySerial object."""
         return (
             "{0}.{1}<id=0x{2:x}, open={3}>(port={4!r}, timeout={5!r}, "
-            "waiting_data={6!r})".format(
+            "in_waiting={6!r})".format(
                 self.__module__,
                 self.__class__.__name__,
                 id(self),
                 self.is_open,
                 self.port,
                 self.timeout,
-                self._waiting_data,
+                len(self._input),
             )
         )
 
@@ -90,53 +135,131 @@ class Serial(object):
         if self.is_open:
             self.is_open = False
         self.port = None
+        with self._lock:
+            self._lock.notify_all()  # nothing more to wait for
 
     def write(self, data):
         """
         Write to a port on dummy_serial.
 
         Args:
-            data (string/bytes): data for sending to the port on
-            dummy_serial. Will affect the response for subsequent read
+            data (bytes): one or more lines for sending to the port on
+            dummy_serial. Each queues its reply for subsequent read
             operations.
-
-        Note that for Python2, the inputdata should be a **string**. For
-        Python3 it should be of type **bytes**.
         """
         self._logger.debug('Writing (%s): "%s"', len(data), data)
 
         if not self.is_open:
             raise PortNotOpenError()
 
-        if sys.version_info[0] > 2:
-            if not isinstance(data, bytes):
-                raise dummyserial.exceptions.DSTypeError(
-                    'The input must be type bytes. Given:' + repr(data))
-            input_str = str(data, encoding='latin1')
-        else:
-            input_str = data
-
-        # Look up which data that should be waiting for subsequent read
-        # commands.
-
-        # modified by Evan to use dict as a regex
-        self._waiting_data = dummyserial.constants.NO_DATA_PRESENT
-
-        for key, val in self.ds_responses.items():
-            pattern = re.compile(key)
-            if pattern.match(input_str):
-                # self._logger.debug("response type {} is: {}".format(val, type(val)))
-                # test if this is a function or a variable to return
-                if callable(val):
-                    try:
-                        self._waiting_data = val()
-                    except Exception as e:
-                        Logger.log("d", "exception:{}".format(e))
-                        return
-                else:
-                    self._waiting_data = val
-                break
-
+        if not isinstance(data, bytes):
+            raise dummyserial.exceptions.DSTypeError(
+                'The input must be type bytes. Given:' + repr(data))
+
+        if self.firmware is not None:
+            # the reader thread asks the firmware for reports (and works out
+            # ADVANCED_OK replies) under the lock too
+            with self._lock:
+                for (when, reply) in self.firmware.receive(data, self.clock.now()):
+                    self._schedule_locked(reply, when)
+                self._lock.notify_all()
+            return
+
+        # Look up the reply for each line written
+        for line in data.split(b"\n"):
+            if not line.strip():
+                continue
+            reply = self._responses.match(line)
+            if reply is None:
+                continue
+            # test if this is a function or a variable to return
+            if callable(reply):
+                try:
+                    reply = reply()
+                except Exception as e:
+                    self._logger.error("exception: %s", e)
+                    return
+            self._schedule(reply)
+        self._wake()
+
+    def _wake(self):
+        """Let a blocked read know there's a new reply."""
+        with self._lock:
+            self._lock.notify_all()
+
+    def _schedule(self, data, when=None):
+        """Queue a reply (bytes, or a function returning them when it's
+        read), readable once its latency has passed after when (or now)."""
+        if not data:
+            return
+        if not isinstance(data, bytes) and not callable(data):
+            data = bytes(data, encoding='latin1')
+
+        with self._lock:
+            self._schedule_locked(data, when)
+
+    def _schedule_locked(self, data, when=None):
+        # replies come back in order, even with random latencies
+        if when is None:
+            when = self.clock.now()
+        due = max(when + self._latency(), self._last_due)
+        self._last_due = due
+        self._pending.append((due, data))
+
+    def _receive(self, wait=False):
+        """
+        Move replies that are due into the input buffer (call with the
+        lock held). With wait, a virtual clock skips ahead to the next
+        reply if there's nothing due. Returns whether anything arrived.
+        """
+        now = self.clock.now()
+        if self.firmware is not None:
+            # whatever the firmware sends by itself
+            for (when, report) in self.firmware.reports(now):
+                self._schedule_locked(report, when)
+        if wait and self._pending and self._pending[0][0] > now:
+            if self.clock.advance_to(self._pending[0][0]):
+                now = self.clock.now()
+        received = False
+        while self._pending and self._pending[0][0] <= now:
+            reply = self._pending.popleft()[1]
+            # replies can be worked out when they arrive
+            self._input += reply() if callable(reply) else reply
+            received = True
+        return received
+
+    def _deadline(self):
+        """When a read starting now times out (real time), None for never."""
+        if self.timeout is None:
+            return None
+        return time.monotonic() + self.timeout
+
+    def _wait(self, deadline):
+        """
+        Wait (with the lock held) until the next reply or auto-report is
+        due, something is written or the deadline passes.  Returns False
+        once the deadline has passed or the port is closed.
+        """
+        now = time.monotonic()
+        if not self.is_open or (deadline is not None and now >= deadline):
+            return False
+        wake = deadline
+        if isinstance(self.clock, RealClock):
+            # due times are on the same clock, otherwise only a write helps
+            due = [self._pending[0][0]] if self._pending else []
+            next_report = getattr(self.firmware, 'next_report', None)
+            if next_report is not None and next_report() is not None:
+                due.append(next_report())
+            if due:
+                wake = min(due) if wake is None else min(wake, min(due))
+        self._lock.wait(None if wake is None else max(0.0, wake - now))
+        return True
+
+    def _take(self, size):
+        """Remove and return size bytes from the input buffer."""
+        data = bytes(self._input[:size])
+        del self._input[:size]
+        return data
 
     def flush(self):
         """\
@@ -157,11 +280,13 @@ class Serial(object):
         Args:
             size (int): For compability with the real function.
 
-        Returns a **string** for Python2 and **bytes** for Python3.
+        Returns **bytes**.
 
-        If the response is shorter than size, it will sleep for timeout.
+        If the response is shorter than size, it waits for the rest until
+        the timeout, then returns what there is.
 
-        If the response is longer than size, it will return only size bytes.
+        If the response is longer than size, it will return only size bytes,
+        the rest is kept for later.
         """
         self._logger.debug('Reading %s bytes.', size)
 
@@ -173,73 +298,83 @@ class Serial(object):
                 'The size to read must not be negative. ' +
                 'Given: {!r}'.format(size))
 
-        # Do the actual reading from the waiting data, and simulate the
-        # influence of size.
-        if self._waiting_data == dummyserial.constants.DEFAULT_RESPONSE:
-            return_str = self._waiting_data
-        elif size == len(self._waiting_data):
-            return_str = self._waiting_data
-            self._waiting_data = dummyserial.constants.NO_DATA_PRESENT
-        elif size < len(self._waiting_data):
-            self._logger.debug(
-                'The size (%s) to read is smaller than the available data. ' +
-                'Some bytes will be kept for later. ' +
-                'Available (%s): "%s"',
-                size, len(self._waiting_data), self._waiting_data
-            )
-
-            return_str = self._waiting_data[:size]
-            self._waiting_data = self._waiting_data[size:]
-        else:  # Wait for timeout - we asked for more data than available!
-            self._logger.debug(
-                'The size (%s) to read is larger than the available data. ' +
-                'Will sleep until timeout. ' +
-                'Available (%s): "%s"',
-                size, len(self._waiting_data), self._waiting_data
-            )
-
-            time.sleep(self.timeout)
-            return_str = self._waiting_data
-            self._waiting_data = dummyserial.constants.NO_DATA_PRESENT
+        deadline = self._deadline()
+        with self._lock:
+            while len(self._input) < size:
+                if not self._receive(wait=True) and not self._wait(deadline):
+                    break
+            return_str = self._take(size)
 
         self._logger.debug(
             'Read (%s): "%s"',
             len(return_str), return_str
         )
 
-        if sys.version_info[0] > 2:  # Convert types to make it python3 compat.
-            return bytes(return_str, encoding='latin1')
-        else:
-            return return_str
+        return return_str
 
-    ## FIXME
-    def readline(self):
+    def readline(self, size=-1):
         """
-        Read line of bytes from the Dummy Serial Responses.
+        Read a line of bytes (up to and including the newline) from the
+        Dummy Serial Responses, or at most size bytes.
 
+        If there's no whole line by the timeout, it returns what there
+        is, like a real port.
         """
-        # self._logger.debug('Reading line')
-
         if not self.is_open:
             raise PortNotOpenError
 
-        # Do the actual reading from the waiting data, and simulate the
-        # influence of size.
-        if len(self._waiting_data) < 1:
-            return_str = dummyserial.constants.NO_DATA_PRESENT
-        else:
-            return_str = self._waiting_data # keep in original format, might be bytes!
-            self._waiting_data = dummyserial.constants.NO_DATA_PRESENT
+        deadline = self._deadline()
+        with self._lock:
+            while True:
+                end = self._input.find(b"\n")
+                if end >= 0 or 0 <= size <= len(self._input):
+                    break
+                if not self._receive(wait=True) and not self._wait(deadline):
+                    break
+            if end < 0:
+                end = len(self._input)
+            else:
+                end += 1
+            if size >= 0:
+                end = min(end, size)
+            return_str = self._take(end)
 
         if return_str:
-            self._logger.debug(
-                'Read ({}): "{}"'.format(len(return_str), return_str)
-            )
+            self._logger.debug('Read (%s): "%s"', len(return_str), return_str)
         return return_str
 
+    @property
+    def in_waiting(self):
+        """
+        Bytes received and waiting to be read. Only looks: a virtual clock
+        moves on in read() and readline(), not here.
+        """
+        with self._lock:
+            self._receive()
+            return len(self._input)
+
+    def inWaiting(self):  # pylint: disable=C0103
+        """pyserial 2.7 compat."""
+        return self.in_waiting
+
+    @property
+    def out_waiting(self):
+        """Bytes waiting to be sent: none, writes are instant."""
+        return 0
+
+    def outWaiting(self):  # pylint: disable=C0103
+        """pyserial 2.7 compat."""
+        return self.out_waiting
+
+    def reset_input_buffer(self):
+        """Throw away everything received and not read yet."""
+        with self._lock:
+            self._receive()
+            del self._input[:]
+
+    def reset_output_buffer(self):
+        """Nothing to throw away, writes are instant."""
+        pass
 
-    def out_waiting(self):  # pylint: disable=C0103
-        """Returns length of waiting output data."""
-        return len(self._waiting_data)
-
-    outWaiting = out_waiting  # pyserial 2.7 / 3.0 compat.
+    flushInput = reset_input_buffer  # pyserial 2.7 compat.
+    flushOutput = reset_output_buffer  # pyserial 2.7 compat.
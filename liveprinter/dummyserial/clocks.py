@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Dummy Serial Clocks and Latency Models."""
+
+import random
+import time
+
+__author__ = 'Evan Raskob <http://pixelist.info>'
+__license__ = 'Apache License, Version 2.0'
+__copyright__ = 'Copyright 2019 Evan Raskob'
+
+
+class RealClock(object):
+    """
+    Wall clock time. Replies become readable once their latency has
+    really passed; reads block until then (up to the port's timeout).
+    """
+
+    virtual = False
+
+    def now(self):
+        """Current time in seconds."""
+        return time.monotonic()
+
+    def advance_to(self, when):
+        """Real time can't be skipped ahead, the reader has to wait."""
+        return False
+
+
+class VirtualClock(object):
+    """
+    Simulated time. Starts at 0 and only moves when told to; a read that
+    finds no reply ready yet skips straight to when the next one is due,
+    as if it had waited for it. Runs as fast as the caller can read, and
+    the same seed always gives the same timings.
+    """
+
+    virtual = True
+
+    def __init__(self, start=0.0):
+        self._now = start
+
+    def now(self):
+        """Current simulated time in seconds."""
+        return self._now
+
+    def advance(self, seconds):
+        """Move simulated time forward."""
+        self._now += max(0.0, seconds)
+        return self._now
+
+    def advance_to(self, when):
+        """Move simulated time forward to when (never backwards)."""
+        if when > self._now:
+            self._now = when
+        return True
+
+
+def make_clock(clock):
+    """
+    A clock from a name ('real' or 'virtual'), None (real) or a clock
+    object, which is used as is.
+    """
+    if clock is None or clock == 'real':
+        return RealClock()
+    if clock == 'virtual':
+        return VirtualClock()
+    if hasattr(clock, 'now') and hasattr(clock, 'advance_to'):
+        return clock
+    raise ValueError('Unknown clock: {!r}'.format(clock))
+
+
+def make_latency(latency, seed=None):
+    """
+    A function returning the delay in seconds before the next reply.
+
+    Args:
+        * latency: None or 0 for no delay; a number for a fixed delay; a
+          (min, max) pair for uniformly random delays; or a function
+          taking a random.Random and returning a delay, for any other
+          distribution.
+        * seed: random seed, for repeatable delays.
+    """
+    rng = random.Random(seed)
+
+    if not latency:
+        return lambda: 0.0
+    if callable(latency):
+        return lambda: max(0.0, latency(rng))
+    if isinstance(latency, (int, float)):
+        return lambda: float(latency)
+
+    low, high = latency
+    if high <= 0:
+        return lambda: 0.0
+    return lambda: rng.uniform(low, high)
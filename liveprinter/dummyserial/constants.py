@@ -26,4 +26,4 @@ DEFAULT_BAUDRATE = 250000
 #   "no data available on port".
 DEFAULT_RESPONSE = b'ok\n'
 
-NO_DATA_PRESENT = ''
+NO_DATA_PRESENT = b''
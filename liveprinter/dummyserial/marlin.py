@@ -0,0 +1,392 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Simulated Marlin firmware for the dummy serial port.
+
+Works out when each reply would come back from a real printer, instead of
+answering straight away: moves go into a bounded planner queue and only get
+their ``ok`` once there's room for them, move times come from the feedrate
+and acceleration, M400/G4/G28 wait for motion to finish and M109/M190 wait
+for a heater model to reach temperature, reporting it every second like
+Marlin does. M155 turns on temperature auto-reports (see reports()). With
+advanced_ok, oks say how much room is left like Marlin's ADVANCED_OK
+(``ok N<line> P<planner blocks> B<command slots>``).
+
+Use it with ``dummyserial.Serial(port=..., ds_firmware=MarlinSimulator())``.
+"""
+
+import functools
+import math
+import operator
+import re
+from collections import deque
+
+__author__ = 'Evan Raskob <http://pixelist.info>'
+__license__ = 'Apache License, Version 2.0'
+__copyright__ = 'Copyright 2019 Evan Raskob'
+
+
+WORD_PATTERN = re.compile(r"([A-Z])\s*(-?\d*\.?\d+)?")
+NUMBERED_LINE_PATTERN = re.compile(r"N(\d+)\s*(.*)")
+
+
+class Heater(object):
+    """
+    First order heater model: the temperature heads exponentially towards
+    the target (or room temperature when off) with time constant tau.
+    """
+
+    def __init__(self, ambient=20.0, tau=15.0, window=1.0, residency=0.0):
+        self.ambient = ambient
+        self.tau = tau  # in s
+        self.window = window  # close enough to the target, in degrees
+        self.residency = residency  # time to stay in the window, in s
+        self.target = 0.0
+        self._start_temperature = ambient
+        self._start_time = 0.0
+
+    def _equilibrium(self):
+        return max(self.target, self.ambient)
+
+    def temperature(self, when):
+        """Temperature at time when (in s)."""
+        equilibrium = self._equilibrium()
+        elapsed = max(0.0, when - self._start_time)
+        return equilibrium + (self._start_temperature - equilibrium) * \
+            math.exp(-elapsed / self.tau)
+
+    def set_target(self, target, when):
+        self._start_temperature = self.temperature(when)
+        self._start_time = when
+        self.target = target
+
+    def reached_at(self, when):
+        """When the temperature will be within window of the target."""
+        gap = abs(self.temperature(when) - self._equilibrium())
+        if gap <= self.window:
+            return when + self.residency
+        return when + self.tau * math.log(gap / self.window) + self.residency
+
+
+class MarlinSimulator(object):
+    """
+    Replies to GCODE the way (and when) Marlin would.
+
+    Args:
+        * planner_size: moves the planner can hold (BLOCK_BUFFER_SIZE).
+        * command_buffer: commands waiting to be run (BUFSIZE).
+        * rx_buffer_size: serial receive buffer in bytes. Lines arriving
+          when both buffers are full are garbled, like on a real board.
+        * acceleration: in mm/s^2 (M204).
+        * max_speed, max_z_speed: in mm/s.
+        * home_time: how long G28 takes, in s.
+        * command_time: time to parse and run one command, in s.
+        * baudrate: for the time lines take to arrive; set from the port
+          if not given.
+        * advanced_ok: send ADVANCED_OK oks.
+    """
+
+    def __init__(self, planner_size=16, command_buffer=4, rx_buffer_size=128,
+                 acceleration=1000.0, max_speed=300.0, max_z_speed=10.0,
+                 home_time=3.0, command_time=0.0002, baudrate=None,
+                 advanced_ok=True):
+        self.planner_size = planner_size
+        self.command_buffer = command_buffer
+        self.rx_buffer_size = rx_buffer_size
+        self.acceleration = acceleration
+        self.max_speed = max_speed
+        self.max_z_speed = max_z_speed
+        self.home_time = home_time
+        self.command_time = command_time
+        self.baudrate = baudrate
+        self.advanced_ok = advanced_ok
+
+        self.hotend = Heater(tau=15.0, residency=3.0)
+        self.bed = Heater(tau=60.0)
+
+        self.position = dict(X=0.0, Y=0.0, Z=0.0, E=0.0)
+        self.feedrate = 1500.0  # mm/min
+        self.relative = False
+        self.relative_extrusion = False
+        self.last_line = 0
+        self.halted = False
+        self.autoreport_interval = 0  # s between temperature reports (M155)
+        self._next_report = None
+
+        self._planner = deque()  # end times of planned moves
+        self._motion_end = 0.0  # when the last planned move finishes
+        self._busy_until = 0.0  # when the current command finishes
+        self._waiting = deque()  # (start time, bytes) of received commands
+        self._received = deque()  # (arrival, start time) of recent commands, for ADVANCED_OK
+
+        # counters
+        self.moves = 0
+        self.planner_full = 0  # times a move had to wait for the planner
+        self.rx_overflows = 0
+
+    def receive(self, data, now):
+        """
+        Lines written to the port at time now. Returns (time, reply line)
+        pairs, one line each, in order. A reply line can be a function
+        returning it, to be called when it's read.
+        """
+        replies = []
+        byte_time = 10.0 / (self.baudrate or 250000)
+        arrival = now
+        for line in data.split(b"\n"):
+            arrival += (len(line) + 1) * byte_time
+            if line.strip():
+                replies += self._receive_line(line, arrival)
+        return replies
+
+    def _receive_line(self, line, arrival):
+        if self.halted:
+            return []
+
+        start = max(arrival, self._busy_until)
+        if self._overflowed(arrival, start, len(line) + 1):
+            self.rx_overflows += 1
+            line = line[:len(line) // 2]  # lost bytes
+
+        text = line.decode('latin1').strip()
+        if text.startswith('N'):
+            text, error = self._check_line(text)
+            if error is not None:
+                self._busy_until = start + self.command_time
+                return [(self._busy_until, error),
+                        (self._busy_until, b"Resend: %d\n" % (self.last_line + 1)),
+                        (self._busy_until, self._ok(self._busy_until))]
+
+        replies = self._run(text.split(';')[0].strip(), start + self.command_time)
+        self._busy_until = replies[-1][0] if replies else start
+        return replies
+
+    def _overflowed(self, arrival, start, size):
+        """Whether there's room to receive a line arriving at arrival."""
+        while self._waiting and self._waiting[0][0] <= arrival:
+            self._waiting.popleft()
+        self._waiting.append((start, size))
+        if self.advanced_ok:
+            while self._received and self._received[0][1] < arrival - 10.0:
+                self._received.popleft()
+            self._received.append((arrival, start))
+        if len(self._waiting) <= self.command_buffer:
+            return False
+        buffered = sum(size for (_, size) in
+                       list(self._waiting)[self.command_buffer:])
+        return buffered > self.rx_buffer_size
+
+    def _check_line(self, text):
+        """
+        Check a numbered line's checksum and number.
+        Returns the command and an error line, or None if it's fine.
+        """
+        if '*' not in text:
+            return text, b"Error:No Checksum with line number, Last Line: %d\n" % self.last_line
+        body, _, checksum = text.rpartition('*')
+        expected = functools.reduce(operator.xor, body.encode('latin1'), 0)
+        if not checksum.strip().isdigit() or int(checksum) != expected:
+            return body, b"Error:checksum mismatch, Last Line: %d\n" % self.last_line
+
+        match = NUMBERED_LINE_PATTERN.match(body)
+        if match is None:
+            return body, b"Error:checksum mismatch, Last Line: %d\n" % self.last_line
+        line_number = int(match.group(1))
+        cmd = match.group(2)
+        if cmd.startswith("M110"):
+            self.last_line = line_number
+        elif line_number != self.last_line + 1:
+            return cmd, b"Error:Line Number is not Last Line Number+1, Last Line: %d\n" % self.last_line
+        else:
+            self.last_line = line_number
+        return cmd, None
+
+    def temperatures(self, when):
+        return b"T:%.2f /%.2f B:%.2f /%.2f @:0 B@:0" % (
+            self.hotend.temperature(when), self.hotend.target,
+            self.bed.temperature(when), self.bed.target)
+
+    def _run(self, cmd, now):
+        """Run one command. Returns its replies, the last being its ok."""
+        if cmd == "":
+            return []
+        words = WORD_PATTERN.findall(cmd.upper())
+        if not words:
+            return [(now, b'echo:Unknown command: "%s"\n' % cmd.encode('latin1')), (now, self._ok(now))]
+        code = words[0][0] + str(int(float(words[0][1] or 0)))
+        params = dict((letter, float(value)) for (letter, value) in words[1:] if value)
+        flags = set(letter for (letter, _) in words[1:])
+
+        replies = []
+
+        if code in ("G0", "G1"):
+            now = self._move(params, now)
+        elif code == "G4":
+            now = max(now, self._motion_end) + params.get('P', 0) / 1000.0 + params.get('S', 0)
+        elif code == "G28":
+            now = max(now, self._motion_end)
+            replies += self._busy(now, self.home_time)
+            now += self.home_time
+            for axis in ('XYZ' if not flags & set('XYZ') else flags & set('XYZ')):
+                self.position[axis] = 0.0
+            self._motion_end = now
+        elif code == "G90":
+            self.relative = self.relative_extrusion = False
+        elif code == "G91":
+            self.relative = self.relative_extrusion = True
+        elif code == "G92":
+            for axis in 'XYZE':
+                if axis in params:
+                    self.position[axis] = params[axis]
+        elif code == "M82":
+            self.relative_extrusion = False
+        elif code == "M83":
+            self.relative_extrusion = True
+        elif code == "M400":
+            now = max(now, self._motion_end)
+        elif code in ("M104", "M109"):
+            replies, now = self._heat(self.hotend, code == "M109", params, now)
+        elif code in ("M140", "M190"):
+            replies, now = self._heat(self.bed, code == "M190", params, now)
+        elif code == "M105":
+            return [(now, b"ok " + self.temperatures(now) + b"\n")]
+        elif code == "M114":
+            replies.append((now, b"X:%.2f Y:%.2f Z:%.2f E:%.2f Count X:%d Y:%d Z:%d\n" % (
+                self.position['X'], self.position['Y'], self.position['Z'], self.position['E'],
+                self.position['X'] * 80, self.position['Y'] * 80, self.position['Z'] * 400)))
+        elif code == "M115":
+            replies += [(now, b"FIRMWARE_NAME:Marlin (LivePrinter simulator) SOURCE_CODE_URL:github.com/MarlinFirmware/Marlin PROTOCOL_VERSION:1.0 MACHINE_TYPE:Simulated EXTRUDER_COUNT:1\n"),
+                        (now, b"Cap:EEPROM:0\n"),
+                        (now, b"Cap:AUTOREPORT_TEMP:1\n"),
+                        (now, b"Cap:EMERGENCY_PARSER:0\n")]
+        elif code == "M112":
+            self.halted = True
+            return [(now, b"Error:Printer halted. kill() called!\n")]
+        elif code == "M155":
+            self.autoreport_interval = params.get('S', 1.0)
+            self._next_report = now + self.autoreport_interval if self.autoreport_interval > 0 else None
+        elif code == "M204":
+            self.acceleration = params.get('S', params.get('P', self.acceleration))
+        elif code == "M410":
+            # quickstop: forget planned moves
+            self._planner.clear()
+            self._motion_end = now
+        elif code[0] not in "GMT":
+            replies.append((now, b'echo:Unknown command: "%s"\n' % cmd.encode('latin1')))
+
+        replies.append((now, self._ok(now)))
+        return replies
+
+    def _ok(self, now):
+        """
+        The ok for a command finished at now. ADVANCED_OK ones are worked
+        out when they're read, once the lines sent meanwhile have arrived.
+        """
+        if not self.advanced_ok:
+            return b"ok\n"
+        line = self.last_line
+        return lambda: self._advanced_ok(line, now)
+
+    def _advanced_ok(self, line, now):
+        # like Marlin, the command being acknowledged still has its slot
+        planned = sum(1 for end in self._planner if end > now)
+        waiting = sum(1 for (arrival, start) in self._received
+                      if arrival <= now < start)
+        return b"ok N%d P%d B%d\n" % (
+            line, max(0, self.planner_size - 1 - planned),
+            max(0, self.command_buffer - 1 - waiting))
+
+    def next_report(self):
+        """When the next auto-report is due, or None if there won't be one."""
+        if self.halted:
+            return None
+        return self._next_report
+
+    def reports(self, now):
+        """
+        Temperature auto-reports (M155) due by now, as (time, line) pairs.
+        Reports that nobody was around to read for a while are skipped.
+        """
+        if self._next_report is None or self.halted:
+            return []
+        if now - self._next_report > 10 * self.autoreport_interval:
+            missed = int((now - self._next_report) / self.autoreport_interval)
+            self._next_report += missed * self.autoreport_interval
+        replies = []
+        while self._next_report <= now:
+            replies.append((self._next_report, b" " + self.temperatures(self._next_report) + b"\n"))
+            self._next_report += self.autoreport_interval
+        return replies
+
+    def _move(self, params, now):
+        """Plan a move, waiting for room in the planner. Returns when it's planned."""
+        if 'F' in params:
+            self.feedrate = params['F']
+
+        distances = {}
+        for axis in 'XYZE':
+            if axis in params:
+                relative = self.relative_extrusion if axis == 'E' else self.relative
+                target = self.position[axis] + params[axis] if relative else params[axis]
+                distances[axis] = target - self.position[axis]
+                self.position[axis] = target
+
+        distance = math.sqrt(sum(distances.get(axis, 0) ** 2 for axis in 'XYZ'))
+        speed = min(self.feedrate / 60.0, self.max_speed)
+        if distance == 0:
+            distance = abs(distances.get('E', 0))
+        elif distances.get('Z') and not (distances.get('X') or distances.get('Y')):
+            speed = min(speed, self.max_z_speed)
+        if distance == 0 or speed <= 0:
+            return now
+
+        # trapezoid from standstill to standstill, or a triangle if too short
+        accel_distance = speed * speed / self.acceleration
+        if distance >= accel_distance:
+            duration = distance / speed + speed / self.acceleration
+        else:
+            duration = 2 * math.sqrt(distance / self.acceleration)
+
+        while self._planner and self._planner[0] <= now:
+            self._planner.popleft()
+        if len(self._planner) >= self.planner_size:
+            # wait for the oldest move to finish
+            self.planner_full += 1
+            now = self._planner.popleft()
+
+        self._motion_end = max(now, self._motion_end) + duration
+        self._planner.append(self._motion_end)
+        self.moves += 1
+        return now
+
+    def _heat(self, heater, wait, params, now):
+        """Set a heater (M104/M109/M140/M190), waiting for it if asked."""
+        target = params.get('S', params.get('R', heater.target))
+        heater.set_target(target, now)
+        # S only waits when heating, R waits for cooling too
+        if not wait or target <= 0 or \
+                ('R' not in params and heater.temperature(now) >= target):
+            return [], now
+
+        replies = []
+        reached = heater.reached_at(now)
+        report = now + 1.0
+        while report < reached:
+            replies.append((report, b" " + self.temperatures(report) + b" W:?\n"))
+            report += 1.0
+        return replies, reached
+
+    def _busy(self, now, duration):
+        """The "busy" keepalive Marlin sends every 2s of a long command."""
+        return [(now + t, b"echo:busy: processing\n")
+                for t in range(2, int(duration) + 1, 2)]
+
+    def metrics(self):
+        return {
+            'moves': self.moves,
+            'planner_full': self.planner_full,
+            'planner_depth': len(self._planner),
+            'rx_overflows': self.rx_overflows,
+            'line': self.last_line,
+        }
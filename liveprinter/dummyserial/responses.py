@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Dummy Serial Response Table."""
+
+import re
+
+__author__ = 'Evan Raskob <http://pixelist.info>'
+__license__ = 'Apache License, Version 2.0'
+__copyright__ = 'Copyright 2019 Evan Raskob'
+
+
+# optional line number, then the command: letter and number (G1, M105...)
+COMMAND_PATTERN = re.compile(rb"\s*(?:N\d+\s*)?([A-Za-z])(\d*)")
+
+# a key that's just a command (M105) or a command letter (G)
+COMMAND_KEY_PATTERN = re.compile(r"^([A-Za-z])(\d*)$")
+
+
+def command_word(line):
+    """
+    The command in a written line as (letter, number), e.g. (b'G', 1) for
+    b'N12 G01 X10*34'. The number is None if there isn't one; None if
+    it's not a command at all.
+    """
+    match = COMMAND_PATTERN.match(line)
+    if match is None:
+        return None
+    letter, number = match.groups()
+    return (letter.upper(), int(number) if number else None)
+
+
+class ResponseTable(object):
+    """
+    Replies for written lines, compiled once.
+
+    Keys are either commands (``'M105'``, ``'G1'``), a command letter on its
+    own for every other command with that letter (``'G'``), or a regex
+    matched against the whole line. Commands are looked up in a dict by the
+    line's command, with or without a line number and checksum; the
+    regexes are only tried (in order) when that finds nothing.
+
+    Replies are bytes (or str), or a function returning them.
+    """
+
+    def __init__(self, responses=None):
+        self.responses = dict(responses or {})
+        self._commands = {}  # (letter, number or None) -> reply
+        self._patterns = []  # (compiled regex, reply)
+
+        for key, reply in self.responses.items():
+            match = COMMAND_KEY_PATTERN.match(key)
+            if match is not None:
+                letter, number = match.groups()
+                index = (letter.upper().encode('latin1'),
+                         int(number) if number else None)
+                # first one wins, like the regexes
+                self._commands.setdefault(index, reply)
+            else:
+                self._patterns.append(
+                    (re.compile(key.encode('latin1')), reply))
+
+    def __len__(self):
+        return len(self.responses)
+
+    def match(self, line):
+        """The reply for a line (bytes), or None."""
+        word = command_word(line)
+        if word is not None:
+            reply = self._commands.get(word)
+            if reply is None and word[1] is not None:
+                reply = self._commands.get((word[0], None))
+            if reply is not None:
+                return reply
+
+        for pattern, reply in self._patterns:
+            if pattern.match(line):
+                return reply
+        return None
@@ -1,52 +1,76 @@
 import time
+from JSONEncoding import encode
 
 class PrinterResponse():
+    # responses are made for every line the printer sends, so they're kept
+    # small, and each form (dict, JSON-RPC, JSON text) is only built once
+    __slots__ = ('_time', '_type', '_command', '_properties', '_dict', '_jsonrpc', '_json')
+
     def __init__(self, **fields):
         self._time = time.time() * 1000 #ms for javascript front end
-        self._type = fields['type']
-        self._command = fields['command']
-        self._properties = {}
-
-        for key,val in fields.items(): 
-            if key != "type" and key != "command":
-                self._properties[key] = val
-        
+        self._type = fields.pop('type')
+        self._command = fields.pop('command')
+        self._properties = fields
+        self._dict = None
+        self._jsonrpc = None
+        self._json = None
+
+    #
+    # a response from toDict(), e.g. from another process
+    #
+    @classmethod
+    def fromDict(cls, fields:dict):
+        response = cls(type=fields['type'], command=fields['command'], **fields['properties'])
+        response._time = fields['time']
+        return response
+
     def getTime(self):
         return self._time
 
     def getType(self):
         return self._type
 
+    # (don't change the dicts returned, they're shared)
     def toDict(self):
-        return {
+        if self._dict is None:
+            self._dict = {
                 'type': self._type,
                 'time': self._time,
-                'command': self._command, 
+                'command': self._command,
                 'properties': self._properties
                 }
+        return self._dict
 
     def toJSONRPC(self):
-        json = {
+        if self._jsonrpc is None:
+            params = {
+                'time': self._time,
+                'command': self._command
+                }
+            params.update(self._properties)
+            self._jsonrpc = {
                 'jsonrpc': '2.0',
-                'id': 3, 
+                'id': 3,
                 'method': self._type,
-                'params': {
-                    'time': self._time,
-                    'command': self._command
-                    }
+                'params': params
                 }
-        for key,val in self._properties.items(): 
-            json['params'][key] = val
-        
-        return json
-    
+        return self._jsonrpc
+
+    #
+    # toJSONRPC() as JSON text, for websockets
+    #
+    def toJSON(self):
+        if self._json is None:
+            self._json = encode(self.toJSONRPC())
+        return self._json
+
     def __repr__(self):
-        return self.toDict()
+        return "PrinterResponse({})".format(self.toDict())
 
     def __str__(self):
         return str(self.toDict())
 
-    
+
 # TEST
 #pr = PrinterResponse(**{
 #    'type': "temperature",
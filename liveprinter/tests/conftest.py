@@ -0,0 +1,33 @@
+#
+# the modules import each other flat, as when the server is run from
+# liveprinter/, so the tests do too
+#
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import dummyserial
+from ConnectionState import ConnectionState
+from SerialDevice import SerialDevice
+
+
+#
+# connects a SerialDevice to a simulated Marlin (with ADVANCED_OK oks), as
+# set-serial-port does for "dummy".  Awaited inside the test's event loop:
+# printer = await connect_dummy(flow_mode, telemetry_interval=1.0)
+#
+@pytest.fixture
+def connect_dummy(tmp_path):
+    async def connect(flow_mode:str, **settings):
+        printer = SerialDevice(logpath=str(tmp_path), flow_mode=flow_mode, **settings)
+        printer._serial_port = "/dev/null"
+        printer._serial = dummyserial.Serial(port=printer._serial_port, baudrate=250000, timeout=0.5,
+            ds_firmware=dummyserial.MarlinSimulator(advanced_ok=True))
+        printer.commands_sent = 1
+        printer.connection_state = ConnectionState.connected
+        printer.start_transport()
+        await printer.negotiate()
+        return printer
+    return connect
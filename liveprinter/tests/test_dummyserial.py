@@ -0,0 +1,55 @@
+#
+# dummyserial reads block like a real port's: until a reply is due, until
+# something is written, or until the timeout
+#
+# See main license for details.
+#
+import threading
+import time
+import dummyserial
+
+
+def make_port(**kwargs):
+    return dummyserial.Serial(port="/dev/null", ds_responses={'G': b'ok\n'}, **kwargs)
+
+
+def test_read_waits_for_a_delayed_reply():
+    port = make_port(timeout=2, ds_latency=0.05)
+    port.write(b"G1 X1\n")
+    start = time.monotonic()
+    assert port.readline() == b"ok\n"
+    assert 0.04 < time.monotonic() - start < 1
+
+
+def test_read_wakes_up_when_written_to():
+    port = make_port(timeout=2)
+    threading.Timer(0.05, port.write, args=(b"G1 X1\n",)).start()
+    start = time.monotonic()
+    assert port.read(1) == b"o"
+    assert time.monotonic() - start < 1
+
+
+def test_read_times_out():
+    port = make_port(timeout=0.05)
+    start = time.monotonic()
+    assert port.read(1) == b""
+    assert port.readline() == b""
+    assert time.monotonic() - start >= 0.09
+
+
+def test_virtual_clock_doesnt_wait_for_replies():
+    port = make_port(timeout=2, ds_latency=5, ds_clock='virtual')
+    port.write(b"G1 X1\n")
+    start = time.monotonic()
+    assert port.readline() == b"ok\n"
+    assert time.monotonic() - start < 0.5
+    assert port.clock.now() >= 5
+
+
+def test_in_waiting_leaves_the_virtual_clock_alone():
+    port = make_port(timeout=2, ds_latency=5, ds_clock='virtual')
+    port.write(b"G1 X1\n")
+    before = port.clock.now()
+    assert port.in_waiting == 0
+    assert port.clock.now() == before
+    assert port.readline() == b"ok\n"
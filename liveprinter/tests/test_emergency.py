@@ -0,0 +1,62 @@
+#
+# with firmware that has an emergency parser, M108/M112/M410 go straight to
+# the port instead of waiting behind the command that's running
+#
+# See main license for details.
+#
+import asyncio
+import time
+
+
+def test_ping_pong_emergency_command_skips_the_queue(connect_dummy):
+    async def run():
+        printer = await connect_dummy('ping-pong')
+        # the simulator doesn't have one, but it's all the same to the host
+        printer.capabilities.caps['EMERGENCY_PARSER'] = True
+        written = []
+        write = printer._serial.write
+        def record(data):
+            written.append((time.monotonic(), data))
+            return write(data)
+        printer._serial.write = record
+        try:
+            # waits out the simulated hotend's 3s residency
+            heating = asyncio.ensure_future(printer.send_command("M109 S21"))
+            await asyncio.sleep(0.5)
+            asked = time.monotonic()
+            cancelled = asyncio.ensure_future(printer.send_command("M108"))
+            await asyncio.sleep(0.1)
+            sent = [when for (when, data) in written if data == b"M108\n"]
+            results = (await heating, await cancelled, await printer.send_command("G1 X10 F6000"))
+            return asked, sent, results
+        finally:
+            await printer.close()
+
+    asked, sent, (heating, cancelled, moved) = asyncio.run(run())
+    assert sent and sent[0] - asked < 0.1
+    assert heating[-1].startswith("ok")
+    assert cancelled == [cancelled[0]] and cancelled[0].startswith("ok")
+    assert moved == [moved[0]] and moved[0].startswith("ok")
+
+
+def test_window_emergency_stop_isnt_waited_for(connect_dummy):
+    async def run():
+        printer = await connect_dummy('window')
+        printer.capabilities.caps['EMERGENCY_PARSER'] = True
+        written = []
+        write = printer._serial.write
+        def record(data):
+            written.append(data)
+            return write(data)
+        printer._serial.write = record
+        try:
+            start = time.monotonic()
+            stopped = await printer.send_command("M112")
+            return time.monotonic() - start, stopped, written
+        finally:
+            await printer.close()
+
+    elapsed, stopped, written = asyncio.run(run())
+    assert elapsed < 1
+    assert stopped == []
+    assert written == [b"M112\n"]
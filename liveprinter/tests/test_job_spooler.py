@@ -0,0 +1,37 @@
+#
+# JobSpooler: streaming a GCODE file to the printer
+#
+# See main license for details.
+#
+import asyncio
+import logging
+from JobSpooler import JobSpooler
+
+
+class FakePrinter():
+    serial_logger = logging.getLogger("test")
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.events = []
+
+    def _notify(self, event):
+        self.events.append(event)
+
+    async def send_commands(self, batch):
+        return [self.replies.get(line, ["ok"]) for line in batch]
+
+
+def test_failed_job_reports_the_error_line(tmp_path):
+    path = tmp_path / "job.gcode"
+    path.write_text("G28\nG1 X10 ; move\nM104 S999\n")
+    printer = FakePrinter({"M104 S999": ["echo:busy: processing", "Error:Temperature too high", "ok"]})
+
+    async def run():
+        job = JobSpooler(printer, str(path))
+        await job.start()
+        return job
+
+    job = asyncio.run(run())
+    assert job.state == 'failed'
+    assert job.error == "Error:Temperature too high"
@@ -0,0 +1,40 @@
+#
+# MarlinParsers.parse_line: lines that only look like oks or temperature
+# reports by their first character must come back as plain responses
+#
+# See main license for details.
+#
+import pytest
+from MarlinParsers import parse_line, MarlinResponse, OkResponse, TemperatureReport
+
+
+@pytest.mark.parametrize("line", [
+    "Begin file list",
+    "Bed Leveling ON",
+    "TMC CONNECTION ERROR",
+    "okay",
+    "okay then",
+    ])
+def test_lookalikes_are_plain_responses(line):
+    response = parse_line(line)
+    assert type(response) is MarlinResponse
+    assert response.properties() == {'message': line}
+
+
+@pytest.mark.parametrize("line", [
+    "T:176.1 E:0 W:?",
+    "T0:200.0 /200.0 T1:25.0 /0.0",
+    "B:25.9 /60.0",
+    " T:20.0 /0.0 B:20.0 /0.0 @:0 B@:0",
+    ])
+def test_temperature_reports(line):
+    response = parse_line(line)
+    assert isinstance(response, TemperatureReport)
+    assert not response.ok
+
+
+def test_oks():
+    assert isinstance(parse_line("ok"), OkResponse)
+    assert isinstance(parse_line("ok N12 P15 B3"), OkResponse)
+    response = parse_line("ok T:20.0 /0.0 B:20.0 /0.0 @:0 B@:0")
+    assert isinstance(response, TemperatureReport) and response.ok
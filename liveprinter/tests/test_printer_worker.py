@@ -0,0 +1,33 @@
+#
+# WorkerPrinter: a printer in its own process, started on the first call
+#
+# See main license for details.
+#
+import asyncio
+import subprocess
+import PrinterWorker
+from PrinterWorker import WorkerPrinter
+
+
+def test_concurrent_first_calls_start_one_worker(monkeypatch):
+    started = []
+    popen = subprocess.Popen
+    def counting_popen(*args, **kwargs):
+        process = popen(*args, **kwargs)
+        started.append(process)
+        return process
+    monkeypatch.setattr(PrinterWorker.subprocess, 'Popen', counting_popen)
+
+    async def run():
+        printer = WorkerPrinter()
+        printer.worker_args = ["--telemetry_interval=0", "--firmware_cache="]
+        try:
+            return await asyncio.gather(*(printer.call("get-printer-state", []) for _ in range(3)))
+        finally:
+            await printer.close()
+
+    results = asyncio.run(run())
+    assert len(started) == 1
+    for result in results:
+        assert isinstance(result[0], dict), result
+    assert started[0].poll() is not None # stopped by close()
@@ -0,0 +1,32 @@
+#
+# M155 temperature auto-reports go to telemetry, except whilst a heater wait
+# is running: its progress reports look the same and are its replies
+#
+# See main license for details.
+#
+import asyncio
+import pytest
+
+
+@pytest.mark.parametrize("flow_mode", ['window', 'ping-pong'])
+def test_heater_wait_gets_its_progress_reports(connect_dummy, flow_mode):
+    async def run():
+        printer = await connect_dummy(flow_mode, telemetry_interval=1.0)
+        printer.max_retries = 10 # a second of silence and the stream is given up
+        try:
+            for _ in range(100):
+                if printer.telemetry.mode == 'autoreport':
+                    break
+                await asyncio.sleep(0.01) # M155 goes out in the background
+            assert printer.telemetry.mode == 'autoreport'
+            # takes the simulated hotend's 3s residency, with a report a second
+            heating, moved = await printer.send_commands(["M109 S21", "G1 X10 F6000"])
+            return heating, moved
+        finally:
+            await printer.close()
+
+    heating, moved = asyncio.run(run())
+    assert not any(str(line).startswith("ERROR") for line in heating)
+    assert any(" W:" in str(line) for line in heating)
+    assert heating[-1].startswith("ok")
+    assert len(moved) == 1 and moved[0].startswith("ok")